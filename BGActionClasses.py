@@ -1,10 +1,15 @@
 from .BGBaseClasses import *
 from .Settings import *
+from .BGIntervalIndex import *
 import datetime as dt
 
 #------------------------------------------------------------------
 def findFirstBG(conts) :
     # Quick function to find the first BG
+    # (with an IntervalIndex, only the measurements are looked at)
+    if isinstance(conts,IntervalIndex) :
+        conts = conts.OfType('BGMeasurement')
+
     for c in conts :
         if c.IsMeasurement() and c.firstBG :
             return c
@@ -12,6 +17,9 @@ def findFirstBG(conts) :
 
 #------------------------------------------------------------------
 class Annotation(BGEventBase) :
+
+    __slots__ = ('annotation',)
+
     def __init__(self,iov_0_utc,iov_1_utc,annotation) :
         BGEventBase.__init__(self,iov_0_utc,iov_1_utc)
         self.annotation = annotation.replace('\x00','').strip()
@@ -22,6 +30,8 @@ class BGMeasurement(BGEventBase) :
     #
     # BG Reading
     #
+    __slots__ = ('const_BG','firstBG')
+
     def __init__(self,iov_0_utc,iov_1_utc,const_BG) :
         BGEventBase.__init__(self,iov_0_utc,iov_1_utc)
         self.affectsBG = False
@@ -36,22 +46,44 @@ class BGMeasurement(BGEventBase) :
         iov_1_utc = BGEventBase.GetUtcFromString(iov_1_str)
         return cls(iov_0_utc,iov_1_utc,const_BG)
 
+#------------------------------------------------------------------
+def BolusWizardProperty(name,default) :
+    # An InsulinBolus attribute stored in its wizard dict, which is only made when set
+    def Get(self) :
+        if self.wizard is None :
+            return default
+        return self.wizard.get(name,default)
+
+    def Set(self,value) :
+        if self.wizard is None :
+            self.wizard = dict()
+        self.wizard[name] = value
+        return
+
+    return property(Get,Set)
+
 #------------------------------------------------------------------
 class InsulinBolus(BGActionBase) :
 
+    __slots__ = ('insulin','wizard')
+
+    # The bolus wizard values. Most boluses (e.g. the mini-boluses) keep the defaults, so
+    # the values are only stored (in the wizard dict) for the boluses that set them.
+    UserInputCarbSensitivity = BolusWizardProperty('UserInputCarbSensitivity',2)
+    BWZMatchedDelivered   = BolusWizardProperty('BWZMatchedDelivered',True)
+    BWZEstimate           = BolusWizardProperty('BWZEstimate',0)
+    BWZInsulinSensitivity = BolusWizardProperty('BWZInsulinSensitivity',0)
+    BWZCorrectionEstimate = BolusWizardProperty('BWZCorrectionEstimate',0)
+    BWZFoodEstimate       = BolusWizardProperty('BWZFoodEstimate',0)
+    BWZActiveInsulin      = BolusWizardProperty('BWZActiveInsulin',0)
+    BWZBGInput            = BolusWizardProperty('BWZBGInput',0)
+    BWZCarbRatio          = BolusWizardProperty('BWZCarbRatio',0)
+
     def __init__(self,time_ut,insulin) :
         BGActionBase.__init__(self,time_ut,time_ut + dt.timedelta(hours=6).total_seconds())
         self.affectsBG = True
         self.insulin = insulin
-        self.UserInputCarbSensitivity = 2
-        self.BWZMatchedDelivered = True
-        self.BWZEstimate = 0
-        self.BWZInsulinSensitivity = 0
-        self.BWZCorrectionEstimate = 0
-        self.BWZFoodEstimate       = 0
-        self.BWZActiveInsulin      = 0
-        self.BWZBGInput            = 0
-        self.BWZCarbRatio          = 0
+        self.wizard = None
 
     @classmethod
     def FromStringDate(cls,time_str,insulin) :
@@ -60,11 +92,17 @@ class InsulinBolus(BGActionBase) :
 
     # This used to be called getEffectiveSensitivity, but that name is misleading for food.
     def getMagnitudeOfBGEffect(self,settings) :
-        return settings.getInsulinSensitivity(self.iov_0_utc) * self.insulin
+        return self.getSettingAtStart(settings,'InsulinSensitivity') * self.insulin
+
+    def ContentKey(self) :
+        return BGActionBase.ContentKey(self) + (self.insulin,getattr(self,'Ta',None))
 
     def getIntegral(self,time_start,time_end,settings) :
         return self.getIntegralBase(time_start,time_end,settings,'getInsulinTa')
 
+    def getDeliveries(self,settings) :
+        return self.getDeliveriesBase(settings,'getInsulinTa')
+
     # Derivative, useful for making e.g. absorption plots
     def getBGEffectDerivPerHour(self,time_ut,settings) :
         return self.getBGEffectDerivPerHourBase(time_ut,settings,'getInsulinTa')
@@ -90,14 +128,39 @@ class InsulinBolus(BGActionBase) :
 
 #------------------------------------------------------------------
 class SquareWaveBolus(BGEventBase) :
+    #
+    # Two modes (chosen per instance):
+    # - discretized (the default): the square wave is a mini-bolus every 6 minutes
+    # - analytic: the constant infusion is convolved with the action curve in closed form
+    #   (see InsulinActionCurveIntegral), with no mini-boluses at all.
+    #
+    __slots__ = ('insulin','duration_hr','analytic','miniBoluses')
 
-    def __init__(self,time_ut,duration_hr,insulin) :
+    def __init__(self,time_ut,duration_hr,insulin,analytic=False) :
         BGEventBase.__init__(self,time_ut,time_ut + duration_hr + dt.timedelta(hours=6).total_seconds())
         self.affectsBG = True
         self.insulin = insulin
         self.duration_hr = duration_hr
+        self.analytic = analytic
         self.miniBoluses = []
 
+        if not self.analytic :
+            self.MakeMiniBoluses()
+
+        return
+
+    @classmethod
+    def FromStringDate(cls,time_str,duration_hr,insulin,analytic=False) :
+        """call via my_inst = SquareWaveBolus.FromStringDate('2019-02-24T12:00:00',3,4.0)"""
+
+        iov_0_utc = BGEventBase.GetUtcFromString(time_str)
+        return cls(iov_0_utc,duration_hr,insulin,analytic)
+
+    def MakeMiniBoluses(self) :
+
+        self.miniBoluses = []
+        time_ut = self.iov_0_utc
+
         # Update every 6 minutes...!
         time_step_hr = 0.1
 
@@ -117,23 +180,119 @@ class SquareWaveBolus(BGEventBase) :
 
         return
 
-    @classmethod
-    def FromStringDate(cls,time_str,duration_hr,insulin) :
-        """call via my_inst = SquareWaveBolus.FromStringDate('2019-02-24T12:00:00',3,4.0)"""
+    def SetAnalytic(self,analytic) :
+        # Switch between the analytic and the discretized mode
+        self.analytic = analytic
+        if self.analytic :
+            self.miniBoluses = []
+        elif not self.miniBoluses :
+            self.MakeMiniBoluses()
+        return
 
-        iov_0_utc = BGEventBase.GetUtcFromString(time_str)
-        return cls(iov_0_utc,duration_hr,insulin)
+    def getSegments(self,settings) :
+        # For the analytic mode: split the infusion at the half-hour (local time) boundaries,
+        # within which the sensitivity and Ta settings are constant.
+        # Returns a list of (start_utc, end_utc, BG effect per hour of infusion, Ta)
+        rate = self.insulin / float(self.duration_hr)
+
+        segments = []
+        for seg_start,seg_end in self.getSegmentTimes() :
+            magnitude = settings.getInsulinSensitivity(seg_start) * rate
+            Ta = settings.getInsulinTa(seg_start)
+            segments.append((seg_start,seg_end,magnitude,Ta))
+
+        return segments
+
+    def getSegmentTimes(self) :
+        # The (start_utc, end_utc) of the segments of getSegments
+        time_end = self.iov_0_utc + self.duration_hr*3600.
+
+        times = []
+        seg_start = self.iov_0_utc
+        while seg_start < time_end :
+            seg_end = int(seg_start) - (timeOfDay.LocalSeconds(seg_start) % 1800) + 1800
+            seg_end = min(seg_end,time_end)
+            times.append((seg_start,seg_end))
+            seg_start = seg_end
+
+        return times
+
+    def getSettingsBins(self,settings) :
+        # The profile bins that the settings are read from (at each mini-bolus, or segment start)
+        if self.analytic :
+            times = list(seg_start for seg_start,seg_end in self.getSegmentTimes())
+        else :
+            times = list(c.iov_0_utc for c in self.miniBoluses)
+        return np.unique(settings.getBin(np.array(times,dtype=np.float64))).tolist()
+
+    def getIntegralAnalytic(self,time_start,time_end,settings) :
+        ret = 0
+        for seg_start,seg_end,magnitude,Ta in self.getSegments(settings) :
+
+            # Like the mini-boluses, insulin delivered after time_end does not count
+            seg_end = min(seg_end,time_end)
+            if seg_end <= seg_start :
+                continue
+
+            G_end   = InsulinActionCurveIntegral((time_end  -seg_start)/3600.,Ta) - InsulinActionCurveIntegral((time_end  -seg_end)/3600.,Ta)
+            G_start = InsulinActionCurveIntegral((time_start-seg_start)/3600.,Ta) - InsulinActionCurveIntegral((time_start-seg_end)/3600.,Ta)
+            ret += (G_end - G_start) * magnitude
+
+        return ret
+
+    def getBGEffectDerivPerHourAnalytic(self,time_ut,settings) :
+        ret = 0
+        for seg_start,seg_end,magnitude,Ta in self.getSegments(settings) :
+
+            # Like the mini-boluses, only deliveries from the last 6 hours count
+            seg_start = max(seg_start,time_ut - dt.timedelta(hours=6).total_seconds())
+            seg_end = min(seg_end,time_ut)
+            if seg_end <= seg_start :
+                continue
+
+            ret += (InsulinActionCurve((time_ut-seg_start)/3600.,Ta) - InsulinActionCurve((time_ut-seg_end)/3600.,Ta)) * magnitude
+
+        return ret
+
+    def getDeliveries(self,settings) :
+        # The mini-boluses (none, in the analytic mode)
+        deliveries = list(c.getDeliveries(settings) for c in self.miniBoluses)
+        if not deliveries :
+            return np.zeros(0),np.zeros(0),np.zeros(0)
+        return tuple(np.concatenate(x) for x in zip(*deliveries))
+
+    def getInfusions(self,settings) :
+        # The constant-rate segments (none, in the discretized mode)
+        if not self.analytic :
+            return np.zeros(0),np.zeros(0),np.zeros(0),np.zeros(0)
+        return tuple(np.array(x,dtype=np.float64) for x in zip(*self.getSegments(settings)))
 
     def getBGEffectDerivPerHourTimesInterval(self,time_start,delta_hr,settings) :
+        if self.analytic :
+            return self.getBGEffectDerivPerHourAnalytic(time_start,settings) * delta_hr
         return sum(c.getBGEffectDerivPerHourTimesInterval(time_start,delta_hr,settings) for c in self.miniBoluses)
 
     def getBGEffectDerivPerHour(self,time_ut,settings) :
+        if self.analytic :
+            return self.getBGEffectDerivPerHourAnalytic(time_ut,settings)
         return sum(c.getBGEffectDerivPerHour(time_ut,settings) for c in self.miniBoluses)
 
     def getIntegral(self,time_start,time_end,settings) :
+        # (cached, since it is a sum over many mini-boluses or segments)
+        return self.CachedResult(settings,['InsulinSensitivity','InsulinTa'],
+                                 ('getIntegral',time_start,time_end,self.insulin,self.duration_hr,self.analytic),
+                                 lambda : self.getIntegralUncached(time_start,time_end,settings),
+                                 lambda : self.getSettingsBins(settings))
+
+    def getIntegralUncached(self,time_start,time_end,settings) :
+        if self.analytic :
+            return self.getIntegralAnalytic(time_start,time_end,settings)
         return sum(c.getIntegral(time_start,time_end,settings) for c in self.miniBoluses)
 
     def BGEffectRemaining(self,time_ut,settings) :
+        if self.analytic :
+            infinity = time_ut + datetime.timedelta(days=30).total_seconds()
+            return self.getIntegralAnalytic(time_ut,infinity,settings)
         return sum(c.BGEffectRemaining(time_ut,settings) for c in self.miniBoluses)
 
     def Print(self) :
@@ -143,6 +302,8 @@ class SquareWaveBolus(BGEventBase) :
 #------------------------------------------------------------------
 class DualWaveBolus(BGEventBase) :
 
+    __slots__ = ('insulin_square','insulin_inst','duration_hr','square','inst')
+
     def __init__(self,time_ut,duration_hr,insulin_square,insulin_inst) :
         BGEventBase.__init__(self,time_ut,time_ut + duration_hr + dt.timedelta(hours=6).total_seconds())
         self.affectsBG = True
@@ -150,7 +311,8 @@ class DualWaveBolus(BGEventBase) :
         self.insulin_inst = insulin_inst
         self.duration_hr = duration_hr
 
-        self.square = SquareWaveBolus(time_ut,duration_hr,insulin_square)
+        # The square part is always computed analytically
+        self.square = SquareWaveBolus(time_ut,duration_hr,insulin_square,analytic=True)
         self.inst = InsulinBolus(time_ut,insulin_inst)
 
     @classmethod
@@ -169,9 +331,21 @@ class DualWaveBolus(BGEventBase) :
     def getIntegral(self,time_start,time_end,settings) :
         return sum(c.getIntegral(time_start,time_end,settings) for c in [self.square,self.inst])
 
+    def getDeliveries(self,settings) :
+        return tuple(np.concatenate(x) for x in zip(self.square.getDeliveries(settings),self.inst.getDeliveries(settings)))
+
+    def getInfusions(self,settings) :
+        return self.square.getInfusions(settings)
+
+    def BGEffectRemaining(self,time_ut,settings) :
+        return sum(c.BGEffectRemaining(time_ut,settings) for c in [self.square,self.inst])
+
 #------------------------------------------------------------------
 class Food(BGActionBase) :
 
+    # (Ta is only set for a food with its own absorption time, see BGActionBase.getTa)
+    __slots__ = ('food','original_value','fattyMeal')
+
     def __init__(self,iov_utc,food) :
         BGActionBase.__init__(self,iov_utc,iov_utc + dt.timedelta(hours=6).total_seconds())
         self.affectsBG = True
@@ -191,12 +365,15 @@ class Food(BGActionBase) :
         return cls(iov_utc,food)
 
     def getMagnitudeOfBGEffect(self,settings) :
-        return settings.getFoodSensitivity(self.iov_0_utc) * self.food
+        return self.getSettingAtStart(settings,'FoodSensitivity') * self.food
 
     def getIntegral(self,time_start,time_end,settings) :
         # If it has its own tA, then the base class knows to override the settings.
         return self.getIntegralBase(time_start,time_end,settings,'getFoodTa')
 
+    def getDeliveries(self,settings) :
+        return self.getDeliveriesBase(settings,'getFoodTa')
+
     # Derivative, useful for making e.g. absorption plots
     def getBGEffectDerivPerHour(self,time_ut,settings) :
         # If it has its own tA, then the base class knows to override the settings.
@@ -242,22 +419,37 @@ class LiverBasalGlucose(BGEventBase) :
     # - It has an "infinite" (or undefined) magnitude
     # - It has no defined start time, so its integral can only be defined between two moments
 
+    __slots__ = ('binWidth_hr','nBins','LiverHourlyGlucoseFine','smear_hr_pm','smearedKey','cumulativeFine')
+
     def __init__(self) :
         BGEventBase.__init__(self,0,float('inf'))
         self.affectsBG = True
         self.binWidth_hr = 0.25 # granularity of the binning, when calculating.
         self.nBins = int( 24 / self.binWidth_hr )
-        self.LiverHourlyGlucoseFine = [0]*self.nBins # Make memory slots, but recalculate each time
+        self.LiverHourlyGlucoseFine = [0]*self.nBins # Make memory slots, recalculated when the settings change
         self.smear_hr_pm = 1 # average the rate over plus or minus X hours
+
+        # The smeared list is cached, and recalculated only when this key changes
+        self.smearedKey = None
+
+        # Cumulative integral (in mg/dL) of the smeared list from midnight up to the
+        # start of each fine bin. The last entry is the integral over the whole day.
+        self.cumulativeFine = [0]*(self.nBins+1)
         return
 
     def getBin(self,time_ut) :
         # time of day (in hours, fractional)
-        lt = time.localtime(time_ut)
-        bin = int( (lt.tm_hour + lt.tm_min/60.)/float(self.binWidth_hr) )
-        return bin
+        return timeOfDay.GetBin(time_ut,self.binWidth_hr)
 
     def getSmearedList(self,settings) :
+
+        if hasattr(settings,'arrayVersions') :
+            key = (settings.arrayVersions['LiverHourlyGlucose'],settings.binWidth_hr,self.smear_hr_pm,self.binWidth_hr)
+        else :
+            key = (tuple(settings.LiverHourlyGlucose),settings.binWidth_hr,self.smear_hr_pm,self.binWidth_hr)
+        if key == self.smearedKey :
+            return self.LiverHourlyGlucoseFine
+
         # First, lengthen the list
         tmp = []
         for BG in settings.LiverHourlyGlucose :
@@ -274,48 +466,51 @@ class LiverBasalGlucose(BGEventBase) :
                 val += tmp[j%(len(tmp))]
             self.LiverHourlyGlucoseFine[i] = val/float(n)
 
+        # And the cumulative sums, for the integral
+        for i in range(self.nBins) :
+            self.cumulativeFine[i+1] = self.cumulativeFine[i] + self.LiverHourlyGlucoseFine[i]*self.binWidth_hr
+
+        self.smearedKey = key
+
         #print(''.join('%2.1f '%(a) for a in LiverHourlyGlucoseFine))
         return self.LiverHourlyGlucoseFine
 
+    def getCumulativeIntegral(self,time_from_midnight) :
+        # Integral of the (periodic) smeared list from a midnight to (midnight + time_from_midnight).
+        # Call getSmearedList first.
+        bin_s = self.binWidth_hr*3600.
+        days = math.floor(time_from_midnight/86400.)
+        time_in_day = time_from_midnight - days*86400.
+        liver_bin = min(int(time_in_day//bin_s),self.nBins-1)
+
+        partial = self.cumulativeFine[liver_bin] + (time_in_day - liver_bin*bin_s)/3600. * self.LiverHourlyGlucoseFine[liver_bin]
+        return days*self.cumulativeFine[self.nBins] + partial
+
+    def getCumulativeIntegralArray(self,time_from_midnight) :
+        # Same as getCumulativeIntegral, for an array of times
+        time_from_midnight = np.asarray(time_from_midnight,dtype=np.float64)
+        bin_s = self.binWidth_hr*3600.
+        days = np.floor(time_from_midnight/86400.)
+        time_in_day = time_from_midnight - days*86400.
+        liver_bin = np.minimum((time_in_day//bin_s).astype(np.int64),self.nBins-1)
+
+        cumulative = np.array(self.cumulativeFine)
+        fine = np.array(self.LiverHourlyGlucoseFine)
+        partial = cumulative[liver_bin] + (time_in_day - liver_bin*bin_s)/3600. * fine[liver_bin]
+        return days*cumulative[self.nBins] + partial
 
     def getIntegral(self,time_start,time_end,settings) :
 
-        tmp_LiverHourlyGlucoseFine = self.getSmearedList(settings)
-
-        sum = 0
-
-        # iterators (both are incremented, to avoid float-to-int errors)
-        it_time = time_start
-        liver_bin = self.getBin(it_time)
-
-        tmp = time.localtime(time_start)
-        time_start_day = time_start - tmp.tm_sec - 60*tmp.tm_min - 3600*tmp.tm_hour
-
-        # print('Getting integral for',time.ctime(time_start),time.ctime(time_end))
-
-        # Go through times up to the end, plus one bin width (in order to avoid missing the last bin)
-        while (it_time <= time_end + dt.timedelta(hours=self.binWidth_hr).total_seconds()) :
-
-            # For each bin, find the valid time interval (in hours)
-            # This should ensure that the final bin is treated correctly.
-            low_edge = max(time_start,time_start_day + liver_bin    *dt.timedelta(hours=self.binWidth_hr).total_seconds() )
-            up_edge  = min(time_end  ,time_start_day + (liver_bin+1)*dt.timedelta(hours=self.binWidth_hr).total_seconds() )
-
-            if up_edge < low_edge :
-                break
-
-            delta_time_hr = (up_edge - low_edge)/3600.
-            # print('bin edges:',time.ctime(time_start_day + liver_bin    *self.binWidth_hr*3600.))
-            # print(             time.ctime(time_start_day + (liver_bin+1)*self.binWidth_hr*3600.))
-            # print(time.ctime(low_edge), time.ctime(up_edge), delta_time_hr)
+        if time_end <= time_start :
+            return 0
 
-            # return (Glucose / hour) * D(hour)
-            sum += delta_time_hr * tmp_LiverHourlyGlucoseFine[liver_bin % self.nBins]
+        self.getSmearedList(settings)
 
-            it_time += self.binWidth_hr*3600.
-            liver_bin += 1
+        # The bins are aligned to the midnight of the first day. Any interval length costs the same:
+        # (whole-day integral) * (number of days) + partial-day lookups.
+        time_start_day = timeOfDay.Midnight(time_start)
 
-        return sum
+        return self.getCumulativeIntegral(time_end - time_start_day) - self.getCumulativeIntegral(time_start - time_start_day)
 
     def BGEffectRemaining(self,the_time,settings) :
         return 0
@@ -333,6 +528,41 @@ class LiverBasalGlucose(BGEventBase) :
         # Same, but for the smeared list:
         return self.getSmearedList(settings)[self.getBin(time_ut)]
 
+    def getSmearMatrix(self,settings) :
+        # The smeared list is linear in settings.LiverHourlyGlucose:
+        #   LiverHourlyGlucoseFine = numpy.dot(matrix,settings.LiverHourlyGlucose)
+        nCoarse = len(settings.LiverHourlyGlucose)
+        nRepeat = int(settings.binWidth_hr/self.binWidth_hr)
+        nFine = nCoarse*nRepeat
+        smear_hr_pm = int(self.smear_hr_pm/self.binWidth_hr)
+
+        matrix = np.zeros((nFine,nCoarse))
+        for i in range(nFine) :
+            for j in range(i-smear_hr_pm,i+smear_hr_pm+1) :
+                matrix[i,(j%nFine)//nRepeat] += 1./(2*smear_hr_pm+1)
+
+        return matrix
+
+    def getFineBinHours(self,time_start,time_end) :
+        # For arrays of windows: the hours spent in each fine bin (shape: windows x fine bins),
+        # such that getIntegral(time_start,time_end) = numpy.dot(hours,LiverHourlyGlucoseFine).
+        time_start = np.atleast_1d(np.asarray(time_start,dtype=np.float64))
+        time_end = np.atleast_1d(np.asarray(time_end,dtype=np.float64))
+        midnight = timeOfDay.Midnight(time_start)
+
+        bin_s = self.binWidth_hr*3600.
+        edges = np.arange(self.nBins)*bin_s
+
+        def HoursFromMidnight(time_from_midnight) :
+            days = np.floor(time_from_midnight/86400.)
+            time_in_day = time_from_midnight - days*86400.
+            partial = np.clip(time_in_day[:,None] - edges[None,:],0,bin_s)/3600.
+            return days[:,None]*self.binWidth_hr + partial
+
+        hours = HoursFromMidnight(time_end - midnight) - HoursFromMidnight(time_start - midnight)
+        hours[time_end <= time_start] = 0
+        return hours
+
 #------------------------------------------------------------------
 class BasalInsulin(BGEventBase) :
     # This is driven by the basal settings, but it is NOT a parameter of interest, it is a known
@@ -340,9 +570,25 @@ class BasalInsulin(BGEventBase) :
     # - It has an "infinite" (or undefined) magnitude
     # - It has no defined start time, so its integral can only be defined between two moments
 
+    __slots__ = ('BasalRates','deliveryTimes','deliveryBins','deliveryAmounts','settingsBins','deliveryVersion')
+
     def getBin(self,time_ut) :
         # From 4am ... and assuming 48 bins
-        return int(2 * (time.localtime(time_ut).tm_hour + time.localtime(time_ut).tm_min/60.) )
+        return timeOfDay.GetBin(time_ut,0.5)
+
+    def __setattr__(self,name,value) :
+        # The deliveries are read-only copies: a change means new arrays, and a new
+        # deliveryVersion (for the cached results, see getIntegral and ContentKey)
+        if name in ['deliveryTimes','deliveryAmounts'] :
+            value = np.array(value,dtype=np.float64)
+            value.flags.writeable = False
+            object.__setattr__(self,'deliveryVersion',NewVersion())
+            if name == 'deliveryTimes' :
+                object.__setattr__(self,'deliveryBins',self.getBin(value))
+                object.__setattr__(self,'settingsBins',dict())
+
+        object.__setattr__(self,name,value)
+        return
 
     def __init__(self,iov_0_utc,iov_1_utc,basal_rates,sensitivities=None,containers=[]) :
         BGEventBase.__init__(self,iov_0_utc,iov_1_utc)
@@ -359,61 +605,68 @@ class BasalInsulin(BGEventBase) :
             TrueUserProfile.SettingsArrayToList(sensitivities,tmp_InsulinSensitivityList)
         elif type(sensitivities) == type([]) :
             tmp_InsulinSensitivityList = sensitivities
-
-
-        self.basalBoluses = []
+        has_sensitivities = (sensitivities is not None) and (len(sensitivities) > 0)
 
         # Rounded down to the nearest hour:
-        time_ut = iov_0_utc - 60*time.localtime(iov_0_utc).tm_min - time.localtime(iov_0_utc).tm_sec
+        time_ut = iov_0_utc - timeOfDay.SecondsIntoHour(iov_0_utc)
 
         # Update every 6 minutes...!
         time_step_hr = 0.1
 
-        fattyEvents = dict()
-
-        while time_ut < iov_1_utc :
-
-            basalFactor = 1
-            bolus_val = self.BasalRates[self.getBin(time_ut)]*float(time_step_hr)*basalFactor
-
-            # If there is a TempBasal, then modify the basalFactor
-            for c in containers :
-                if not c.IsTempBasal() :
-                    continue
+        # The basal insulin is stored as two arrays (rather than one InsulinBolus per step):
+        # the delivery times, and the insulin delivered at each time.
+        # (the bin of each delivery is set with the times, see __setattr__)
+        self.deliveryTimes = np.arange(time_ut,iov_1_utc,time_step_hr*3600.)
+        nominal = np.asarray(self.BasalRates,dtype=np.float64)[self.deliveryBins]*float(time_step_hr)
+        basalFactors = np.ones(len(self.deliveryTimes))
 
-                if c.iov_0_utc > time_ut or time_ut > c.iov_1_utc :
-                    continue
-
-                basalFactor = c.basalFactor
+        fattyEvents = dict()
 
-                # If the basalFactor >1, then
-                # Make a new LiverFattyGlucose object, add it to container list
-                if (basalFactor > 1) and sensitivities :
-                    insulin_sensi = tmp_InsulinSensitivityList[self.getBin(time_ut)]
-                    bolusSlice = -insulin_sensi*bolus_val*(basalFactor-1)
+        # Index the TempBasals and Suspends once, instead of scanning all containers at every step
+        if isinstance(containers,IntervalIndex) :
+            basalModifiers = containers
+        else :
+            basalModifiers = IntervalIndex(c for c in containers if (c.IsTempBasal() or c.IsSuspend()))
+
+        # If there is a TempBasal, then modify the basalFactor. (Later TempBasals win.)
+        tempBasals = []
+        for c in basalModifiers.Overlapping(time_ut,iov_1_utc,'TempBasal') :
+            lo = np.searchsorted(self.deliveryTimes,c.iov_0_utc,side='left')
+            hi = np.searchsorted(self.deliveryTimes,c.iov_1_utc,side='right')
+            if hi <= lo :
+                continue
+            basalFactors[lo:hi] = c.basalFactor
+            tempBasals.append((lo,hi,c))
+
+        # If the basalFactor >1, then
+        # Make a new LiverFattyGlucose object, add it to container list
+        # (in order of their first step, as if stepping through time)
+        tempBasals.sort(key=lambda x: x[0])
+        for lo,hi,c in tempBasals :
+            basalFactor = c.basalFactor
+            if not ((basalFactor > 1) and has_sensitivities) :
+                continue
 
-                    if c.iov_0_utc not in fattyEvents.keys() :
-                        Ta_tempBasal = (c.iov_1_utc - c.iov_0_utc) / float(3600.)
-                        fattyEvents[c.iov_0_utc] = {'iov_0_utc':c.iov_0_utc,'iov_1_utc':c.iov_1_utc}
-                        fattyEvents[c.iov_0_utc]['BGEffect'] = bolusSlice
-                        fattyEvents[c.iov_0_utc]['Ta_tempBasal'] = Ta_tempBasal
-                        fattyEvents[c.iov_0_utc]['fractionOfBasal'] = basalFactor-1
-                    else :
-                        fattyEvents[c.iov_0_utc]['BGEffect'] += bolusSlice
+            insulin_sensi = np.asarray(tmp_InsulinSensitivityList,dtype=np.float64)[self.deliveryBins[lo:hi]]
+            BGEffect = np.sum(-insulin_sensi*nominal[lo:hi]*(basalFactor-1))
 
-            # Now check for Suspend, which should preempt TempBasals
-            for c in containers :
-                if not c.IsSuspend() :
-                    continue
-                if c.iov_0_utc < time_ut and time_ut < c.iov_1_utc :
-                    basalFactor = c.basalFactor
+            if c.iov_0_utc not in fattyEvents.keys() :
+                Ta_tempBasal = (c.iov_1_utc - c.iov_0_utc) / float(3600.)
+                fattyEvents[c.iov_0_utc] = {'iov_0_utc':c.iov_0_utc,'iov_1_utc':c.iov_1_utc}
+                fattyEvents[c.iov_0_utc]['BGEffect'] = BGEffect
+                fattyEvents[c.iov_0_utc]['Ta_tempBasal'] = Ta_tempBasal
+                fattyEvents[c.iov_0_utc]['fractionOfBasal'] = basalFactor-1
+            else :
+                fattyEvents[c.iov_0_utc]['BGEffect'] += BGEffect
 
-            # Finally, make the mini-bolus for the basal insulin.
-            bolus_val *= basalFactor
-            minibolus = InsulinBolus(time_ut,bolus_val)
-            self.basalBoluses.append(minibolus)
+        # Now check for Suspend, which should preempt TempBasals
+        for c in basalModifiers.Overlapping(time_ut,iov_1_utc,'Suspend') :
+            lo = np.searchsorted(self.deliveryTimes,c.iov_0_utc,side='right')
+            hi = np.searchsorted(self.deliveryTimes,c.iov_1_utc,side='left')
+            basalFactors[lo:hi] = c.basalFactor
 
-            time_ut += time_step_hr*3600.
+        # Finally, the basal insulin delivered at each step.
+        self.deliveryAmounts = nominal * basalFactors
 
         for k in fattyEvents.keys() :
             fe = fattyEvents[k]
@@ -431,14 +684,82 @@ class BasalInsulin(BGEventBase) :
 
         return cls(iov_0_utc,iov_1_utc,basal_rates,sensitivities,containers)
 
+    @classmethod
+    def FromDeliveries(cls,iov_0_utc,iov_1_utc,basal_rates,deliveryTimes,deliveryAmounts) :
+        # The BasalInsulin with these deliveries (e.g. as packed by BGArchive.PackBasal): the
+        # TempBasals and Suspends are already applied, and no LiverFattyGlucose events are made.
+        basal = cls.__new__(cls)
+        BGEventBase.__init__(basal,iov_0_utc,iov_1_utc)
+        basal.affectsBG = True
+        basal.BasalRates = list(basal_rates)
+        basal.deliveryTimes = deliveryTimes
+        basal.deliveryAmounts = deliveryAmounts
+        return basal
+
+    @property
+    def basalBoluses(self) :
+        # The old representation (one InsulinBolus per step), made on demand.
+        return list(InsulinBolus(t,insulin) for t,insulin in zip(self.deliveryTimes.tolist(),self.deliveryAmounts.tolist()))
+
+    def ContentKey(self) :
+        return BGEventBase.ContentKey(self) + (self.deliveryVersion,)
+
+    def getSettingsBins(self,settings,lo,hi) :
+        # The settings (TrueUserProfile) bin of each delivery in [lo,hi), cached per bin width
+        # (settingsBins is reset with the delivery times)
+        if settings.binWidth_hr not in self.settingsBins.keys() :
+            self.settingsBins[settings.binWidth_hr] = settings.getBin(self.deliveryTimes)
+        return self.settingsBins[settings.binWidth_hr][lo:hi]
+
+    def getDeliveryEffects(self,settings,lo=0,hi=None) :
+        # The BG effect (sensitivity * insulin) and Ta of the deliveries in [lo,hi)
+        bins = self.getSettingsBins(settings,lo,hi)
+        magnitudes = np.asarray(settings.InsulinSensitivity,dtype=np.float64)[bins] * self.deliveryAmounts[lo:hi]
+        Ta = np.asarray(settings.InsulinTa,dtype=np.float64)[bins]
+        return magnitudes,Ta
+
+    def getDeliveries(self,settings) :
+        magnitudes,Ta = self.getDeliveryEffects(settings)
+        return self.deliveryTimes,magnitudes,Ta
+
     def getBGEffectDerivPerHourTimesInterval(self,time_start,delta_hr,settings) :
-        return sum(c.getBGEffectDerivPerHourTimesInterval(time_start,delta_hr,settings) for c in self.basalBoluses)
+        return self.getBGEffectDerivPerHour(time_start,settings) * delta_hr
 
     def getBGEffectDerivPerHour(self,time_ut,settings) :
-        return sum(c.getBGEffectDerivPerHour(time_ut,settings) for c in self.basalBoluses)
+        # Only the deliveries from the last 6 hours count (like an InsulinBolus)
+        lo = np.searchsorted(self.deliveryTimes,time_ut - dt.timedelta(hours=6).total_seconds(),side='left')
+        hi = np.searchsorted(self.deliveryTimes,time_ut,side='right')
+        if hi <= lo :
+            return 0.
+
+        magnitudes,Ta = self.getDeliveryEffects(settings,lo,hi)
+        time_hr = (time_ut - self.deliveryTimes[lo:hi])/3600.
+        return float(np.dot(InsulinActionCurveDerivativeArray(time_hr,Ta),magnitudes))
 
     def getIntegral(self,time_start,time_end,settings) :
-        return sum(c.getIntegral(time_start,time_end,settings) for c in self.basalBoluses)
+        # (cached, per window and version of the settings bins of the deliveries it reads;
+        # which deliveries those are depends on the longest Ta, so that is part of the key)
+        maxTa = float(np.max(settings.InsulinTa))
+        return self.CachedResult(settings,['InsulinSensitivity','InsulinTa'],('getIntegral',time_start,time_end,maxTa,self.deliveryVersion),
+                                 lambda : self.getIntegralUncached(time_start,time_end,settings),
+                                 lambda : np.unique(self.getSettingsBins(settings,*self.getIntegralRange(time_start,time_end,maxTa))).tolist())
+
+    def getIntegralRange(self,time_start,time_end,maxTa) :
+        # The deliveries [lo,hi) that count: deliveries after time_end do not count, and
+        # deliveries long before time_start have saturated, and contribute exactly zero.
+        lo = np.searchsorted(self.deliveryTimes,time_start - saturationTime_Ta*maxTa*3600.,side='left')
+        hi = np.searchsorted(self.deliveryTimes,time_end,side='right')
+        return lo,hi
+
+    def getIntegralUncached(self,time_start,time_end,settings) :
+        lo,hi = self.getIntegralRange(time_start,time_end,float(np.max(settings.InsulinTa)))
+        if hi <= lo :
+            return 0.
+
+        magnitudes,Ta = self.getDeliveryEffects(settings,lo,hi)
+        curve_end   = InsulinActionCurveArray((time_end   - self.deliveryTimes[lo:hi])/3600.,Ta)
+        curve_start = InsulinActionCurveArray((time_start - self.deliveryTimes[lo:hi])/3600.,Ta)
+        return float(np.dot(curve_end - curve_start,magnitudes))
 
     def BGEffectRemaining(self,the_time,settings) :
         return 0
@@ -448,6 +769,8 @@ class TempBasal(BGEventBase) :
 
     # This class is designed to communicate with the BasalInsulin class.
 
+    __slots__ = ('basalFactor',)
+
     def __init__(self,iov_0_utc,iov_1_utc,basalFactor) :
         BGEventBase.__init__(self,iov_0_utc,iov_1_utc)
         self.affectsBG = False
@@ -470,6 +793,8 @@ class Suspend(TempBasal) :
     # Very similar to TempBasal, except that we need a different class
     # because Suspend takes precedence over TempBasal
 
+    __slots__ = ()
+
     def __init__(self,iov_0_utc,iov_1_utc) :
         TempBasal.__init__(self,iov_0_utc,iov_1_utc,0)
         self.affectsBG = False
@@ -489,6 +814,8 @@ class LiverFattyGlucose(BGActionBase) :
     # is simply "BG Effect". In other words, we will not attempt any tricky transformation
     # to insulin or food or something.
 
+    __slots__ = ('BGEffect','original_value','fractionOfBasal','Ta_tempBasal')
+
     def __init__(self,time_start,time_end,BGEffect,Ta_tempBasal,fractionOfBasal) :
         BGActionBase.__init__(self,time_start,time_end + 6.*3600.)
         self.affectsBG = True
@@ -531,6 +858,9 @@ class LiverFattyGlucose(BGActionBase) :
         # Use a trick below: instead of settings, give them self (for Ta)
         return self.getIntegralBase(time_start,time_end,self,'getFattyGlucoseLocalTa')
 
+    def getDeliveries(self,settings) :
+        return self.getDeliveriesBase(self,'getFattyGlucoseLocalTa')
+
 
     # Derivative, useful for making e.g. absorption plots
     def getBGEffectDerivPerHour(self,time_ut,settings) :
@@ -581,11 +911,17 @@ class ExerciseEffect(BGEventBase) :
     # This will calculate the "multiplier effect" that exercise has on insulin,
     # and its effect is the sum of those effects.
     #
+    __slots__ = ('factor','affectedEvents','magnitudeCache','derivativeCache')
+
     def __init__(self,iov_0_utc,iov_1_utc,factor,containers=[]) :
         BGEventBase.__init__(self,iov_0_utc,iov_1_utc)
         self.affectsBG = True
         self.factor = factor
         self.affectedEvents = []
+
+        # Cached results, valid for one CacheKey: (key,magnitude), and the derivatives by (time,key)
+        self.magnitudeCache = None
+        self.derivativeCache = OrderedDict()
         if len(containers) :
             self.LoadContainers(containers)
         return
@@ -599,17 +935,12 @@ class ExerciseEffect(BGEventBase) :
         return cls(iov_0_utc,iov_1_utc,factor)
 
     def LoadContainers(self,containers) :
-        for c in containers :
-            if c.iov_0_utc > self.iov_1_utc :
-                continue
-
-            if c.iov_1_utc < self.iov_0_utc :
-                continue
-
-            # Consider only insulin
-            if not (c.IsBasalInsulin() or c.IsBolus()) :
-                continue
+        # containers can be a list, or an IntervalIndex (to be shared between many ExerciseEffects)
+        if not isinstance(containers,IntervalIndex) :
+            containers = IntervalIndex(containers)
 
+        # Consider only insulin
+        for c in containers.Overlapping(self.iov_0_utc,self.iov_1_utc,['BasalInsulin','InsulinBolus']) :
             self.affectedEvents.append(c)
 
         return
@@ -617,19 +948,26 @@ class ExerciseEffect(BGEventBase) :
     def BGEffectRemaining(self,the_time,settings) :
         return 0
 
-    def getMagnitudeOfBGEffect(self,settings) :
-        mag = 0
-
-        time_step = self.iov_0_utc
-        hours_per_step = 0.1
+    def CacheKey(self,settings) :
+        # The cached results are for the same profile version, the same affectedEvents (each
+        # with the same ContentKey: editing one in place changes it too) and the same action
+        # curve mode
+        version = getattr(settings,'version',None)
+        if version is None :
+            version = (id(settings),settings.Fingerprint())
+        return (version,tuple(c.ContentKey() for c in self.affectedEvents),GetActionCurveMode())
 
-        while time_step < self.iov_1_utc :
-
-            for c in self.affectedEvents :
-                mag += c.getBGEffectDerivPerHourTimesInterval(time_step,hours_per_step,settings)
+    def getMagnitudeOfBGEffect(self,settings) :
+        # The integral of the affected events over the exercise window, times the factor
+        key = self.CacheKey(settings)
+        if (self.magnitudeCache is not None) and (self.magnitudeCache[0] == key) :
+            return self.magnitudeCache[1]
 
-            time_step += dt.timedelta(hours=hours_per_step).total_seconds()
+        mag = 0
+        for c in self.affectedEvents :
+            mag += c.getIntegral(self.iov_0_utc,self.iov_1_utc,settings)
 
+        self.magnitudeCache = (key,mag * self.factor)
         return mag * self.factor
 
     def getBGEffectDerivPerHour(self,time_ut,settings) :
@@ -637,9 +975,19 @@ class ExerciseEffect(BGEventBase) :
         if self.iov_0_utc > time_ut or time_ut > self.iov_1_utc :
             return 0
 
+        key = (time_ut,self.CacheKey(settings))
+        if key in self.derivativeCache :
+            self.derivativeCache.move_to_end(key)
+            return self.derivativeCache[key]
+
         for c in self.affectedEvents :
             deriv += c.getBGEffectDerivPerHour(time_ut,settings)
 
+        # (a small LRU cache)
+        self.derivativeCache[key] = deriv * self.factor
+        if len(self.derivativeCache) > 256 :
+            self.derivativeCache.popitem(last=False)
+
         return deriv * self.factor
 
     def getBGEffectDerivPerHourTimesInterval(self,time_start,delta_hr,settings) :
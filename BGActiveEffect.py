@@ -0,0 +1,143 @@
+from .BGActionClasses import *
+from collections import OrderedDict
+
+#------------------------------------------------------------------
+#
+# The remaining ("active") BG effect at a given time, for a bolus wizard:
+#
+#     index = ActiveEffectIndex(events,the_userprofile)
+#     index.BGEffectRemaining(time_ut)   # OrderedDict: insulin, food, fatty (in mg/dL)
+#     index.Total(time_ut)
+#
+# This is the sum of event.BGEffectRemaining(time_ut) over the events that have started
+# by time_ut (iov_0_utc <= time_ut), split by kind. Like BGEffectRemaining, a square wave
+# in progress counts the part that is not delivered yet, and the basal is not included.
+#
+# The events are reduced once to arrays of deliveries (and of infusion segments for the
+# analytic square waves, so they are never split into mini-boluses), each with the time
+# from which it counts (its event start) and the time at which its effect has saturated
+# (saturationTime_Ta * Ta after delivery). A query only looks at the deliveries between
+# those two times, found by bisection like in IntervalIndex, so it does not depend on
+# the length of the history.
+#
+
+activeEffectKinds = ['insulin','food','fatty']
+
+activeEffectKindOf = {'InsulinBolus'      :'insulin',
+                      'SquareWaveBolus'   :'insulin',
+                      'DualWaveBolus'     :'insulin',
+                      'Food'              :'food',
+                      'LiverFattyGlucose' :'fatty',
+                      }
+
+#------------------------------------------------------------------
+class ActiveEffectIndex :
+
+    def __init__(self,events,settings) :
+        self.events = list(e for e in events if e.__class__.__name__ in activeEffectKindOf.keys())
+        self.settings = settings
+        self.version = None
+        self.dirty = True
+        return
+
+    def __len__(self) :
+        return len(self.events)
+
+    def append(self,event) :
+        if event.__class__.__name__ in activeEffectKindOf.keys() :
+            self.events.append(event)
+            self.dirty = True
+        return
+
+    def Build(self) :
+        # The deliveries (and segments) of all events, split into tiers by how long they count
+        # (powers of two in seconds, as in IntervalIndex)
+        columns = OrderedDict((name,[]) for name in ['starts','ends','kinds','times','times_end','magnitudes','Ta'])
+
+        def Add(event,times,times_end,magnitudes,Ta) :
+            # (times_end is None for point deliveries, and NaN in the column)
+            n = len(times)
+            if not n :
+                return
+            if times_end is None :
+                columns['ends'].append(times + saturationTime_Ta*Ta*3600.)
+                times_end = np.full(n,np.nan)
+            else :
+                columns['ends'].append(times_end + saturationTime_Ta*Ta*3600.)
+            columns['starts'].append(np.full(n,float(event.iov_0_utc)))
+            columns['kinds'].append(np.full(n,activeEffectKinds.index(activeEffectKindOf[event.__class__.__name__]),dtype=np.int32))
+            columns['times'].append(times)
+            columns['times_end'].append(times_end)
+            columns['magnitudes'].append(magnitudes)
+            columns['Ta'].append(Ta)
+            return
+
+        for e in self.events :
+            times,magnitudes,Ta = (np.asarray(x,dtype=np.float64) for x in e.getDeliveries(self.settings))
+            Add(e,times,None,magnitudes,Ta)
+            if hasattr(e,'getInfusions') :
+                starts,ends,magnitudes,Ta = (np.asarray(x,dtype=np.float64) for x in e.getInfusions(self.settings))
+                Add(e,starts,ends,magnitudes,Ta)
+
+        for name in columns.keys() :
+            dtype = np.int32 if (name == 'kinds') else np.float64
+            columns[name] = np.concatenate(columns[name]) if columns[name] else np.zeros(0,dtype=dtype)
+
+        durations = columns['ends'] - columns['starts']
+        tiers = np.log2(np.maximum(durations,0) + 1).astype(np.int32)
+
+        self.tiers = []
+        for tier in np.unique(tiers) :
+            positions = np.nonzero(tiers == tier)[0]
+            positions = positions[np.argsort(columns['starts'][positions],kind='stable')]
+            tier_columns = OrderedDict((name,columns[name][positions]) for name in columns.keys())
+            tier_columns['inverseTa_s'] = 1./(tier_columns['Ta']*3600.)
+            self.tiers.append((tier_columns,durations[positions].max()))
+
+        self.version = getattr(self.settings,'version',None)
+        self.dirty = False
+        return
+
+    def Active(self,time_ut) :
+        # The columns of the deliveries that count at time_ut (started, and not saturated)
+        if self.dirty or (getattr(self.settings,'version',None) != self.version) :
+            self.Build()
+
+        for tier_columns,max_duration in self.tiers :
+            starts = tier_columns['starts']
+            lo = np.searchsorted(starts,time_ut - max_duration,side='left')
+            hi = np.searchsorted(starts,time_ut,side='right')
+            if hi <= lo :
+                continue
+
+            mask = tier_columns['ends'][lo:hi] >= time_ut
+            if not np.any(mask) :
+                continue
+            yield OrderedDict((name,values[lo:hi][mask]) for name,values in tier_columns.items())
+
+        return
+
+    def BGEffectRemaining(self,time_ut) :
+        # The remaining BG effect at time_ut, by kind
+        result = np.zeros(len(activeEffectKinds))
+        for active in self.Active(time_ut) :
+            times,times_end = active['times'],active['times_end']
+            point = np.isnan(times_end)
+
+            # Point deliveries: magnitude * (1 - curve(t - time)), and all of it if it is still to come
+            x = (time_ut - times[point])*active['inverseTa_s'][point]
+            remaining = np.where(x < 0,1.,np.exp(math.log(0.05)*x*x))*active['magnitudes'][point]
+            result += np.bincount(active['kinds'][point],weights=remaining,minlength=len(result))
+
+            # Infusions (magnitudes are per hour): the total minus the part already absorbed
+            if np.all(point) :
+                continue
+            starts,ends,Ta = times[~point],times_end[~point],active['Ta'][~point]
+            absorbed = InsulinActionCurveIntegralArray((time_ut - starts)/3600.,Ta) - InsulinActionCurveIntegralArray((time_ut - ends)/3600.,Ta)
+            remaining = ((ends - starts)/3600. - absorbed)*active['magnitudes'][~point]
+            result += np.bincount(active['kinds'][~point],weights=remaining,minlength=len(result))
+
+        return OrderedDict(zip(activeEffectKinds,result.tolist()))
+
+    def Total(self,time_ut) :
+        return sum(self.BGEffectRemaining(time_ut).values())
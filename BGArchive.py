@@ -0,0 +1,150 @@
+import os
+import json
+from .BGEventStore import *
+
+#------------------------------------------------------------------
+#
+# A binary archive of one patient: a directory with one .npy file per column of the
+# EventStore, and a small json header with the TrueUserProfile and the UserSettings
+# (from their toJson) and the table lengths:
+#
+#     patient.bgarchive/
+#         header.json
+#         InsulinBolus.iov_0_utc.npy
+#         InsulinBolus.magnitude.npy
+#         ...
+#
+#     SaveArchive('patient.bgarchive',events,the_userprofile,user_settings)
+#     store,profile,user_settings = LoadArchive('patient.bgarchive')
+#     events = store.GetEvents() + UnpackBasal(LoadArchiveBasal('patient.bgarchive'))
+#
+# The columns are loaded with np.load(mmap_mode='r'): nothing is read until it is used,
+# and the pages are shared between processes that load the same archive. The loaded
+# columns are read-only (appending to a table copies it first). The text columns (e.g.
+# the annotations) are saved as fixed-width strings, and loaded back into object arrays.
+#
+# The rows are saved sorted by start time; the store that is saved is not modified.
+#
+# The BasalInsulin and LiverBasalGlucose events are not in the EventStore. When the events
+# are given as a list, they are saved too (see PackBasal): the delivery arrays of each
+# BasalInsulin (after its TempBasals and Suspends) as .npy files, and the rest in the header.
+# An archive saved from an EventStore (or before version 2) has no record of them (None).
+#
+
+archiveVersion = 2
+
+#------------------------------------------------------------------
+def PackBasal(events) :
+    # The BasalInsulin and LiverBasalGlucose events, as plain arrays and numbers
+    basal = list({'iov_0_utc':e.iov_0_utc,
+                  'iov_1_utc':e.iov_1_utc,
+                  'BasalRates':list(float(x) for x in e.BasalRates),
+                  'deliveryTimes':e.deliveryTimes,
+                  'deliveryAmounts':e.deliveryAmounts} for e in events if e.IsBasalInsulin())
+    # (a LiverBasalGlucose is made from the profile, so only the number of them is kept)
+    liver = sum(1 for e in events if e.IsBasalGlucose())
+    return {'basal':basal,'liver':liver}
+
+#------------------------------------------------------------------
+def UnpackBasal(packed) :
+    # The events of PackBasal (none, if packed is None)
+    if packed is None :
+        return []
+
+    events = list(BasalInsulin.FromDeliveries(b['iov_0_utc'],b['iov_1_utc'],b['BasalRates'],b['deliveryTimes'],b['deliveryAmounts'])
+                  for b in packed['basal'])
+    events += list(LiverBasalGlucose() for i in range(packed['liver']))
+    return events
+
+#------------------------------------------------------------------
+def ColumnFileName(type_name,column) :
+    return '%s.%s.npy'%(type_name,column)
+
+#------------------------------------------------------------------
+def SaveArchive(path,events,profile=None,user_settings=None) :
+    # events is an EventStore, or a list of events (BasalInsulin and LiverBasalGlucose are skipped)
+    if isinstance(events,EventStore) :
+        store = events
+        packed = None
+    else :
+        events = list(events)
+        store = EventStore.FromEvents(e for e in events if e.__class__.__name__ in eventColumns.keys())
+        packed = PackBasal(events)
+
+    if not os.path.isdir(path) :
+        os.makedirs(path)
+
+    tables = OrderedDict()
+    for type_name in store.Types() :
+        table = store.Table(type_name)
+        order = np.argsort(table['iov_0_utc'],kind='stable')
+        for column in table.ColumnNames() :
+            values = table[column][order]
+            if values.dtype == object :
+                # (object arrays cannot be memory-mapped)
+                values = np.array(list(values),dtype=np.str_)
+            np.save(os.path.join(path,ColumnFileName(type_name,column)),values,allow_pickle=False)
+        tables[type_name] = {'n':len(table),'columns':table.ColumnNames()}
+
+    basal = None
+    if packed is not None :
+        basal = {'basal':[],'liver':packed['liver']}
+        for i,b in enumerate(packed['basal']) :
+            for column in ['deliveryTimes','deliveryAmounts'] :
+                np.save(os.path.join(path,ColumnFileName('BasalInsulin%d'%(i),column)),b[column],allow_pickle=False)
+            basal['basal'].append(dict((key,b[key]) for key in ['iov_0_utc','iov_1_utc','BasalRates']))
+
+    header = {'version':archiveVersion,
+              'tables':tables,
+              'basal':basal,
+              'profile':profile.toJson() if (profile is not None) else None,
+              'settings':OrderedDict((key,user_settings[key].toJson()) for key in user_settings.keys()) if user_settings else {}}
+
+    with open(os.path.join(path,'header.json'),'w') as f :
+        json.dump(header,f,indent=1)
+
+    return
+
+#------------------------------------------------------------------
+def LoadArchive(path,mmap_mode='r') :
+    # Returns the EventStore, the TrueUserProfile (or None) and an OrderedDict of UserSettings
+    with open(os.path.join(path,'header.json')) as f :
+        header = json.load(f,object_pairs_hook=OrderedDict)
+
+    if header['version'] > archiveVersion :
+        raise ValueError('LoadArchive: archive version %d is newer than this code (%d)'%(header['version'],archiveVersion))
+
+    store = EventStore()
+    for type_name,info in header['tables'].items() :
+        table = store.Table(type_name)
+        dtypes = dict(table.dtype)
+        for column in info['columns'] :
+            values = np.load(os.path.join(path,ColumnFileName(type_name,column)),mmap_mode=mmap_mode,allow_pickle=False)
+            if dtypes.get(column) == object :
+                # (fixed-width strings would truncate longer text appended later)
+                values = values.astype(object)
+            table.columns[column] = values
+        table.n = info['n']
+
+    profile = None
+    if header['profile'] is not None :
+        profile = TrueUserProfile.fromJson(header['profile'])
+
+    user_settings = OrderedDict((key,UserSetting.fromJson(value)) for key,value in header['settings'].items())
+
+    return store,profile,user_settings
+
+#------------------------------------------------------------------
+def LoadArchiveBasal(path,mmap_mode='r') :
+    # The PackBasal record of the archive (None, if it has none: see UnpackBasal)
+    with open(os.path.join(path,'header.json')) as f :
+        header = json.load(f,object_pairs_hook=OrderedDict)
+
+    packed = header.get('basal')
+    if packed is None :
+        return None
+
+    for i,b in enumerate(packed['basal']) :
+        for column in ['deliveryTimes','deliveryAmounts'] :
+            b[column] = np.load(os.path.join(path,ColumnFileName('BasalInsulin%d'%(i),column)),mmap_mode=mmap_mode,allow_pickle=False)
+    return packed
@@ -1,67 +1,327 @@
 import math
 import time
 import datetime
+import numpy as np
+from .BGCache import *
+
+# Beyond this many Ta, the action curve is 1 to double precision, i.e. an
+# event no longer changes BG (its effect has saturated).
+saturationTime_Ta = 5.
+
+# How the action curve is evaluated: 'exact', or from the 'linear' or 'cubic'
+# interpolation tables (see ActionCurveTable and SetActionCurveMode)
+actionCurveMode = 'exact'
 
 #------------------------------------------------------------------
-def InsulinActionCurve(time_hr,Ta) :
+def InsulinActionCurve(time_hr,Ta,mode=None) :
     if time_hr < 0 :
         return 0
 
+    if (mode or actionCurveMode) != 'exact' :
+        return actionCurveTable.CurveScalar(time_hr/float(Ta),mode or actionCurveMode)
+
     result = 1 - math.pow(0.05,math.pow(time_hr/float(Ta),2))
     return result
 
 #------------------------------------------------------------------
-def InsulinActionCurveDerivative(time_hr,Ta) :
+def InsulinActionCurveDerivative(time_hr,Ta,mode=None) :
     if time_hr < 0 :
         return 0
 
+    if (mode or actionCurveMode) != 'exact' :
+        return actionCurveTable.SlopeScalar(time_hr/float(Ta),mode or actionCurveMode)/float(Ta)
+
     result = math.log(20)*2*math.pow((1/float(Ta)),2)
     result *= time_hr
     result *= math.pow(0.05,math.pow(time_hr/float(Ta),2))
     return result
 
+#------------------------------------------------------------------
+def InsulinActionCurveArray(time_hr,Ta,mode=None) :
+    # Same as InsulinActionCurve, but for numpy arrays of times and Ta (broadcast
+    # against each other). Negative times are masked to zero.
+    time_hr = np.asarray(time_hr,dtype=np.float64)
+    Ta = np.asarray(Ta,dtype=np.float64)
+
+    if (mode or actionCurveMode) != 'exact' :
+        return actionCurveTable.Curve(time_hr/Ta,mode or actionCurveMode)
+
+    x = np.maximum(time_hr,0.)/Ta
+    result = -np.expm1(math.log(0.05)*x*x)
+    return np.where(time_hr < 0,0.,result)
+
+#------------------------------------------------------------------
+def InsulinActionCurveDerivativeArray(time_hr,Ta,mode=None) :
+    # Same as InsulinActionCurveDerivative, but for numpy arrays of times and Ta.
+    time_hr = np.asarray(time_hr,dtype=np.float64)
+    Ta = np.asarray(Ta,dtype=np.float64)
+
+    if (mode or actionCurveMode) != 'exact' :
+        return actionCurveTable.Slope(time_hr/Ta,mode or actionCurveMode)/Ta
+
+    t = np.maximum(time_hr,0.)
+    x = t/Ta
+    result = math.log(20)*2*t/(Ta*Ta) * np.exp(math.log(0.05)*x*x)
+    return np.where(time_hr < 0,0.,result)
+
+
+#------------------------------------------------------------------
+def InsulinActionCurveIntegral(time_hr,Ta) :
+    # The integral of InsulinActionCurve from 0 to time_hr (in hours), which is
+    # what a constant infusion of one unit per hour delivers. Closed form via erf.
+    if time_hr < 0 :
+        return 0
+
+    k = math.sqrt(math.log(20))/float(Ta)
+    return time_hr - math.sqrt(math.pi)/(2*k) * math.erf(k*time_hr)
+
+#------------------------------------------------------------------
+def ErfArray(x) :
+    # erf of a numpy array, without scipy: Abramowitz & Stegun 7.1.26 (absolute error
+    # below 1.5e-7, so below 1e-6 hours in InsulinActionCurveIntegralArray for Ta < 10h)
+    x = np.asarray(x,dtype=np.float64)
+    a = np.abs(x)
+    t = 1./(1. + 0.3275911*a)
+    poly = t*(0.254829592 + t*(-0.284496736 + t*(1.421413741 + t*(-1.453152027 + t*1.061405429))))
+    return np.copysign(1. - poly*np.exp(-a*a),x)
+
+# scipy's erf (to double precision, like math.erf) if it is installed
+try :
+    from scipy.special import erf as _erf
+except ImportError :
+    _erf = ErfArray
+
+#------------------------------------------------------------------
+def InsulinActionCurveIntegralArray(time_hr,Ta) :
+    # Same as InsulinActionCurveIntegral, but for numpy arrays of times and Ta.
+    time_hr = np.asarray(time_hr,dtype=np.float64)
+    Ta = np.asarray(Ta,dtype=np.float64)
+
+    t = np.maximum(time_hr,0.)
+    k = math.sqrt(math.log(20))/Ta
+    result = t - math.sqrt(math.pi)/(2*k) * _erf(k*t)
+    return np.where(time_hr < 0,0.,result)
+
+#------------------------------------------------------------------
+class ActionCurveTable :
+    #
+    # The action curve A and its derivative, tabulated once on a fine grid of x = time_hr/Ta,
+    # for interpolation instead of exp/pow. Since A(time_hr,Ta) = a(time_hr/Ta) (with
+    # a(x) = 1 - 0.05^(x^2)), one table in x serves every Ta (per-bin InsulinTa and FoodTa,
+    # the Food overrides, LiverFattyGlucose).
+    #
+    # With a step h in x (a step of h*Ta hours for a given Ta), and c = ln(20):
+    # - 'linear' : |error of A| <= h^2 * c/4           (= h_hr^2 * ln20 / (4 Ta^2) in hours)
+    #              |error of dA/dt| <= 2.54 * h^2 / Ta
+    # - 'cubic'  : (Hermite, from the tabulated values and exact slopes)
+    #              |error of A| <= h^4 * c^2/32
+    #              |error of dA/dt| <= 1.33 * h^4 / Ta
+    # (from h^2/8 max|a''| and h^4/384 max|a''''|, with max|a''| = 2c, max|a'''| = 20.2,
+    # max|a''''| = 12c^2 and max|a'''''| = 508). The default h = 2^-10 gives 7.1e-7 and
+    # 2.6e-13 for A.
+    #
+    # Note that the exact numpy curve is a single expm1, so the tables are not faster
+    # everywhere: compare with the action curve entries of Benchmarks.
+    #
+    modes = ['linear','cubic']
+
+    def __init__(self,step=2.**-10) :
+        self.step = step
+        self.n = int(math.ceil(saturationTime_Ta/step)) + 1
+        x = np.arange(self.n + 1)*step
+        c = math.log(20)
+        g = np.exp(-c*x*x)
+        self.curve = -np.expm1(-c*x*x)            # a
+        self.slope = 2*c*x*g                       # a'
+        self.slope2 = 2*c*g*(1 - 2*c*x*x)          # a''
+
+        # (lists, for the scalar functions)
+        self.curveList = self.curve.tolist()
+        self.slopeList = self.slope.tolist()
+        self.slope2List = self.slope2.tolist()
+        return
+
+    @staticmethod
+    def ErrorBound(step_hr,Ta,mode) :
+        # The bound on |error| of A for a table step of step_hr hours, with this Ta (see above)
+        h = step_hr/float(Ta)
+        if mode == 'linear' :
+            return h*h*math.log(20)/4.
+        return h**4*math.log(20)**2/32.
+
+    def Interpolate(self,x,values,slopes,mode) :
+        # values at x (an array), from the tables of values and their slopes. x is clipped
+        # to the table: x < 0 reads a(0) = a'(0) = 0, and x beyond saturationTime_Ta the
+        # last entry (which is saturated).
+        if mode not in self.modes :
+            raise ValueError('ActionCurveTable: unknown mode %s'%(mode))
+
+        u = np.clip(x*(1./self.step),0.,self.n - 1)
+        i = u.astype(np.int64)
+        u -= i
+        v0 = values[i]
+        v1 = values[i+1]
+        if mode == 'linear' :
+            return v0 + u*(v1 - v0)
+
+        one_u = 1 - u
+        return ((1 + 2*u)*one_u*one_u*v0 + u*one_u*one_u*self.step*slopes[i]
+                + u*u*(3 - 2*u)*v1 - u*u*one_u*self.step*slopes[i+1])
+
+    def InterpolateScalar(self,x,values,slopes,mode) :
+        # Same, for one x >= 0
+        u = min(x/self.step,self.n - 1)
+        i = int(u)
+        u -= i
+        if mode == 'linear' :
+            return values[i] + u*(values[i+1] - values[i])
+        if mode != 'cubic' :
+            raise ValueError('ActionCurveTable: unknown mode %s'%(mode))
+        one_u = 1 - u
+        return ((1 + 2*u)*one_u*one_u*values[i] + u*one_u*one_u*self.step*slopes[i]
+                + u*u*(3 - 2*u)*values[i+1] - u*u*one_u*self.step*slopes[i+1])
+
+    def Curve(self,x,mode) :
+        return self.Interpolate(x,self.curve,self.slope,mode)
+
+    def Slope(self,x,mode) :
+        # da/dx (divide by Ta for the derivative per hour)
+        return self.Interpolate(x,self.slope,self.slope2,mode)
+
+    def CurveScalar(self,x,mode) :
+        return self.InterpolateScalar(x,self.curveList,self.slopeList,mode)
+
+    def SlopeScalar(self,x,mode) :
+        return self.InterpolateScalar(x,self.slopeList,self.slope2List,mode)
+
+# The shared table
+actionCurveTable = ActionCurveTable()
+
+#------------------------------------------------------------------
+def SetActionCurveMode(mode) :
+    # Switch all action curve evaluations to 'exact', 'linear' or 'cubic' (returns the previous mode).
+    # A single evaluation can also be switched with the mode argument of InsulinActionCurve etc.
+    global actionCurveMode
+    if mode not in ['exact'] + ActionCurveTable.modes :
+        raise ValueError('SetActionCurveMode: unknown mode %s'%(mode))
+    previous = actionCurveMode
+    actionCurveMode = mode
+    return previous
+
+#------------------------------------------------------------------
+def GetActionCurveMode() :
+    # (the module variable, which "from BGBaseClasses import *" would only copy)
+    return actionCurveMode
+
+# Timestamp formats: Medtronic csv, Tidepool, and another
+timestampFormats = ["%m/%d/%y %H:%M:%S",
+                    '%Y-%m-%dT%H:%M:%S',
+                    '%Y-%m-%d %H:%M:%S']
+
+# Integer type tags of the event classes, for the type checks (IsBolus etc.). Each subclass
+# of BGEventBase gets the tag of its class name in __init_subclass__ (new names are appended).
+eventTypeNames = ['Annotation','BGMeasurement','InsulinBolus','SquareWaveBolus','DualWaveBolus','Food',
+                  'LiverBasalGlucose','BasalInsulin','TempBasal','Suspend','LiverFattyGlucose','ExerciseEffect']
+eventTypeTags = dict((name,tag) for tag,name in enumerate(eventTypeNames))
+
+(tagAnnotation,tagBGMeasurement,tagInsulinBolus,tagSquareWaveBolus,tagDualWaveBolus,tagFood,
+ tagLiverBasalGlucose,tagBasalInsulin,tagTempBasal,tagSuspend,tagLiverFattyGlucose,tagExerciseEffect) = range(len(eventTypeNames))
 
 #------------------------------------------------------------------
 class BGEventBase :
-    
+    #
+    # The events have __slots__ (no per-instance __dict__), since there can be hundreds of
+    # thousands of them (with the mini-boluses). Subclasses list their own attributes in
+    # __slots__. (A subclass without __slots__ simply gets a __dict__ again.)
+    #
+    __slots__ = ('iov_0_utc','iov_1_utc','affectsBG','cacheToken')
+
+    typeTag = -1
+
+    def __init_subclass__(cls,**kwargs) :
+        super().__init_subclass__(**kwargs)
+        if cls.__name__ not in eventTypeTags.keys() :
+            eventTypeTags[cls.__name__] = len(eventTypeNames)
+            eventTypeNames.append(cls.__name__)
+        cls.typeTag = eventTypeTags[cls.__name__]
+        return
+
     def __init__(self,iov_0_utc,iov_1_utc) :
         self.iov_0_utc = iov_0_utc
         self.iov_1_utc = iov_1_utc
         return
 
+    # The format that worked last time is tried first (see timestampFormats)
+    lastTimestampFormat = 0
+
     @staticmethod
     def GetUtcFromString(iov_str) :
         """call via BGEventBase.GetUtcFromString('02/24/2019 12:00:00')"""
         """or       BGEventBase.GetUtcFromString('2019-02-24T12:00:00')"""
 
-        try :
-            # Medtronic csv format
-            iov_utc = int(time.mktime(time.strptime(iov_str,"%m/%d/%y %H:%M:%S")))
-            return iov_utc
-
-        except ValueError :
-            pass
-
-        try :
-            # Tidepool format
-            iov_utc = int(time.mktime(time.strptime(iov_str, '%Y-%m-%dT%H:%M:%S')))
-            return iov_utc
-
-        except ValueError :
-            pass
+        nformats = len(timestampFormats)
+        for i in range(nformats) :
+            j = (BGEventBase.lastTimestampFormat + i) % nformats
+            try :
+                iov_utc = int(time.mktime(time.strptime(iov_str,timestampFormats[j])))
+            except ValueError :
+                continue
 
-        try :
-            # Another format
-            iov_utc = int(time.mktime(time.strptime(iov_str, '%Y-%m-%d %H:%M:%S')))
+            BGEventBase.lastTimestampFormat = j
             return iov_utc
 
-        except ValueError :
-            pass
-
         print('Error: could not convert to UTC: %s'%(iov_str))
         raise ValueError
         return None
 
+    def CacheToken(self) :
+        # A number that identifies this event in the shared resultCache (unlike id(), never reused)
+        token = getattr(self,'cacheToken',None)
+        if token is None :
+            token = NewVersion()
+            self.cacheToken = token
+        return token
+
+    def ContentKey(self) :
+        # What the cached results of other events (e.g. an ExerciseEffect) need to know about
+        # this one: it changes when the event does. Subclasses add their magnitude.
+        return (self.CacheToken(),self.iov_0_utc,self.iov_1_utc)
+
+    def CachedResult(self,settings,names,key,function,bins=None) :
+        # function(), cached in the shared resultCache for this event, the profile, the key
+        # (e.g. the method and the time window) and the actionCurveMode. The result stays
+        # valid while the profile arrays in names do not change or, if bins() gives the
+        # profile bins that function reads, while those bins do not change: changing one
+        # bin only recomputes the results that read it.
+        # Not cached if settings is not versioned (e.g. a LiverFattyGlucose as settings).
+        arrayVersions = getattr(settings,'arrayVersions',None)
+        if arrayVersions is None :
+            return function()
+
+        full_key = (self.CacheToken(),id(settings),settings.nBins,key,actionCurveMode)
+        versions = tuple(arrayVersions[name] for name in names)
+
+        # An entry is [value, array versions, bins read, versions of those bins]
+        entry = resultCache.Get(full_key)
+        if entry is not missing :
+            if entry[1] == versions :
+                return entry[0]
+            if (entry[2] is not None) and (entry[3] == BGEventBase.BinVersions(settings,names,entry[2])) :
+                entry[1] = versions
+                return entry[0]
+            resultCache.Invalid()
+
+        value = function()
+        read = None if (bins is None) else tuple(bins())
+        read_versions = None if (read is None) else BGEventBase.BinVersions(settings,names,read)
+        resultCache.Set(full_key,[value,versions,read,read_versions])
+        return value
+
+    @staticmethod
+    def BinVersions(settings,names,bins) :
+        # The versions of some bins of the profile arrays in names
+        return tuple(tuple(settings.binVersions[name][i] for i in bins) for name in names)
+
     def Duration_hr(self) :
         return (self.iov_1_utc - self.iov_0_utc)/3600.
 
@@ -73,54 +333,76 @@ class BGEventBase :
 
         raise AttributeError
 
-    # Helper functions for figuring out the derived class:
+    # Helper functions for figuring out the derived class (the class name, via its type tag):
     def IsMeasurement(self) :
-        return self.__class__.__name__ == 'BGMeasurement'
+        return self.typeTag == tagBGMeasurement
 
     def IsBolus(self) :
-        return self.__class__.__name__ == 'InsulinBolus'
+        return self.typeTag == tagInsulinBolus
 
     def IsSquareWaveBolus(self) :
-        return self.__class__.__name__ == 'SquareWaveBolus'
+        return self.typeTag == tagSquareWaveBolus
 
     def IsDualWaveBolus(self) :
-        return self.__class__.__name__ == 'DualWaveBolus'
+        return self.typeTag == tagDualWaveBolus
 
     def IsFood(self) :
-        return self.__class__.__name__ == 'Food'
+        return self.typeTag == tagFood
 
     def IsBasalGlucose(self) :
-        return self.__class__.__name__ == 'LiverBasalGlucose'
+        return self.typeTag == tagLiverBasalGlucose
 
     def IsBasalInsulin(self) :
-        return self.__class__.__name__ == 'BasalInsulin'
+        return self.typeTag == tagBasalInsulin
 
     def IsTempBasal(self) :
-        return self.__class__.__name__ == 'TempBasal'
+        return self.typeTag == tagTempBasal
 
     def IsSuspend(self) :
-        return self.__class__.__name__ == 'Suspend'
+        return self.typeTag == tagSuspend
 
     def IsExercise(self) :
-        return self.__class__.__name__ == 'ExerciseEffect'
+        return self.typeTag == tagExerciseEffect
 
     def IsLiverFattyGlucose(self) :
-        return self.__class__.__name__ == 'LiverFattyGlucose'
+        return self.typeTag == tagLiverFattyGlucose
 
     def IsAnnotation(self) :
-        return self.__class__.__name__ == 'Annotation'
+        return self.typeTag == tagAnnotation
 
 #------------------------------------------------------------------
 class BGActionBase(BGEventBase) :
 
+    # Ta (hours) overrides the decay time of the profile; it is unset by default.
+    __slots__ = ('settingsBin','Ta')
+
     def __init__(self,iov_0_utc,iov_1_utc) :
         BGEventBase.__init__(self,iov_0_utc,iov_1_utc)
+
+        # The profile bin of iov_0_utc: (binWidth_hr, bin), made on first use
+        self.settingsBin = None
         return
 
+    def getSettingAtStart(self,settings,name) :
+        # settings.get<name>(self.iov_0_utc), e.g. name = 'InsulinSensitivity'. Finding the bin
+        # (the local time of day) is the slow part, so the bin is kept, for as long as the bin
+        # width of the profile stays the same. The value itself is always read from the profile.
+        binWidth_hr = getattr(settings,'binWidth_hr',None)
+        if binWidth_hr is None :
+            return getattr(settings,'get'+name)(self.iov_0_utc)
+
+        cached = self.settingsBin
+        if (cached is None) or (cached[0] != binWidth_hr) :
+            cached = (binWidth_hr,settings.getBin(self.iov_0_utc))
+            self.settingsBin = cached
+
+        return getattr(settings,name)[cached[1]]
+
     def getTa(self,settings,whichTa) :
         if hasattr(self,'Ta') :
             return self.Ta
-        return getattr(settings,whichTa)(self.iov_0_utc)
+        # (whichTa is the name of the getter, e.g. 'getInsulinTa')
+        return self.getSettingAtStart(settings,whichTa[3:])
 
     def getIntegralBase(self,time_start,time_end,settings,whichTa) :
         # whichTa is a string (either 'getInsulinTa' or 'getFoodTa')
@@ -139,6 +421,14 @@ class BGActionBase(BGEventBase) :
 
         return (InsulinActionCurve(time_hr_end,Ta) - InsulinActionCurve(time_hr_start,Ta)) * magnitude
 
+    def getDeliveriesBase(self,settings,whichTa) :
+        # The event as arrays of (delivery times, BG effect, Ta), for vectorized calculations.
+        # The integral from time_start to time_end of each delivery at time t is
+        #   magnitude * (curve(time_end - t) - curve(time_start - t)), and zero if time_end < t.
+        Ta = self.getTa(settings,whichTa)
+        magnitude = self.getMagnitudeOfBGEffect(settings)
+        return np.array([self.iov_0_utc],dtype=np.float64),np.array([magnitude],dtype=np.float64),np.array([Ta],dtype=np.float64)
+
 
     # The BG equivalent of "Active Insulin"
     def BGEffectRemaining(self,time_ut,settings) :
@@ -0,0 +1,233 @@
+import os
+import io
+import traceback
+import contextlib
+import concurrent.futures
+from .BGEventStore import *
+from .BGTimeline import *
+from .BGFitter import *
+from .BGArchive import *
+
+#------------------------------------------------------------------
+#
+# Batch evaluation of many patient histories, over a pool of processes.
+#
+# Each patient is a "bundle": the events, the TrueUserProfile and the UserSettings
+# (Basal, Sensitivity, ...). Bundles are sent to the workers in a compact form
+# (the numpy columns of an EventStore, plus the profile and settings as json, or
+# just the path of a BGArchive) rather than as pickled event objects, and rebuilt there. The BasalInsulin
+# and LiverBasalGlucose go as their delivery arrays (see BGArchive.PackBasal), so that the worker
+# evaluates the same events as a serial BGTimeline. Only for an archive without them (saved from an
+# EventStore, or an old one) is the BasalInsulin rebuilt from the 'Basal' setting, in the worker.
+#
+#     evaluator = BatchEvaluator('predict',max_workers=8,step_s=300)
+#     for name,result in evaluator.Run(bundles) :
+#         ...
+#
+# Results come back as they finish (not in the input order). If a bundle fails,
+# its result is a BatchError instead, and the rest of the batch carries on.
+#
+
+#------------------------------------------------------------------
+class BatchError :
+    # The (picklable) record of an exception raised while evaluating one bundle
+    def __init__(self,name,error,trace) :
+        self.name = name
+        self.error = error
+        self.trace = trace
+        return
+
+    def __repr__(self) :
+        return 'BatchError(%s: %s)'%(self.name,self.error)
+
+#------------------------------------------------------------------
+def PackBundle(events,profile,user_settings,name=None,**options) :
+    # Compact (picklable) form of one patient: a dict of plain arrays and json strings.
+    # (the BasalInsulin and LiverBasalGlucose are in 'basal', see BGArchive.PackBasal)
+    events = list(events)
+    store = EventStore.FromEvents(e for e in events if e.__class__.__name__ in eventColumns.keys())
+
+    columns = OrderedDict()
+    for type_name in store.Types() :
+        table = store.Table(type_name)
+        columns[type_name] = OrderedDict((column,np.array(table[column])) for column in table.ColumnNames())
+
+    return {'name':name,
+            'columns':columns,
+            'basal':PackBasal(events),
+            'profile':profile.toJson(),
+            'settings':dict((key,user_settings[key].toJson()) for key in user_settings.keys()),
+            'options':options}
+
+#------------------------------------------------------------------
+def ArchiveBundle(path,name=None,**options) :
+    # A bundle that points to a BGArchive: the workers memory-map it themselves
+    return {'name':name if (name is not None) else path,
+            'archive':path,
+            'options':options}
+
+#------------------------------------------------------------------
+def UnpackBundle(bundle) :
+    # Returns the events (including the BasalInsulin and LiverBasalGlucose), the profile and the settings
+    if 'archive' in bundle.keys() :
+        store,profile,user_settings = LoadArchive(bundle['archive'])
+        packed = LoadArchiveBasal(bundle['archive'])
+    else :
+        packed = bundle['basal']
+        store = EventStore()
+        for type_name,columns in bundle['columns'].items() :
+            store.Table(type_name).Extend(**columns)
+        profile = TrueUserProfile.fromJson(bundle['profile'])
+        user_settings = OrderedDict((key,UserSetting.fromJson(value)) for key,value in bundle['settings'].items())
+
+    events = store.GetEvents()
+
+    if packed is not None :
+        events += UnpackBasal(packed)
+
+    elif events and ('Basal' in user_settings.keys()) :
+        options = bundle.get('options',{})
+        time_start = options.get('time_start',min(e.iov_0_utc for e in events))
+        time_end = options.get('time_end',max(e.iov_1_utc for e in events))
+
+        # (only the settings valid at time_start are used)
+        for key in ['Basal','Sensitivity'] :
+            if (key in user_settings.keys()) and (user_settings[key].getValidSnapshotIndexAtUtc(time_start) !=
+                                                  user_settings[key].getValidSnapshotIndexAtUtc(time_end)) :
+                raise ValueError('UnpackBundle: the %s setting changes during %s, so its BasalInsulin cannot be '
+                                 'rebuilt; save the archive from the list of events'%(key,bundle['name']))
+
+        # The rebuilt BasalInsulin makes its own LiverFattyGlucose events (e.g. an archive has the old ones)
+        events = list(e for e in events if not e.IsLiverFattyGlucose())
+
+        sensitivities = None
+        if 'Sensitivity' in user_settings.keys() :
+            sensitivities = user_settings['Sensitivity'].getValidSnapshotAtUtc(time_start)
+
+        # (BasalInsulin prints the LiverFattyGlucose events it makes)
+        with contextlib.redirect_stdout(io.StringIO()) :
+            basal = BasalInsulin(time_start,time_end,user_settings['Basal'].getValidSnapshotAtUtc(time_start),
+                                 sensitivities,containers=events)
+        events.append(basal)
+        events.append(LiverBasalGlucose())
+
+    index = IntervalIndex(events)
+    for e in events :
+        if e.IsExercise() :
+            e.LoadContainers(index)
+
+    return events,profile,user_settings
+
+#------------------------------------------------------------------
+def PredictTask(events,profile,user_settings,step_s=300.,time_start=None,time_end=None,contributions=False,**kwargs) :
+    # The predicted BG on a regular grid (by default, over the span of the recorded events)
+    recorded = list(e for e in events if e.__class__.__name__ in eventColumns.keys())
+    if time_start is None :
+        time_start = min(e.iov_0_utc for e in recorded)
+    if time_end is None :
+        time_end = max(e.iov_1_utc for e in recorded)
+
+    timeline = BGTimeline(events,profile,np.arange(time_start,time_end,step_s))
+
+    result = {'times':timeline.times,'bg':timeline.bg}
+    if contributions :
+        result['contributions'] = dict(timeline.contributions)
+    return result
+
+#------------------------------------------------------------------
+def FitTask(events,profile,user_settings,refineTa=False,time_start=None,time_end=None,**kwargs) :
+    # A ProfileFitter fit (kwargs go to the ProfileFitter)
+    fitter = ProfileFitter(events,profile,**kwargs)
+    fitted = fitter.Fit(refineTa=refineTa)
+    return {'profile':fitted.toJson(),
+            'theta':fitter.theta,
+            'residuals':fitter.residuals,
+            'chi2':float(np.dot(fitter.residuals,fitter.residuals))}
+
+batchTasks = {'predict':PredictTask,
+              'fit'    :FitTask}
+
+#------------------------------------------------------------------
+def RunBundles(task,bundles,options) :
+    # Evaluate a chunk of bundles (in a worker process). Returns a list of (name,result).
+    # task is the name of a batchTasks entry, or a (module-level, picklable) function.
+    function = batchTasks[task] if (type(task) == type('')) else task
+
+    results = []
+    for bundle in bundles :
+        try :
+            kwargs = dict(options)
+            kwargs.update(bundle.get('options',{}))
+            events,profile,user_settings = UnpackBundle(bundle)
+            results.append((bundle['name'],function(events,profile,user_settings,**kwargs)))
+        except Exception as e :
+            results.append((bundle['name'],BatchError(bundle['name'],repr(e),traceback.format_exc())))
+
+    return results
+
+#------------------------------------------------------------------
+class BatchEvaluator :
+    #
+    # Runs a task on many bundles (from PackBundle), over a ProcessPoolExecutor.
+    #   task       : 'predict', 'fit', or a module-level function f(events,profile,user_settings,**options)
+    #   max_workers: number of processes (default: the number of cores)
+    #   chunksize  : bundles per job (larger chunks mean less overhead for small histories)
+    #   serial     : evaluate in this process instead (for debugging)
+    # Other keyword arguments are passed to the task.
+    #
+    def __init__(self,task='predict',max_workers=None,chunksize=1,serial=False,max_pending=None,**options) :
+        self.task = task
+        self.max_workers = max_workers
+        self.chunksize = max(int(chunksize),1)
+        self.serial = serial
+        self.max_pending = max_pending
+        self.options = options
+        return
+
+    def Chunks(self,bundles) :
+        chunk = []
+        for i,bundle in enumerate(bundles) :
+            if type(bundle) == type(()) :
+                # (events,profile,user_settings) or (events,profile,user_settings,name)
+                bundle = PackBundle(bundle[0],bundle[1],bundle[2],*bundle[3:4])
+            if bundle.get('name') is None :
+                bundle = dict(bundle,name=i)
+            chunk.append(bundle)
+            if len(chunk) == self.chunksize :
+                yield chunk
+                chunk = []
+        if chunk :
+            yield chunk
+        return
+
+    def Run(self,bundles) :
+        # Generator of (name,result), in the order in which they finish.
+        # bundles can be any iterable (e.g. a generator reading the exports one by one).
+        if self.serial :
+            for chunk in self.Chunks(bundles) :
+                for result in RunBundles(self.task,chunk,self.options) :
+                    yield result
+            return
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers) as executor :
+            # Limit the number of chunks in flight, so that the bundles are not all packed at once
+            max_pending = self.max_pending or 2*(self.max_workers or os.cpu_count() or 1)
+            pending = set()
+            for chunk in self.Chunks(bundles) :
+                pending.add(executor.submit(RunBundles,self.task,chunk,self.options))
+                if len(pending) < max_pending :
+                    continue
+                done,pending = concurrent.futures.wait(pending,return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done :
+                    for result in future.result() :
+                        yield result
+
+            for future in concurrent.futures.as_completed(pending) :
+                for result in future.result() :
+                    yield result
+
+        return
+
+    def RunAll(self,bundles) :
+        # All of the results, as a dict by name
+        return OrderedDict(self.Run(bundles))
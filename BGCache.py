@@ -0,0 +1,64 @@
+import itertools
+from collections import OrderedDict
+
+#------------------------------------------------------------------
+#
+# Caching of results that depend on the TrueUserProfile.
+#
+# Every change to a profile parameter gets a new version number from NewVersion(),
+# unique across all profiles, so a version number alone says which profile content a
+# result was computed from. The events key their cached results on the versions of the
+# profile arrays (or bins) they depend on, plus their own CacheToken.
+#
+
+NewVersion = itertools.count(1).__next__
+
+# Marks a missing entry (None can be a valid result)
+missing = object()
+
+#------------------------------------------------------------------
+class LRUCache :
+    #
+    # A dict with a maximum size: the least recently used entries are dropped first.
+    #
+    def __init__(self,maxsize=1<<16) :
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def __len__(self) :
+        return len(self.entries)
+
+    def Get(self,key,default=missing) :
+        value = self.entries.get(key,missing)
+        if value is missing :
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def Invalid(self) :
+        # The entry returned by the last Get was out of date: count it as a miss
+        self.hits -= 1
+        self.misses += 1
+        return
+
+    def Set(self,key,value) :
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize :
+            self.entries.popitem(last=False)
+        return
+
+    def Clear(self) :
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        return
+
+# The shared cache of per-window results (BasalInsulin, SquareWaveBolus, ...)
+resultCache = LRUCache()
@@ -0,0 +1,330 @@
+from .BGActionClasses import *
+from collections import OrderedDict
+
+#------------------------------------------------------------------
+#
+# Columnar ("struct-of-arrays") storage for a patient history.
+#
+# Instead of one python object per event, each event type gets its own table
+# of numpy columns. The event objects can still be produced on demand.
+#
+
+# Bits of the 'flags' column
+FLAG_FIRSTBG      = 1 # BGMeasurement.firstBG
+FLAG_FATTYMEAL    = 2 # Food.fattyMeal
+FLAG_BWZMATCHED   = 4 # InsulinBolus.BWZMatchedDelivered
+FLAG_ANALYTIC     = 8 # SquareWaveBolus.analytic
+
+# Columns shared by all of the tables. A Ta of nan means "use the profile".
+commonColumns = [('iov_0_utc',np.float64),
+                 ('iov_1_utc',np.float64),
+                 ('magnitude',np.float64),
+                 ('Ta'       ,np.float64),
+                 ('flags'    ,np.uint8  )]
+
+# Columns specific to each event type. "magnitude" is the insulin, food,
+# BG reading, basal factor etc. depending on the type.
+eventColumns = OrderedDict([
+    ('BGMeasurement'    ,[]),
+    ('InsulinBolus'     ,[('UserInputCarbSensitivity',np.float64),
+                          ('BWZEstimate'             ,np.float64),
+                          ('BWZInsulinSensitivity'   ,np.float64),
+                          ('BWZCorrectionEstimate'   ,np.float64),
+                          ('BWZFoodEstimate'         ,np.float64),
+                          ('BWZActiveInsulin'        ,np.float64),
+                          ('BWZBGInput'              ,np.float64),
+                          ('BWZCarbRatio'            ,np.float64)]),
+    ('SquareWaveBolus'  ,[('duration_hr',np.float64)]),
+    ('DualWaveBolus'    ,[('duration_hr',np.float64),('insulin_inst',np.float64)]),
+    ('Food'             ,[('original_value',np.float64)]),
+    ('TempBasal'        ,[]),
+    ('Suspend'          ,[]),
+    ('LiverFattyGlucose',[('Ta_tempBasal',np.float64),('fractionOfBasal',np.float64),('original_value',np.float64)]),
+    ('ExerciseEffect'   ,[]),
+    ('Annotation'       ,[('annotation',object)]),
+    ])
+
+# Non-zero defaults, for columns not given to EventTable.Append
+columnDefaults = {'Ta':float('nan'),
+                  'UserInputCarbSensitivity':2}
+
+typeDefaultFlags = {'InsulinBolus':FLAG_BWZMATCHED}
+
+#------------------------------------------------------------------
+class EventTable :
+    #
+    # One table (a set of equal-length numpy columns) for one event type.
+    #
+    def __init__(self,type_name,capacity=16) :
+        if type_name not in eventColumns.keys() :
+            raise TypeError('EventTable: no columns defined for %s events'%(type_name))
+
+        self.type_name = type_name
+        self.dtype = commonColumns + eventColumns[type_name]
+        self.n = 0
+        self.columns = OrderedDict()
+        for name,dtype in self.dtype :
+            self.columns[name] = np.zeros(capacity,dtype=dtype)
+        return
+
+    def __len__(self) :
+        return self.n
+
+    def __getitem__(self,name) :
+        # A view of the filled part of one column
+        return self.columns[name][:self.n]
+
+    def ColumnNames(self) :
+        return list(self.columns.keys())
+
+    def Reserve(self,n) :
+        # Make sure there is space for n rows (grows geometrically)
+        capacity = len(self.columns['iov_0_utc'])
+        if n <= capacity :
+            return
+
+        capacity = max(n,2*capacity)
+        for name in self.columns.keys() :
+            column = np.zeros(capacity,dtype=self.columns[name].dtype)
+            column[:self.n] = self.columns[name][:self.n]
+            self.columns[name] = column
+        return
+
+    def Default(self,name) :
+        if name == 'flags' :
+            return typeDefaultFlags.get(self.type_name,0)
+        return columnDefaults.get(name,0)
+
+    def Append(self,**row) :
+        self.Reserve(self.n + 1)
+        for name in self.columns.keys() :
+            self.columns[name][self.n] = row.get(name,self.Default(name))
+        self.n += 1
+        return
+
+    def Extend(self,**columns) :
+        # Append many rows at once, given as equal-length arrays (one per column)
+        nrows = len(columns['iov_0_utc'])
+        self.Reserve(self.n + nrows)
+        for name in self.columns.keys() :
+            self.columns[name][self.n:self.n+nrows] = columns.get(name,self.Default(name))
+        self.n += nrows
+        return
+
+    def Sort(self) :
+        # Stable sort of all columns by start time
+        order = np.argsort(self['iov_0_utc'],kind='stable')
+        for name in self.columns.keys() :
+            self.columns[name][:self.n] = self.columns[name][:self.n][order]
+        return
+
+    def IndicesInWindow(self,time_start,time_end) :
+        # Rows whose interval of validity overlaps [time_start,time_end]
+        return np.nonzero((self['iov_0_utc'] <= time_end) & (self['iov_1_utc'] >= time_start))[0]
+
+#------------------------------------------------------------------
+class EventStore :
+    #
+    # A patient history: one EventTable per event type.
+    #
+    # BasalInsulin and LiverBasalGlucose are not stored, since they are built
+    # from the settings rather than recorded by the pump.
+    #
+    def __init__(self) :
+        self.tables = OrderedDict()
+        return
+
+    @classmethod
+    def FromEvents(cls,events) :
+        """call via my_store = EventStore.FromEvents(list_of_events)"""
+        the_store = cls()
+        the_store.AddEvents(events)
+        return the_store
+
+    def __len__(self) :
+        return sum(len(t) for t in self.tables.values())
+
+    def Types(self) :
+        return list(k for k in self.tables.keys() if len(self.tables[k]))
+
+    def Table(self,type_name) :
+        if type_name not in self.tables.keys() :
+            self.tables[type_name] = EventTable(type_name)
+        return self.tables[type_name]
+
+    def Append(self,type_name,**row) :
+        self.Table(type_name).Append(**row)
+        return
+
+    def Add(self,event) :
+        type_name = event.__class__.__name__
+        self.Table(type_name).Append(**EventStore.EventToRow(event))
+        return
+
+    def AddEvents(self,events) :
+        for event in events :
+            self.Add(event)
+        return
+
+    def Sort(self) :
+        for table in self.tables.values() :
+            table.Sort()
+        return
+
+    def GetEvent(self,type_name,i) :
+        table = self.tables[type_name]
+        row = dict((name,table.columns[name][i]) for name in table.columns.keys())
+        return EventStore.RowToEvent(type_name,row)
+
+    def GetEvents(self,type_names=None) :
+        # Make the event objects (of the requested types), sorted by start time.
+        if type_names is None :
+            type_names = self.Types()
+        elif type(type_names) == type('') :
+            type_names = [type_names]
+
+        events = []
+        for type_name in type_names :
+            if type_name not in self.tables.keys() :
+                continue
+            for i in range(len(self.tables[type_name])) :
+                events.append(self.GetEvent(type_name,i))
+
+        events.sort(key=lambda x: x.iov_0_utc)
+        return events
+
+    def GetEventsInWindow(self,time_start,time_end,type_names=None) :
+        if type_names is None :
+            type_names = self.Types()
+        elif type(type_names) == type('') :
+            type_names = [type_names]
+
+        events = []
+        for type_name in type_names :
+            if type_name not in self.tables.keys() :
+                continue
+            for i in self.tables[type_name].IndicesInWindow(time_start,time_end) :
+                events.append(self.GetEvent(type_name,i))
+
+        events.sort(key=lambda x: x.iov_0_utc)
+        return events
+
+    @staticmethod
+    def EventToRow(event) :
+        # Turn an event object into a dict of column values
+        type_name = event.__class__.__name__
+        if type_name not in eventColumns.keys() :
+            raise TypeError('EventStore: cannot store %s events'%(type_name))
+
+        row = {'iov_0_utc':event.iov_0_utc,'iov_1_utc':event.iov_1_utc,'flags':0}
+
+        if type_name == 'BGMeasurement' :
+            row['magnitude'] = event.const_BG
+            row['flags'] |= FLAG_FIRSTBG if event.firstBG else 0
+
+        elif type_name == 'InsulinBolus' :
+            row['magnitude'] = event.insulin
+            row['flags'] |= FLAG_BWZMATCHED if event.BWZMatchedDelivered else 0
+            for name,dtype in eventColumns[type_name] :
+                row[name] = getattr(event,name)
+
+        elif type_name == 'SquareWaveBolus' :
+            row['magnitude'] = event.insulin
+            row['duration_hr'] = event.duration_hr
+            row['flags'] |= FLAG_ANALYTIC if event.analytic else 0
+
+        elif type_name == 'DualWaveBolus' :
+            row['magnitude'] = event.insulin_square
+            row['insulin_inst'] = event.insulin_inst
+            row['duration_hr'] = event.duration_hr
+
+        elif type_name == 'Food' :
+            row['magnitude'] = event.food
+            row['original_value'] = getattr(event,'original_value',event.food)
+            row['flags'] |= FLAG_FATTYMEAL if event.fattyMeal else 0
+
+        elif type_name in ['TempBasal','Suspend'] :
+            row['magnitude'] = event.basalFactor
+
+        elif type_name == 'LiverFattyGlucose' :
+            row['magnitude'] = event.BGEffect
+            row['Ta_tempBasal'] = event.Ta_tempBasal
+            row['fractionOfBasal'] = event.fractionOfBasal
+            row['original_value'] = event.original_value
+
+        elif type_name == 'ExerciseEffect' :
+            row['magnitude'] = event.factor
+
+        elif type_name == 'Annotation' :
+            row['annotation'] = event.annotation
+
+        if hasattr(event,'Ta') :
+            row['Ta'] = event.Ta
+
+        return row
+
+    @staticmethod
+    def TimeFromColumn(value) :
+        # Times are stored as floats; give back an int when it is a whole second
+        value = float(value)
+        if value.is_integer() :
+            return int(value)
+        return value
+
+    @staticmethod
+    def RowToEvent(type_name,row) :
+        # Make a new event object from a dict of column values
+        iov_0_utc = EventStore.TimeFromColumn(row['iov_0_utc'])
+        iov_1_utc = EventStore.TimeFromColumn(row['iov_1_utc'])
+        magnitude = row['magnitude'].item()
+        flags = int(row['flags'])
+
+        if type_name == 'BGMeasurement' :
+            event = BGMeasurement(iov_0_utc,iov_1_utc,magnitude)
+            event.firstBG = bool(flags & FLAG_FIRSTBG)
+
+        elif type_name == 'InsulinBolus' :
+            event = InsulinBolus(iov_0_utc,magnitude)
+            event.BWZMatchedDelivered = bool(flags & FLAG_BWZMATCHED)
+            for name,dtype in eventColumns[type_name] :
+                setattr(event,name,row[name].item())
+            if not math.isnan(row['Ta']) :
+                event.Ta = row['Ta'].item()
+
+        elif type_name == 'SquareWaveBolus' :
+            event = SquareWaveBolus(iov_0_utc,row['duration_hr'].item(),magnitude,analytic=bool(flags & FLAG_ANALYTIC))
+
+        elif type_name == 'DualWaveBolus' :
+            event = DualWaveBolus(iov_0_utc,row['duration_hr'].item(),magnitude,row['insulin_inst'].item())
+
+        elif type_name == 'Food' :
+            event = Food(iov_0_utc,magnitude)
+            event.original_value = row['original_value'].item()
+            event.fattyMeal = bool(flags & FLAG_FATTYMEAL)
+            if not math.isnan(row['Ta']) :
+                event.Ta = row['Ta'].item()
+
+        elif type_name == 'TempBasal' :
+            event = TempBasal(iov_0_utc,iov_1_utc,magnitude)
+
+        elif type_name == 'Suspend' :
+            event = Suspend(iov_0_utc,iov_1_utc)
+
+        elif type_name == 'LiverFattyGlucose' :
+            # (the constructor adds 6 hours to the end time)
+            event = LiverFattyGlucose(iov_0_utc,iov_1_utc - 6.*3600.,magnitude,
+                                      row['Ta_tempBasal'].item(),row['fractionOfBasal'].item())
+            event.original_value = row['original_value'].item()
+            event.Ta = row['Ta'].item()
+
+        elif type_name == 'ExerciseEffect' :
+            # Note: the affected events need to be loaded separately (LoadContainers)
+            event = ExerciseEffect(iov_0_utc,iov_1_utc,magnitude)
+
+        elif type_name == 'Annotation' :
+            event = Annotation(iov_0_utc,iov_1_utc,row['annotation'])
+
+        else :
+            raise TypeError('EventStore: cannot make %s events'%(type_name))
+
+        return event
@@ -0,0 +1,388 @@
+from .BGTimeline import *
+from .BGSparse import *
+
+#------------------------------------------------------------------
+#
+# Fitting the TrueUserProfile to BG measurements.
+#
+# For fixed Ta, the BG change between two measurements is linear in the profile
+# bins: every insulin delivery contributes InsulinSensitivity[bin] * insulin * (curve
+# difference), every food FoodSensitivity[bin] * food * (curve difference), and the
+# liver glucose is a (smeared) sum of LiverHourlyGlucose bins. So the fit is a
+# regularized linear least-squares problem on a design matrix built once:
+#
+#     minimize |y - c - X theta|^2 + smoothness * |D theta|^2 + prior * |theta - theta_0|^2
+#
+# where y are the measured BG changes, c the contributions that do not depend on the
+# fitted bins (e.g. LiverFattyGlucose), and D the difference of adjacent bins (around
+# the clock). Optionally, InsulinTa and FoodTa are then refined with Gauss-Newton steps,
+# using the analytic derivative of the action curve with respect to Ta.
+#
+# With sparse=True, X (and its derivatives) are CSRMatrix (see BGSparse), with only the
+# nonzero entries: a window only sees the bins of the deliveries of the last
+# saturationTime_Ta * Ta hours. The least-squares problem is then solved with CGLS,
+# so that the memory stays of the order of the nonzeros, for fits of many months.
+#
+
+parameterBlocks = ['InsulinSensitivity','FoodSensitivity','LiverHourlyGlucose']
+
+#------------------------------------------------------------------
+def InsulinActionCurveDerivativeTaArray(time_hr,Ta) :
+    # d(InsulinActionCurve)/d(Ta) = -(time_hr/Ta) * InsulinActionCurveDerivative
+    time_hr = np.asarray(time_hr,dtype=np.float64)
+    return -(np.maximum(time_hr,0.)/Ta) * InsulinActionCurveDerivativeArray(time_hr,Ta)
+
+#------------------------------------------------------------------
+def InsulinActionCurveIntegralDerivativeTaArray(time_hr,Ta) :
+    # d(InsulinActionCurveIntegral)/d(Ta) = -(time_hr*curve - integral)/Ta
+    t = np.maximum(np.asarray(time_hr,dtype=np.float64),0.)
+    return -(t*InsulinActionCurveArray(t,Ta) - InsulinActionCurveIntegralArray(t,Ta))/Ta
+
+#------------------------------------------------------------------
+def DeliveryWindowPairs(starts,band_ends,window_starts,window_ends) :
+    # The (delivery, window) pairs for which a delivery starting at starts[i], whose effect
+    # is constant after band_ends[i], changes BG within the window. The windows must be
+    # sorted (window_starts and window_ends both increasing).
+    w0 = np.searchsorted(window_ends,starts,side='left')
+    w1 = np.searchsorted(window_starts,band_ends,side='right')
+    lengths = np.maximum(w1 - w0,0)
+
+    deliveries = np.repeat(np.arange(len(starts)),lengths)
+    first = np.cumsum(lengths) - lengths
+    windows = w0[deliveries] + np.arange(len(deliveries)) - first[deliveries]
+    return deliveries,windows
+
+#------------------------------------------------------------------
+def DeliveryChunks(*arrays,**kwargs) :
+    # The deliveries (parallel arrays) in chunks of size, to bound the memory of their
+    # (delivery, window) pairs
+    size = kwargs.get('size',4096)
+    for lo in range(0,len(arrays[0]),size) :
+        yield tuple(a[lo:lo+size] for a in arrays)
+    return
+
+#------------------------------------------------------------------
+class ProfileFitter :
+    #
+    # Fit the InsulinSensitivity, FoodSensitivity and LiverHourlyGlucose bins of a
+    # TrueUserProfile to the BG changes between consecutive BG measurements:
+    # each row of the design matrix (dense or sparse) is the window from the iov_0_utc
+    # of one measurement to the iov_0_utc of the next. (The iov_1_utc of a measurement
+    # is not used: a measurement is one reading, with no BG change of its own.)
+    #
+    #     fitter = ProfileFitter(events,the_userprofile)
+    #     fitted_profile = fitter.Fit(refineTa=True)
+    #
+    # The events should include the BasalInsulin and LiverBasalGlucose, if they are used.
+    #
+    def __init__(self,events,settings,measurements=None,fit=parameterBlocks,smoothness=1.,prior=1e-3,max_gap_hr=None,sparse=False) :
+        self.events = list(e for e in events if getattr(e,'affectsBG',False))
+        self.settings = settings
+        self.fit = list(fit)
+        self.smoothness = smoothness
+        self.prior = prior
+        self.nBins = settings.nBins
+        self.sparse = sparse
+
+        if measurements is None :
+            measurements = list(e for e in events if e.IsMeasurement())
+        measurements = sorted(measurements,key=lambda x: x.iov_0_utc)
+
+        # The observations: the BG change between consecutive measurements
+        times = np.array(list(m.iov_0_utc for m in measurements),dtype=np.float64)
+        values = np.array(list(m.const_BG for m in measurements),dtype=np.float64)
+        keep = np.diff(times) > 0
+        if max_gap_hr is not None :
+            keep &= np.diff(times) <= max_gap_hr*3600.
+
+        self.window_starts = times[:-1][keep]
+        self.window_ends = times[1:][keep]
+        self.y = np.diff(values)[keep]
+
+        # The starting point (and the prior)
+        self.theta0 = np.concatenate(list(np.array(getattr(settings,block),dtype=np.float64) for block in parameterBlocks))
+
+        self.theta = None
+        self.residuals = None
+        return
+
+    def BlockColumns(self,block) :
+        i = parameterBlocks.index(block)
+        return np.arange(i*self.nBins,(i+1)*self.nBins)
+
+    def MakeUnitProfile(self,InsulinTa=None,FoodTa=None) :
+        # A copy of the profile with unit sensitivities, so that the BG effect of
+        # each delivery is just its amount of insulin or food.
+        unit = TrueUserProfile.fromJson(self.settings.toJson())
+        unit.InsulinSensitivity = [1.]*unit.nBins
+        unit.FoodSensitivity = [1.]*unit.nBins
+        if InsulinTa is not None :
+            unit.setInsulinTa(InsulinTa)
+        if FoodTa is not None :
+            unit.setFoodTa(FoodTa)
+        return unit
+
+    def MakeDesign(self,InsulinTa=None,FoodTa=None,derivatives=False) :
+        # Returns the design matrix X, the constant part c and (if derivatives) the
+        # derivatives of both with respect to InsulinTa and FoodTa: {name:(dX,dc)}
+        # (X and dX are CSRMatrix if self.sparse)
+        unit = self.MakeUnitProfile(InsulinTa,FoodTa)
+
+        n = len(self.y)
+        ncol = len(parameterBlocks)*self.nBins
+        def Matrix() :
+            return CSRBuilder(n,ncol) if self.sparse else np.zeros(n*ncol)
+
+        self.X = Matrix()
+        self.c = np.zeros(n)
+        self.dX = dict((name,Matrix()) for name in ['InsulinTa','FoodTa'])
+        self.dc = dict((name,np.zeros(n)) for name in ['InsulinTa','FoodTa'])
+        self.derivatives = derivatives
+
+        rows = np.arange(n)
+        for e in self.events :
+            self.AddEvent(e,unit,self.window_starts,self.window_ends,rows,1.)
+
+        def Finish(matrix) :
+            return matrix.Build() if self.sparse else matrix.reshape(n,ncol)
+
+        X = Finish(self.X)
+        if not derivatives :
+            return X,self.c
+
+        dXdTa = dict((name,(Finish(self.dX[name]),self.dc[name])) for name in self.dX.keys())
+        return X,self.c,dXdTa
+
+    def AddEvent(self,e,unit,window_starts,window_ends,rows,scale) :
+
+        if e.IsExercise() :
+            # The affected insulin, within the exercise window, times the factor
+            overlapping = (window_ends >= e.iov_0_utc) & (window_starts <= e.iov_1_utc)
+            if not np.any(overlapping) :
+                return
+            clipped_starts = np.maximum(window_starts[overlapping],e.iov_0_utc)
+            clipped_ends = np.minimum(window_ends[overlapping],e.iov_1_utc)
+            for c in e.affectedEvents :
+                self.AddEvent(c,unit,clipped_starts,clipped_ends,rows[overlapping],scale*e.factor)
+            return
+
+        if e.IsBasalGlucose() :
+            # Hours in each fine bin, times the smearing matrix (fine bins from the coarse bins)
+            hours = e.getFineBinHours(window_starts,window_ends)
+            columns = np.dot(hours,e.getSmearMatrix(unit)) * scale
+            self.AddColumns(rows,self.BlockColumns('LiverHourlyGlucose'),columns)
+            return
+
+        if not hasattr(e,'getDeliveries') :
+            # Slow path: a constant contribution, from getIntegral
+            for row,t0,t1 in zip(rows,window_starts,window_ends) :
+                self.c[row] += scale*e.getIntegral(t0,t1,self.settings)
+            return
+
+        # Which block of parameters (if any) the event is proportional to, and which Ta it uses
+        if e.IsFood() :
+            block = 'FoodSensitivity'
+            whichTa = None if hasattr(e,'Ta') else 'FoodTa'
+        elif e.IsLiverFattyGlucose() :
+            block = None
+            whichTa = None
+        else :
+            block = 'InsulinSensitivity'
+            whichTa = 'InsulinTa'
+
+        times,amounts,Ta = e.getDeliveries(unit)
+        for times,amounts,Ta in DeliveryChunks(times,amounts,Ta) :
+            bins = unit.getBin(times)
+            d,w = DeliveryWindowPairs(times,times + saturationTime_Ta*Ta*3600.,window_starts,window_ends)
+            u_start = (window_starts[w] - times[d])/3600.
+            u_end   = (window_ends[w]   - times[d])/3600.
+            values = scale*amounts[d]*(InsulinActionCurveArray(u_end,Ta[d]) - InsulinActionCurveArray(u_start,Ta[d]))
+            dvalues = None
+            if self.derivatives and whichTa :
+                dvalues = scale*amounts[d]*(InsulinActionCurveDerivativeTaArray(u_end,Ta[d]) - InsulinActionCurveDerivativeTaArray(u_start,Ta[d]))
+            self.AddTerms(rows[w],bins[d],block,whichTa,values,dvalues)
+
+        if not hasattr(e,'getInfusions') :
+            return
+
+        starts,ends,rates,Ta = e.getInfusions(unit)
+        for starts,ends,rates,Ta in DeliveryChunks(starts,ends,rates,Ta) :
+            bins = unit.getBin(starts)
+            d,w = DeliveryWindowPairs(starts,ends + saturationTime_Ta*Ta*3600.,window_starts,window_ends)
+
+            def G(function,t) :
+                return function((t - starts[d])/3600.,Ta[d]) - function((t - ends[d])/3600.,Ta[d])
+
+            values = scale*rates[d]*(G(InsulinActionCurveIntegralArray,window_ends[w]) - G(InsulinActionCurveIntegralArray,window_starts[w]))
+            dvalues = None
+            if self.derivatives and whichTa :
+                dvalues = scale*rates[d]*(G(InsulinActionCurveIntegralDerivativeTaArray,window_ends[w]) -
+                                          G(InsulinActionCurveIntegralDerivativeTaArray,window_starts[w]))
+            self.AddTerms(rows[w],bins[d],block,whichTa,values,dvalues)
+
+        return
+
+    def AddTerms(self,rows,bins,block,whichTa,values,dvalues) :
+        ncol = len(parameterBlocks)*self.nBins
+        if block is None :
+            self.c += np.bincount(rows,weights=values,minlength=len(self.c))
+            return
+
+        flat = rows*ncol + self.BlockColumns(block)[0] + bins
+        self.Accumulate(self.X,flat,values)
+        if dvalues is not None :
+            self.Accumulate(self.dX[whichTa],flat,dvalues)
+        return
+
+    def AddColumns(self,rows,columns,values) :
+        ncol = len(parameterBlocks)*self.nBins
+        flat = (rows[:,None]*ncol + columns[None,:]).ravel()
+        self.Accumulate(self.X,flat,values.ravel())
+        return
+
+    def Accumulate(self,matrix,flat,values) :
+        # matrix (flattened, or a CSRBuilder) [flat] += values
+        if self.sparse :
+            matrix.Add(flat,values)
+        elif len(flat) :
+            # (only over the range of flat: the terms of a chunk are close in time)
+            lo = flat.min()
+            counts = np.bincount(flat - lo,weights=values)
+            matrix[lo:lo+len(counts)] += counts
+        return
+
+    def PenaltyRows(self) :
+        # sqrt(smoothness) * (difference of adjacent bins), and sqrt(prior) * identity, for the fitted blocks
+        D = np.eye(self.nBins) - np.roll(np.eye(self.nBins),1,axis=1)
+        return np.sqrt(self.smoothness)*D,np.sqrt(self.prior)*np.eye(self.nBins)
+
+    def Solve(self,X,c) :
+        # The regularized least-squares solution for the fitted blocks (the others stay fixed)
+        fitted = np.concatenate(list(self.BlockColumns(b) for b in self.fit)) if self.fit else np.zeros(0,dtype=int)
+
+        theta = self.theta0.copy()
+        if not len(fitted) :
+            return theta
+
+        theta_fixed = theta.copy()
+        theta_fixed[fitted] = 0.
+        target = self.y - c - X.dot(theta_fixed)
+
+        if self.sparse :
+            theta[fitted] = self.SolveSparse(X,fitted,target)
+            return theta
+
+        smooth,prior = self.PenaltyRows()
+        nfit = len(self.fit)
+        A = [X[:,fitted]]
+        b = [target]
+        for i in range(nfit) :
+            for penalty,penalty_target in [(smooth,np.zeros(self.nBins)),(prior,np.dot(prior,self.theta0[self.BlockColumns(self.fit[i])]))] :
+                rows = np.zeros((self.nBins,len(fitted)))
+                rows[:,i*self.nBins:(i+1)*self.nBins] = penalty
+                A.append(rows)
+                b.append(penalty_target)
+
+        solution = np.linalg.lstsq(np.vstack(A),np.concatenate(b),rcond=None)[0]
+        theta[fitted] = solution
+        return theta
+
+    def SolveSparse(self,X,fitted,target,tol=1e-10,maxiter=2000) :
+        # Solve's least-squares problem with CGLS: the rows are X[:,fitted], then for each
+        # fitted block the smoothness and the prior rows (applied without making them).
+        # The columns are scaled to unit norm first (Jacobi preconditioning).
+        nfit = len(self.fit)
+        sqrt_smooth,sqrt_prior = np.sqrt(self.smoothness),np.sqrt(self.prior)
+        prior_target = sqrt_prior*self.theta0[fitted]
+
+        norms = X.ColumnNorms()[fitted]
+        norms = np.sqrt(norms**2 + 2*self.smoothness + self.prior)
+        scale = 1./norms
+
+        def Multiply(v) :
+            v = v*scale
+            full = np.zeros(X.shape[1])
+            full[fitted] = v
+            blocks = v.reshape(nfit,self.nBins)
+            smooth = sqrt_smooth*(blocks - np.roll(blocks,-1,axis=1))
+            return np.concatenate([X.dot(full),smooth.ravel(),sqrt_prior*v])
+
+        def MultiplyTranspose(y) :
+            n = len(target)
+            smooth = y[n:n+len(fitted)].reshape(nfit,self.nBins)
+            ret = X.TransposeDot(y[:n])[fitted]
+            ret += sqrt_smooth*(smooth - np.roll(smooth,1,axis=1)).ravel()
+            ret += sqrt_prior*y[n+len(fitted):]
+            return ret*scale
+
+        b = np.concatenate([target,np.zeros(len(fitted)),prior_target])
+        solution = CGLS(Multiply,MultiplyTranspose,b,self.theta0[fitted]*norms,tol=tol,maxiter=maxiter)
+        return solution*scale
+
+    def Objective(self,X,c,theta) :
+        residuals = self.y - c - X.dot(theta)
+        smooth,prior = self.PenaltyRows()
+        ret = np.dot(residuals,residuals)
+        for block in self.fit :
+            columns = self.BlockColumns(block)
+            ret += np.sum(np.dot(smooth,theta[columns])**2)
+            ret += np.sum(np.dot(prior,theta[columns] - self.theta0[columns])**2)
+        return ret
+
+    def Fit(self,refineTa=False,iterations=10,max_step_hr=1.,min_Ta=0.5) :
+        # Returns a fitted copy of the profile. If refineTa, InsulinTa and FoodTa (one value
+        # each, for the whole day) are also fitted.
+        InsulinTa = float(np.mean(self.settings.InsulinTa))
+        FoodTa = float(np.mean(self.settings.FoodTa))
+
+        if not refineTa :
+            X,c = self.MakeDesign()
+            self.theta = self.Solve(X,c)
+            self.residuals = self.y - c - X.dot(self.theta)
+            return self.MakeProfile(self.theta,None,None)
+
+        Ta = np.array([InsulinTa,FoodTa])
+        X,c,dXdTa = self.MakeDesign(Ta[0],Ta[1],derivatives=True)
+        theta = self.Solve(X,c)
+        objective = self.Objective(X,c,theta)
+
+        for iteration in range(iterations) :
+            # Gauss-Newton: the residuals change by -J * dTa
+            residuals = self.y - c - X.dot(theta)
+            J = np.column_stack(list(dXdTa[name][0].dot(theta) + dXdTa[name][1] for name in ['InsulinTa','FoodTa']))
+            step = np.linalg.lstsq(J,residuals,rcond=None)[0]
+            step = np.clip(step,-max_step_hr,max_step_hr)
+
+            # Halve the step until the objective improves
+            improved = False
+            for halving in range(6) :
+                Ta_new = np.maximum(Ta + step,min_Ta)
+                X_new,c_new,dXdTa_new = self.MakeDesign(Ta_new[0],Ta_new[1],derivatives=True)
+                theta_new = self.Solve(X_new,c_new)
+                objective_new = self.Objective(X_new,c_new,theta_new)
+                if objective_new < objective :
+                    improved = True
+                    break
+                step = step/2.
+
+            if not improved :
+                break
+
+            converged = np.max(np.abs(Ta_new - Ta)) < 1e-3
+            Ta,X,c,dXdTa,theta,objective = Ta_new,X_new,c_new,dXdTa_new,theta_new,objective_new
+            if converged :
+                break
+
+        self.theta = theta
+        self.residuals = self.y - c - X.dot(theta)
+        return self.MakeProfile(theta,Ta[0],Ta[1])
+
+    def MakeProfile(self,theta,InsulinTa,FoodTa) :
+        profile = TrueUserProfile.fromJson(self.settings.toJson())
+        for block in parameterBlocks :
+            setattr(profile,block,list(theta[self.BlockColumns(block)]))
+        if InsulinTa is not None :
+            profile.setInsulinTa(InsulinTa)
+        if FoodTa is not None :
+            profile.setFoodTa(FoodTa)
+        return profile
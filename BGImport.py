@@ -0,0 +1,467 @@
+import csv
+import json
+import calendar
+from .BGEventStore import *
+from .Timestamps import *
+
+#------------------------------------------------------------------
+#
+# Streaming import of pump / CGM exports into EventStores.
+#
+# The readers go through the file one row (or one json record) at a time, append the
+# events straight into the columns of an EventStore, and yield the store every
+# chunk_size events, so that the memory use does not depend on the size of the file:
+#
+#     for chunk in MedtronicCsvReader('CareLink-Export.csv').Chunks() :
+#         ...
+#     store = LoadExport('tidepool.json')   # all chunks in one (sorted) EventStore
+#
+# Rows that cannot be used are skipped, and recorded in reader.errors as (line,message).
+#
+
+mgdlPerMmol = 18.01559
+
+#------------------------------------------------------------------
+def DurationToHours(duration_str) :
+    # 'h:mm:ss' (Medtronic) to hours
+    fields = list(float(x) for x in duration_str.split(':'))
+    while len(fields) < 3 :
+        fields.insert(0,0.)
+    return fields[0] + fields[1]/60. + fields[2]/3600.
+
+#------------------------------------------------------------------
+def UtcFromIsoZulu(time_str) :
+    # '2019-02-24T20:00:00.000Z' (an actual utc time, unlike deviceTime)
+    return calendar.timegm(time.strptime(time_str[:19],'%Y-%m-%dT%H:%M:%S'))
+
+#------------------------------------------------------------------
+class ExportReader :
+    #
+    # Base class of the readers: the pairing of related records (bolus wizard and
+    # bolus, suspend and resume, the two parts of a dual wave), and the chunking.
+    # The derived classes implement Records() and HandleRecord(line,record).
+    #
+    def __init__(self,source,chunk_size=10000,user_settings=None,pair_window_s=60.,bg_duration_s=0.) :
+        self.source = source          # a file name, or an open file
+        self.chunk_size = chunk_size
+        self.user_settings = user_settings # needed for temp basals given as a rate (U/h)
+        self.pair_window_s = pair_window_s # bolus wizard records are matched to boluses within this time
+        self.bg_duration_s = bg_duration_s # interval of validity of each BGMeasurement
+        self.errors = []
+        return
+
+    def Open(self) :
+        if hasattr(self.source,'read') :
+            return self.source
+        return open(self.source,newline='',encoding='utf-8-sig',errors='replace')
+
+    def Error(self,line,message) :
+        self.errors.append((line,message))
+        return
+
+    def Chunks(self) :
+        # Generator of EventStores, of (about) chunk_size events each
+        self.store = EventStore()
+        self.parser = TimestampParser() # (the timestamp format is detected once per file)
+        self.pending = []  # [time,kind,key,data] waiting for their partner
+        self.openSuspend = None
+
+        for line,record in self.Records() :
+            try :
+                self.HandleRecord(line,record)
+            except (ValueError,KeyError,TypeError) as e :
+                self.Error(line,'%s: %s'%(e.__class__.__name__,e))
+
+            if len(self.store) >= self.chunk_size :
+                yield self.store
+                self.store = EventStore()
+
+        self.Expire(None)
+        if len(self.store) :
+            yield self.store
+        return
+
+    #
+    # Appending events
+    #
+    def AppendBG(self,time_ut,value) :
+        self.store.Append('BGMeasurement',iov_0_utc=time_ut,iov_1_utc=time_ut + self.bg_duration_s,magnitude=value)
+        return
+
+    def AppendBolus(self,time_ut,insulin,wizard=None) :
+        row = {'iov_0_utc':time_ut,'iov_1_utc':time_ut + 6*3600.,'magnitude':insulin}
+        if wizard is not None :
+            row.update(wizard)
+            matched = abs(wizard.get('BWZEstimate',insulin) - insulin) < 0.05
+            row['flags'] = FLAG_BWZMATCHED if matched else 0
+        self.store.Append('InsulinBolus',**row)
+        return
+
+    def AppendSquare(self,time_ut,duration_hr,insulin) :
+        # (same interval of validity as the SquareWaveBolus constructor)
+        self.store.Append('SquareWaveBolus',iov_0_utc=time_ut,iov_1_utc=time_ut + duration_hr + 6*3600.,
+                          magnitude=insulin,duration_hr=duration_hr)
+        return
+
+    def AppendDual(self,time_ut,duration_hr,insulin_square,insulin_inst) :
+        self.store.Append('DualWaveBolus',iov_0_utc=time_ut,iov_1_utc=time_ut + duration_hr + 6*3600.,
+                          magnitude=insulin_square,insulin_inst=insulin_inst,duration_hr=duration_hr)
+        return
+
+    def AppendFood(self,time_ut,food) :
+        self.store.Append('Food',iov_0_utc=time_ut,iov_1_utc=time_ut + 6*3600.,magnitude=food,original_value=food)
+        return
+
+    def AppendTempBasal(self,line,time_ut,duration_hr,basalFactor=None,rate=None) :
+        if basalFactor is None :
+            # A rate (U/h): relative to the scheduled basal rate
+            if (self.user_settings is None) or ('Basal' not in self.user_settings.keys()) :
+                self.Error(line,'TempBasal given as a rate, but no Basal setting to compare it to')
+                return
+            scheduled = float(self.user_settings['Basal'].GetSettingAtUtc(time_ut))
+            if scheduled <= 0 :
+                self.Error(line,'TempBasal given as a rate, but the scheduled basal is zero')
+                return
+            basalFactor = rate/scheduled
+
+        self.store.Append('TempBasal',iov_0_utc=time_ut,iov_1_utc=time_ut + duration_hr*3600.,magnitude=basalFactor)
+        return
+
+    def AppendSuspend(self,time_start,time_end) :
+        self.store.Append('Suspend',iov_0_utc=time_start,iov_1_utc=time_end,magnitude=0)
+        return
+
+    def AppendAnnotation(self,time_ut,text) :
+        text = text.replace('\x00','').strip()
+        if text :
+            self.store.Append('Annotation',iov_0_utc=time_ut,iov_1_utc=time_ut,annotation=text)
+        return
+
+    #
+    # Pairing
+    #
+    def Pair(self,time_ut,kind,key,data,partner_kind) :
+        # Returns the data of the pending partner record (and removes it), or else adds this
+        # record to the pending ones and returns None. Records with a key are matched by key,
+        # the others by time.
+        self.Expire(time_ut)
+        for i,(t,k,other_key,other_data) in enumerate(self.pending) :
+            if k != partner_kind :
+                continue
+            if (key is not None) or (other_key is not None) :
+                if key != other_key :
+                    continue
+            elif abs(t - time_ut) > self.pair_window_s :
+                continue
+            del self.pending[i]
+            return other_data
+
+        self.pending.append([time_ut,kind,key,data])
+        return None
+
+    def Expire(self,time_ut) :
+        # Records that can no longer be paired (or all of them, if time_ut is None)
+        keep = []
+        for t,kind,key,data in self.pending :
+            if (time_ut is not None) and abs(t - time_ut) <= self.pair_window_s :
+                keep.append([t,kind,key,data])
+            elif kind == 'bolus' :
+                self.AppendBolus(*data)
+            elif kind in ['dual_normal','dual_square'] :
+                self.Error(None,'unpaired %s part of a dual wave bolus at %d'%(kind,t))
+        self.pending = keep
+        return
+
+    def AddBolus(self,time_ut,insulin,key=None) :
+        wizard = self.Pair(time_ut,'bolus',key,(time_ut,insulin),'wizard')
+        if wizard is not None :
+            self.AppendBolus(time_ut,insulin,wizard)
+        return
+
+    def AddWizard(self,time_ut,wizard,key=None) :
+        bolus = self.Pair(time_ut,'wizard',key,wizard,'bolus')
+        if bolus is not None :
+            self.AppendBolus(bolus[0],bolus[1],wizard)
+        return
+
+    def AddDualPart(self,time_ut,part,duration_hr,insulin,key=None) :
+        # part is 'normal' or 'square'
+        partner = self.Pair(time_ut,'dual_'+part,key,(time_ut,duration_hr,insulin),
+                            'dual_square' if (part == 'normal') else 'dual_normal')
+        if partner is None :
+            return
+        normal,square = ((time_ut,duration_hr,insulin),partner) if (part == 'normal') else (partner,(time_ut,duration_hr,insulin))
+        self.AppendDual(normal[0],square[1],square[2],normal[2])
+        return
+
+    def AddSuspendMarker(self,line,time_ut,suspended) :
+        # Suspend and resume markers, in either time order
+        if self.openSuspend is None or (self.openSuspend[1] == suspended) :
+            if self.openSuspend is not None :
+                self.Error(line,'two %s markers in a row'%('suspend' if suspended else 'resume'))
+            self.openSuspend = (time_ut,suspended)
+            return
+
+        t_other = self.openSuspend[0]
+        self.openSuspend = None
+        self.AppendSuspend(min(time_ut,t_other),max(time_ut,t_other))
+        return
+
+#------------------------------------------------------------------
+class MedtronicCsvReader(ExportReader) :
+    #
+    # Medtronic (CareLink) csv exports. The file starts with some information about
+    # the patient and the device; each section of data starts with a header row whose first
+    # column is 'Index'. Rows are usually in reverse time order, which is fine.
+    #
+    bgColumns = ['BG Reading (mg/dL)','Sensor Glucose (mg/dL)']
+
+    def Records(self) :
+        f = self.Open()
+        header = None
+        for line,fields in enumerate(csv.reader(f),1) :
+            if not fields :
+                continue
+            if fields[0].strip() == 'Index' :
+                header = list(x.strip() for x in fields)
+                continue
+            if (header is None) or (len(fields) != len(header)) :
+                continue
+            yield line,dict((k,v.strip()) for k,v in zip(header,fields) if v.strip())
+
+        if f is not self.source :
+            f.close()
+        return
+
+    def Time(self,record) :
+        if 'Timestamp' in record.keys() :
+            return self.parser.ParseOne(record['Timestamp'])
+        return self.parser.ParseOne('%s %s'%(record['Date'],record['Time']))
+
+    def HandleRecord(self,line,record) :
+        if ('Date' not in record.keys()) and ('Timestamp' not in record.keys()) :
+            return
+
+        try :
+            time_ut = self.Time(record)
+        except ValueError :
+            self.Error(line,'could not parse the time')
+            return
+
+        for column in self.bgColumns :
+            if column in record.keys() :
+                self.AppendBG(time_ut,float(record[column]))
+
+        if 'BWZ Estimate (U)' in record.keys() :
+            wizard = {}
+            for name,column in [('BWZEstimate'          ,'BWZ Estimate (U)'),
+                                ('BWZInsulinSensitivity','BWZ Insulin Sensitivity (mg/dL/U)'),
+                                ('BWZCorrectionEstimate','BWZ Correction Estimate (U)'),
+                                ('BWZFoodEstimate'      ,'BWZ Food Estimate (U)'),
+                                ('BWZActiveInsulin'     ,'BWZ Active Insulin (U)'),
+                                ('BWZBGInput'           ,'BWZ BG Input (mg/dL)'),
+                                ('BWZCarbRatio'         ,'BWZ Carb Ratio (g/U)')] :
+                if column in record.keys() :
+                    wizard[name] = float(record[column])
+            self.AddWizard(time_ut,wizard)
+
+            food = float(record.get('BWZ Carb Input (grams)',0))
+            if food > 0 :
+                self.AppendFood(time_ut,food)
+
+        bolus_type = record.get('Bolus Type')
+        if bolus_type and ('Bolus Volume Delivered (U)' in record.keys()) :
+            insulin = float(record['Bolus Volume Delivered (U)'])
+            duration_hr = DurationToHours(record.get('Programmed Bolus Duration (h:mm:ss)','0:00:00'))
+            if bolus_type == 'Normal' :
+                self.AddBolus(time_ut,insulin)
+            elif bolus_type == 'Square' :
+                self.AppendSquare(time_ut,duration_hr,insulin)
+            elif bolus_type.startswith('Dual') :
+                self.AddDualPart(time_ut,'normal' if ('normal' in bolus_type.lower()) else 'square',duration_hr,insulin)
+            else :
+                self.Error(line,'unknown bolus type %s'%(bolus_type))
+
+        if 'Temp Basal Amount' in record.keys() :
+            amount = float(record['Temp Basal Amount'])
+            duration_hr = DurationToHours(record.get('Temp Basal Duration (h:mm:ss)','0:00:00'))
+            if record.get('Temp Basal Type','').lower().startswith('percent') :
+                self.AppendTempBasal(line,time_ut,duration_hr,basalFactor=amount/100.)
+            else :
+                self.AppendTempBasal(line,time_ut,duration_hr,rate=amount)
+
+        if 'Suspend' in record.keys() :
+            marker = record['Suspend'].upper()
+            if ('RESUME' in marker) or (marker == 'NORMAL_PUMPING') :
+                self.AddSuspendMarker(line,time_ut,False)
+            elif 'SUSPEND' in marker :
+                self.AddSuspendMarker(line,time_ut,True)
+
+        if 'Event Marker' in record.keys() :
+            self.AppendAnnotation(time_ut,record['Event Marker'])
+
+        return
+
+#------------------------------------------------------------------
+class TidepoolJsonReader(ExportReader) :
+    #
+    # Tidepool json exports: one (large) json array of records, or one record per line.
+    # The records are decoded one at a time from a buffered read of the file.
+    # Tidepool stores BG in mmol/L; it is converted to mg/dL.
+    #
+    block_size = 1 << 16
+
+    def Records(self) :
+        f = self.Open()
+        decoder = json.JSONDecoder()
+        buf = ''
+        pos = 0
+        line = 0
+        eof = False
+        while True :
+            # skip the separators between records
+            while pos < len(buf) and buf[pos] in ' \t\r\n,[]' :
+                pos += 1
+
+            if pos >= len(buf) :
+                if eof :
+                    break
+                block = f.read(self.block_size)
+                buf,pos = buf[pos:] + block,0
+                eof = not block
+                continue
+
+            try :
+                record,end = decoder.raw_decode(buf,pos)
+            except json.JSONDecodeError :
+                if eof :
+                    self.Error(line,'truncated json')
+                    break
+                block = f.read(self.block_size)
+                buf,pos = buf[pos:] + block,0
+                eof = not block
+                continue
+
+            pos = end
+            line += 1
+            if type(record) == type({}) :
+                yield line,record
+
+        if f is not self.source :
+            f.close()
+        return
+
+    @staticmethod
+    def ToMgdl(value,units) :
+        if units and units.lower().startswith('mmol') :
+            return value*mgdlPerMmol
+        return value
+
+    def Time(self,record) :
+        # deviceTime is the local time on the device, like the Medtronic times
+        if 'deviceTime' in record.keys() :
+            return self.parser.ParseOne(record['deviceTime'][:19])
+        return UtcFromIsoZulu(record['time'])
+
+    def HandleRecord(self,line,record) :
+        record_type = record.get('type')
+        if record_type is None :
+            return
+
+        try :
+            time_ut = self.Time(record)
+        except (ValueError,KeyError) :
+            self.Error(line,'could not parse the time')
+            return
+
+        units = record.get('units','mmol/L')
+
+        if record_type in ['cbg','smbg'] :
+            self.AppendBG(time_ut,self.ToMgdl(float(record['value']),units))
+
+        elif record_type == 'bolus' :
+            subType = record.get('subType','normal')
+            duration_hr = record.get('duration',0)/3600000.
+            if subType == 'normal' :
+                self.AddBolus(time_ut,float(record['normal']),record.get('id'))
+            elif subType == 'square' :
+                self.AppendSquare(time_ut,duration_hr,float(record['extended']))
+            elif subType == 'dual/square' :
+                self.AppendDual(time_ut,duration_hr,float(record.get('extended',0)),float(record.get('normal',0)))
+            else :
+                self.Error(line,'unknown bolus subType %s'%(subType))
+
+        elif record_type == 'wizard' :
+            recommended = record.get('recommended',{})
+            wizard = {}
+            for name,value in [('BWZEstimate'          ,recommended.get('net')),
+                               ('BWZCorrectionEstimate',recommended.get('correction')),
+                               ('BWZFoodEstimate'      ,recommended.get('carb')),
+                               ('BWZActiveInsulin'     ,record.get('insulinOnBoard')),
+                               ('BWZCarbRatio'         ,record.get('insulinCarbRatio'))] :
+                if value is not None :
+                    wizard[name] = float(value)
+            for name,key in [('BWZInsulinSensitivity','insulinSensitivity'),('BWZBGInput','bgInput')] :
+                if record.get(key) is not None :
+                    wizard[name] = self.ToMgdl(float(record[key]),units)
+
+            # The bolus is linked by its id (a string), or else matched by time
+            if type(record.get('bolus')) == type('') :
+                self.AddWizard(time_ut,wizard,record['bolus'])
+            elif type(record.get('bolus')) == type({}) :
+                self.AddWizard(time_ut,wizard,record['bolus'].get('id'))
+            else :
+                self.AddWizard(time_ut,wizard)
+
+            food = float(record.get('carbInput',0))
+            if food > 0 :
+                self.AppendFood(time_ut,food)
+
+        elif record_type == 'food' :
+            carbs = record.get('nutrition',{}).get('carbohydrate',{}).get('net',0)
+            if carbs > 0 :
+                self.AppendFood(time_ut,float(carbs))
+
+        elif record_type == 'basal' :
+            duration_hr = record.get('duration',0)/3600000.
+            deliveryType = record.get('deliveryType')
+            if deliveryType == 'temp' :
+                if 'percent' in record.keys() :
+                    self.AppendTempBasal(line,time_ut,duration_hr,basalFactor=float(record['percent']))
+                elif record.get('suppressed',{}).get('rate') :
+                    self.AppendTempBasal(line,time_ut,duration_hr,basalFactor=float(record['rate'])/float(record['suppressed']['rate']))
+                else :
+                    self.AppendTempBasal(line,time_ut,duration_hr,rate=float(record['rate']))
+            elif deliveryType == 'suspend' :
+                self.AppendSuspend(time_ut,time_ut + duration_hr*3600.)
+
+        elif record_type == 'deviceEvent' :
+            text = record.get('subType','')
+            for key in ['alarmType','reason','status'] :
+                if type(record.get(key)) == type('') :
+                    text += ': ' + record[key]
+            self.AppendAnnotation(time_ut,text)
+
+        return
+
+#------------------------------------------------------------------
+def ExportReaderFor(source,**kwargs) :
+    # The reader for a file name, by extension (.csv is Medtronic, .json is Tidepool)
+    name = source if (type(source) == type('')) else getattr(source,'name','')
+    if name.lower().endswith('.csv') :
+        return MedtronicCsvReader(source,**kwargs)
+    if name.lower().endswith('.json') or name.lower().endswith('.jsonl') :
+        return TidepoolJsonReader(source,**kwargs)
+    raise ValueError('ExportReaderFor: unknown export format for %s'%(name))
+
+#------------------------------------------------------------------
+def LoadExport(source,**kwargs) :
+    # The whole export in one EventStore (sorted by time), and the reader (for reader.errors)
+    reader = ExportReaderFor(source,**kwargs)
+    store = EventStore()
+    for chunk in reader.Chunks() :
+        for type_name in chunk.Types() :
+            table = chunk.Table(type_name)
+            store.Table(type_name).Extend(**dict((name,table[name]) for name in table.ColumnNames()))
+    store.Sort()
+    return store,reader
@@ -0,0 +1,475 @@
+from .BGTimeline import *
+
+#------------------------------------------------------------------
+#
+# Live (incremental) BG prediction, updated as new CGM and pump events arrive.
+#
+# The deliveries are kept in two parts:
+# - the active ones (delivered less than saturationTime_Ta * Ta ago), as arrays of
+#   (delivery time, BG effect, Ta), and
+# - the saturated ones, whose contribution to the curve is the same constant at all later
+#   times. They are folded into one number per event type, and then forgotten.
+#
+# A new event only adds its own contribution to the predicted curve (over its band, see
+# BandedSum), and a new TempBasal only adds the change of the basal deliveries that it
+# re-scales. So the cost of an update depends on the number of active deliveries and on
+# the length of the prediction grid, but not on the length of the history.
+#
+
+basalTimeStep_s = 360. # (like BasalInsulin: a delivery every 6 minutes)
+
+#------------------------------------------------------------------
+class IncrementalModel :
+    #
+    #     model = IncrementalModel(the_userprofile,basal_rates,time_start,sensitivities=...)
+    #     model.AddEvent(InsulinBolus(t,2.0))
+    #     model.AddEvent(TempBasal(t0,t1,1.5))
+    #     model.AddEvent(BGMeasurement(t,t,120))  # the latest measurement is the reference
+    #     model.Advance(time_now)                 # the grid moves to [time_now, time_now + horizon_hr]
+    #     model.times,model.GetBG()               # the predicted BG on the grid
+    #     model.BGEffectRemaining(time_now)       # the BG effect still to come, per event type
+    #
+    # basal_rates and sensitivities are the 48-bin lists (or settings arrays) of BasalInsulin.
+    # The basal deliveries are generated as the grid moves forward, from the hour before
+    # time_start, and a TempBasal or Suspend re-scales the ones already generated.
+    #
+    # The profile is read when each delivery is added (like getDeliveries), so if the profile
+    # changes afterwards, make a new IncrementalModel. Events (and measurements) from before
+    # the start of the grid at the last Advance are outside of the saturated window: their
+    # effect is added as if the saturated deliveries did not exist.
+    #
+    def __init__(self,settings,basal_rates,time_start,sensitivities=None,startBG=None,step_s=300.,horizon_hr=6.,reanchor=True) :
+        self.settings = settings
+        self.settingsVersion = getattr(settings,'version',None)
+        self.step_s = float(step_s)
+        self.horizon_hr = horizon_hr
+        self.reanchor = reanchor
+
+        self.BasalRates = [0]*48
+        if type(basal_rates) == type(np.array([])) :
+            TrueUserProfile.SettingsArrayToList(basal_rates,self.BasalRates)
+        else :
+            self.BasalRates = list(basal_rates)
+        self.BasalRates = np.asarray(self.BasalRates,dtype=np.float64)
+
+        # Insulin sensitivity is needed to make liver (LiverFattyGlucose) events
+        self.BasalSensitivities = None
+        if type(sensitivities) == type(np.array([])) :
+            self.BasalSensitivities = [0]*48
+            TrueUserProfile.SettingsArrayToList(sensitivities,self.BasalSensitivities)
+        elif (sensitivities is not None) and (len(sensitivities) > 0) :
+            self.BasalSensitivities = list(sensitivities)
+        if self.BasalSensitivities is not None :
+            self.BasalSensitivities = np.asarray(self.BasalSensitivities,dtype=np.float64)
+
+        # The basal deliveries are at basalAnchor + k*basalTimeStep_s (rounded down to the hour)
+        self.basalAnchor = time_start - timeOfDay.SecondsIntoHour(time_start)
+        self.basalNext = 0
+        self.basal = OrderedDict((name,np.zeros(0)) for name in ['times','insulin','effects','Ta','factors'])
+        self.basal['suspended'] = np.zeros(0,dtype=bool)
+        self.tempBasals = []
+        self.suspends = []
+        self.fattyTa = dict() # Ta of the LiverFattyGlucose made for each TempBasal start time
+
+        # The active deliveries and infusions, by event type
+        self.deliveries = OrderedDict()
+        self.infusions = OrderedDict()
+        self.exercises = []
+        self.others = []
+        self.liver = LiverBasalGlucose()
+
+        # The folded (saturated) contributions, by event type
+        self.saturated = OrderedDict()
+
+        self.time_ref = time_start
+        self.BG_ref = 0
+        if startBG is not None :
+            self.time_ref = startBG.iov_0_utc
+            self.BG_ref = startBG.const_BG
+
+        self.times = np.zeros(0)
+        self.contributions = OrderedDict()
+        self.time_saturated = -float('inf')
+        self.Advance(time_start)
+        return
+
+    def CheckSettings(self) :
+        if getattr(self.settings,'version',None) != self.settingsVersion :
+            raise ValueError('IncrementalModel: the profile has changed, make a new IncrementalModel')
+        return
+
+    #
+    # The contribution of a set of deliveries (or infusions) to the curve at times T,
+    # relative to the reference time (Phi(T) - Phi(time_ref), like BGTimeline)
+    #
+    def DeliveryCurve(self,times,magnitudes,Ta,T) :
+        if not len(times) :
+            return np.zeros(len(T))
+        time_ref = np.array([self.time_ref],dtype=np.float64)
+        return CumulativeEffectOfDeliveries(times,magnitudes,Ta,T) - CumulativeEffectOfDeliveries(times,magnitudes,Ta,time_ref)[0]
+
+    def InfusionCurve(self,starts,ends,magnitudes,Ta,T) :
+        if not len(starts) :
+            return np.zeros(len(T))
+        time_ref = np.array([self.time_ref],dtype=np.float64)
+        return CumulativeEffectOfInfusions(starts,ends,magnitudes,Ta,T) - CumulativeEffectOfInfusions(starts,ends,magnitudes,Ta,time_ref)[0]
+
+    def ExerciseCurve(self,exercise,type_name,times,magnitudes,Ta,T) :
+        # The part of the exercise effect that comes from these deliveries. Like ExerciseEffect
+        # (LoadContainers), only the basal and the InsulinBolus events overlapping the window count.
+        if type_name == 'InsulinBolus' :
+            keep = (times + 6*3600. >= exercise.iov_0_utc)
+            times,magnitudes,Ta = times[keep],magnitudes[keep],Ta[keep]
+        elif type_name != 'BasalInsulin' :
+            return np.zeros(len(T))
+        if not len(times) :
+            return np.zeros(len(T))
+
+        # The integral is clamped to the exercise window
+        clipped = np.clip(T,exercise.iov_0_utc,exercise.iov_1_utc)
+        clipped_ref = np.clip(np.array([self.time_ref],dtype=np.float64),exercise.iov_0_utc,exercise.iov_1_utc)
+        return exercise.factor * (CumulativeEffectOfDeliveries(times,magnitudes,Ta,clipped) -
+                                  CumulativeEffectOfDeliveries(times,magnitudes,Ta,clipped_ref)[0])
+
+    def GenericCurve(self,event,T) :
+        # Slow path, for events without a vectorized form (like BGTimeline.GenericCurve)
+        curve = np.zeros(len(T))
+        for i,t in enumerate(T) :
+            if t >= self.time_ref :
+                curve[i] = event.getIntegral(self.time_ref,t,self.settings)
+            else :
+                curve[i] = -event.getIntegral(t,self.time_ref,self.settings)
+        return curve
+
+    def ActiveDeliveries(self) :
+        # (type name, times, BG effects, Ta) of the active deliveries, including the basal
+        for type_name in self.deliveries.keys() :
+            yield (type_name,) + tuple(self.deliveries[type_name])
+        yield 'BasalInsulin',self.basal['times'],self.basal['effects']*self.basal['factors'],self.basal['Ta']
+
+    def Curves(self,T) :
+        # The contribution of each event type at times T (>= time_saturated), from scratch
+        T = np.asarray(T,dtype=np.float64)
+        curves = OrderedDict((type_name,np.full(len(T),float(value))) for type_name,value in self.saturated.items())
+
+        def Add(type_name,curve) :
+            if type_name not in curves.keys() :
+                curves[type_name] = np.zeros(len(T))
+            curves[type_name] += curve
+            return
+
+        for type_name,times,magnitudes,Ta in self.ActiveDeliveries() :
+            if len(times) :
+                Add(type_name,self.DeliveryCurve(times,magnitudes,Ta,T))
+            for exercise in self.exercises :
+                Add('ExerciseEffect',self.ExerciseCurve(exercise,type_name,times,magnitudes,Ta,T))
+
+        for type_name,(starts,ends,magnitudes,Ta) in self.infusions.items() :
+            Add(type_name,self.InfusionCurve(starts,ends,magnitudes,Ta,T))
+
+        # (the bins are aligned to the midnight of the reference day, like BGTimeline)
+        self.liver.getSmearedList(self.settings)
+        midnight = timeOfDay.Midnight(self.time_ref)
+        Add('LiverBasalGlucose',self.liver.getCumulativeIntegralArray(T - midnight) - self.liver.getCumulativeIntegral(self.time_ref - midnight))
+
+        for event in self.others :
+            Add(event.__class__.__name__,self.GenericCurve(event,T))
+
+        return curves
+
+    def AddContribution(self,type_name,curve) :
+        if type_name not in self.contributions.keys() :
+            self.contributions[type_name] = np.zeros(len(self.times))
+        self.contributions[type_name] += curve
+        return
+
+    def ApplyDeliveries(self,type_name,times,magnitudes,Ta) :
+        # Add the curve of new deliveries (or of a change of magnitude) on the grid
+        self.AddContribution(type_name,self.DeliveryCurve(times,magnitudes,Ta,self.times))
+        for exercise in self.exercises :
+            self.AddContribution('ExerciseEffect',self.ExerciseCurve(exercise,type_name,times,magnitudes,Ta,self.times))
+        return
+
+    def AppendDeliveries(self,type_name,times,magnitudes,Ta) :
+        times,magnitudes,Ta = (np.asarray(x,dtype=np.float64) for x in (times,magnitudes,Ta))
+        if not len(times) :
+            return
+        self.ApplyDeliveries(type_name,times,magnitudes,Ta)
+        if type_name in self.deliveries.keys() :
+            self.deliveries[type_name] = list(np.concatenate(x) for x in zip(self.deliveries[type_name],(times,magnitudes,Ta)))
+        else :
+            self.deliveries[type_name] = [times,magnitudes,Ta]
+        return
+
+    def AppendInfusions(self,type_name,starts,ends,magnitudes,Ta) :
+        starts,ends,magnitudes,Ta = (np.asarray(x,dtype=np.float64) for x in (starts,ends,magnitudes,Ta))
+        if not len(starts) :
+            return
+        self.AddContribution(type_name,self.InfusionCurve(starts,ends,magnitudes,Ta,self.times))
+        if type_name in self.infusions.keys() :
+            self.infusions[type_name] = list(np.concatenate(x) for x in zip(self.infusions[type_name],(starts,ends,magnitudes,Ta)))
+        else :
+            self.infusions[type_name] = [starts,ends,magnitudes,Ta]
+        return
+
+    #
+    # The basal
+    #
+    def BasalFactors(self,times) :
+        # The basalFactor at each delivery time (later TempBasals win, and Suspends win over TempBasals)
+        factors = np.ones(len(times))
+        suspended = np.zeros(len(times),dtype=bool)
+        for c in self.tempBasals :
+            factors[(times >= c.iov_0_utc) & (times <= c.iov_1_utc)] = c.basalFactor
+        for c in self.suspends :
+            inside = (times > c.iov_0_utc) & (times < c.iov_1_utc)
+            factors[inside] = c.basalFactor
+            suspended |= inside
+        return factors,suspended
+
+    def GenerateBasal(self,time_end) :
+        # The basal deliveries up to time_end (included)
+        k_end = int(math.floor((time_end - self.basalAnchor)/basalTimeStep_s)) + 1
+        if k_end <= self.basalNext :
+            return
+
+        times = self.basalAnchor + np.arange(self.basalNext,k_end)*basalTimeStep_s
+        self.basalNext = k_end
+
+        insulin = self.BasalRates[timeOfDay.GetBin(times,0.5)]*(basalTimeStep_s/3600.)
+        bins = self.settings.getBin(times)
+        effects = np.asarray(self.settings.InsulinSensitivity,dtype=np.float64)[bins]*insulin
+        Ta = np.asarray(self.settings.InsulinTa,dtype=np.float64)[bins]
+        factors,suspended = self.BasalFactors(times)
+
+        self.ApplyDeliveries('BasalInsulin',times,effects*factors,Ta)
+        for name,values in zip(['times','insulin','effects','Ta','factors','suspended'],[times,insulin,effects,Ta,factors,suspended]) :
+            self.basal[name] = np.concatenate([self.basal[name],values])
+        return
+
+    def AddBasalModifier(self,c) :
+        # A TempBasal or Suspend: re-scale the basal deliveries already generated, and the later ones
+        times = self.basal['times']
+        if c.IsSuspend() :
+            changed = (times > c.iov_0_utc) & (times < c.iov_1_utc)
+            self.suspends.append(c)
+        else :
+            changed = (times >= c.iov_0_utc) & (times <= c.iov_1_utc) & ~self.basal['suspended']
+            self.tempBasals.append(c)
+
+        if np.any(changed) :
+            delta = self.basal['effects'][changed]*(c.basalFactor - self.basal['factors'][changed])
+            self.ApplyDeliveries('BasalInsulin',times[changed],delta,self.basal['Ta'][changed])
+            self.basal['factors'][changed] = c.basalFactor
+            if c.IsSuspend() :
+                self.basal['suspended'][changed] = True
+
+        if (not c.IsSuspend()) and (c.basalFactor > 1) and (self.BasalSensitivities is not None) :
+            self.AddFattyGlucose(c)
+
+        return
+
+    def AddFattyGlucose(self,c) :
+        # The LiverFattyGlucose of a TempBasal with basalFactor > 1 (like BasalInsulin), from
+        # all of the nominal deliveries in its window (generated or not).
+        k0 = int(math.ceil((c.iov_0_utc - self.basalAnchor)/basalTimeStep_s))
+        k1 = int(math.floor((c.iov_1_utc - self.basalAnchor)/basalTimeStep_s)) + 1
+        if k1 <= k0 :
+            return
+
+        times = self.basalAnchor + np.arange(k0,k1)*basalTimeStep_s
+        bins = timeOfDay.GetBin(times,0.5)
+        nominal = self.BasalRates[bins]*(basalTimeStep_s/3600.)
+        BGEffect = np.sum(-self.BasalSensitivities[bins]*nominal*(c.basalFactor-1))
+
+        # (TempBasals starting at the same time make one LiverFattyGlucose, with the first one's Ta)
+        if c.iov_0_utc not in self.fattyTa.keys() :
+            self.fattyTa[c.iov_0_utc] = LiverFattyGlucose(c.iov_0_utc,c.iov_1_utc,BGEffect,(c.iov_1_utc - c.iov_0_utc)/3600.,c.basalFactor-1).Ta
+
+        self.AppendDeliveries('LiverFattyGlucose',[c.iov_0_utc],[BGEffect],[self.fattyTa[c.iov_0_utc]])
+        return
+
+    #
+    # New events, and the passing of time
+    #
+    def AddEvent(self,event) :
+        self.CheckSettings()
+        type_name = event.__class__.__name__
+
+        if event.IsMeasurement() :
+            if self.reanchor and (event.iov_0_utc >= max(self.time_ref,self.time_saturated)) :
+                self.Anchor(event)
+
+        elif event.IsTempBasal() or event.IsSuspend() :
+            self.AddBasalModifier(event)
+
+        elif not getattr(event,'affectsBG',False) :
+            pass
+
+        elif event.IsBasalInsulin() :
+            raise ValueError('IncrementalModel: the basal is made from the basal_rates, give TempBasals instead')
+
+        elif event.IsBasalGlucose() :
+            # (the model has its own LiverBasalGlucose)
+            pass
+
+        elif event.IsExercise() :
+            self.exercises.append(event)
+            for the_type,times,magnitudes,Ta in self.ActiveDeliveries() :
+                self.AddContribution('ExerciseEffect',self.ExerciseCurve(event,the_type,times,magnitudes,Ta,self.times))
+
+        elif hasattr(event,'getDeliveries') :
+            self.AppendDeliveries(type_name,*event.getDeliveries(self.settings))
+            if hasattr(event,'getInfusions') :
+                self.AppendInfusions(type_name,*event.getInfusions(self.settings))
+
+        else :
+            self.others.append(event)
+            self.AddContribution(type_name,self.GenericCurve(event,self.times))
+
+        return
+
+    def AddEvents(self,events) :
+        for event in events :
+            self.AddEvent(event)
+        return
+
+    def Anchor(self,measurement) :
+        # A new reference BG. The saturated contributions are constant from time_saturated
+        # on, so they are zero relative to the new reference time.
+        self.time_ref = measurement.iov_0_utc
+        self.BG_ref = measurement.const_BG
+        self.saturated = OrderedDict()
+        self.contributions = self.Curves(self.times)
+        return
+
+    def Advance(self,time_now) :
+        # Move the grid to [time_now, time_now + horizon_hr] (in steps of step_s),
+        # generate the new basal deliveries, and fold the saturated ones.
+        self.CheckSettings()
+        time_start = math.floor(time_now/self.step_s)*self.step_s
+        if len(self.times) :
+            time_start = max(time_start,self.times[0])
+        time_end = time_start + self.horizon_hr*3600.
+
+        # The new grid points, from the current state
+        first = self.times[-1] + self.step_s if len(self.times) else time_start
+        new_times = np.arange(first,time_end + 0.5*self.step_s,self.step_s)
+        if len(new_times) :
+            new_curves = self.Curves(new_times)
+            self.times = np.concatenate([self.times,new_times])
+            type_names = list(self.contributions.keys()) + list(k for k in new_curves.keys() if k not in self.contributions.keys())
+            for type_name in type_names :
+                old = self.contributions.get(type_name,np.zeros(len(self.times) - len(new_times)))
+                new = new_curves.get(type_name,np.zeros(len(new_times)))
+                self.contributions[type_name] = np.concatenate([old,new])
+
+        self.GenerateBasal(time_end)
+
+        # Drop the past
+        keep = np.searchsorted(self.times,time_start,side='left')
+        self.times = self.times[keep:]
+        for type_name in self.contributions.keys() :
+            self.contributions[type_name] = self.contributions[type_name][keep:]
+
+        self.Fold(time_start)
+
+        # TempBasals and Suspends that are over no longer change anything
+        last_basal = self.basalAnchor + (self.basalNext - 1)*basalTimeStep_s
+        self.tempBasals = list(c for c in self.tempBasals if c.iov_1_utc >= last_basal)
+        self.suspends = list(c for c in self.suspends if c.iov_1_utc >= last_basal)
+        return
+
+    def Fold(self,time_fold) :
+        # Fold the deliveries whose effect is constant from time_fold on: their contribution
+        # at any later time is the one at time_fold.
+        T = np.array([time_fold],dtype=np.float64)
+
+        def AddSaturated(type_name,value) :
+            self.saturated[type_name] = self.saturated.get(type_name,0.) + value
+            return
+
+        for type_name in list(self.deliveries.keys()) :
+            times,magnitudes,Ta = self.deliveries[type_name]
+            done = (times + saturationTime_Ta*Ta*3600. < time_fold)
+            if not np.any(done) :
+                continue
+            AddSaturated(type_name,self.DeliveryCurve(times[done],magnitudes[done],Ta[done],T)[0])
+            for exercise in self.exercises :
+                AddSaturated('ExerciseEffect',self.ExerciseCurve(exercise,type_name,times[done],magnitudes[done],Ta[done],T)[0])
+            self.deliveries[type_name] = [times[~done],magnitudes[~done],Ta[~done]]
+
+        done = (self.basal['times'] + saturationTime_Ta*self.basal['Ta']*3600. < time_fold)
+        if np.any(done) :
+            times,magnitudes,Ta = self.basal['times'][done],(self.basal['effects']*self.basal['factors'])[done],self.basal['Ta'][done]
+            AddSaturated('BasalInsulin',self.DeliveryCurve(times,magnitudes,Ta,T)[0])
+            for exercise in self.exercises :
+                AddSaturated('ExerciseEffect',self.ExerciseCurve(exercise,'BasalInsulin',times,magnitudes,Ta,T)[0])
+            for name in self.basal.keys() :
+                self.basal[name] = self.basal[name][~done]
+
+        for type_name in list(self.infusions.keys()) :
+            starts,ends,magnitudes,Ta = self.infusions[type_name]
+            done = (ends + saturationTime_Ta*Ta*3600. < time_fold)
+            if not np.any(done) :
+                continue
+            AddSaturated(type_name,self.InfusionCurve(starts[done],ends[done],magnitudes[done],Ta[done],T)[0])
+            self.infusions[type_name] = list(x[~done] for x in (starts,ends,magnitudes,Ta))
+
+        # Exercise windows that are over
+        for exercise in list(self.exercises) :
+            if exercise.iov_1_utc >= time_fold :
+                continue
+            for type_name,times,magnitudes,Ta in self.ActiveDeliveries() :
+                AddSaturated('ExerciseEffect',self.ExerciseCurve(exercise,type_name,times,magnitudes,Ta,T)[0])
+            self.exercises.remove(exercise)
+
+        self.time_saturated = time_fold
+        return
+
+    #
+    # Results
+    #
+    def GetBG(self,type_names=None) :
+        # The predicted BG on the grid (self.times), optionally from only some of the event types
+        if type_names is None :
+            type_names = self.contributions.keys()
+        elif type(type_names) == type('') :
+            type_names = [type_names]
+
+        bg = np.full(len(self.times),float(self.BG_ref))
+        for type_name in type_names :
+            if type_name in self.contributions.keys() :
+                bg += self.contributions[type_name]
+        return bg
+
+    def Evaluate(self,times) :
+        # The predicted BG at any times (from time_saturated on), computed from the current state
+        times = np.asarray(times,dtype=np.float64)
+        if len(times) and (times.min() < self.time_saturated) :
+            raise ValueError('IncrementalModel: cannot predict before the saturated window (%s)'%(time.ctime(self.time_saturated)))
+
+        bg = np.full(len(times),float(self.BG_ref))
+        for curve in self.Curves(times).values() :
+            bg += curve
+        return bg
+
+    def BGEffectRemaining(self,time_ut) :
+        # The BG effect still to come after time_ut (from time_saturated on), per event type.
+        # (Unlike BasalInsulin.BGEffectRemaining, the basal is included: it is the BG
+        # equivalent of the basal insulin still active.)
+        if time_ut < self.time_saturated :
+            raise ValueError('IncrementalModel: cannot look before the saturated window (%s)'%(time.ctime(self.time_saturated)))
+
+        remaining = OrderedDict()
+        for type_name,times,magnitudes,Ta in self.ActiveDeliveries() :
+            curve = InsulinActionCurveArray((time_ut - times)/3600.,Ta)
+            remaining[type_name] = remaining.get(type_name,0.) + float(np.dot(1 - curve,magnitudes))
+
+        for type_name,(starts,ends,magnitudes,Ta) in self.infusions.items() :
+            G_start = InsulinActionCurveIntegralArray((time_ut - starts)/3600.,Ta)
+            G_end   = InsulinActionCurveIntegralArray((time_ut - ends  )/3600.,Ta)
+            total = (ends - starts)/3600.
+            remaining[type_name] = remaining.get(type_name,0.) + float(np.dot(total - (G_start - G_end),magnitudes))
+
+        return remaining
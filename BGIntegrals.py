@@ -0,0 +1,146 @@
+from .BGTimeline import *
+
+#------------------------------------------------------------------
+#
+# Batched integrals: many events over many windows at once.
+#
+#     IntegralMatrix(events,settings,time_starts,time_ends)         # [i,j] = events[i].getIntegral(time_starts[j],time_ends[j],settings)
+#     IntegralMatrix(events,settings,time_starts,time_ends,axis=0)  # summed over the events (one value per window)
+#     IntegralMatrix(events,settings,time_starts,time_ends,axis=1)  # summed over the windows (one value per event)
+#
+# The integral of an event over a window is Phi(time_end) - Phi(time_start), where Phi is its
+# cumulative effect (see BGTimeline). So the deliveries of all the events, whatever their type
+# and Ta, are evaluated together at the distinct window times only, and only within the band
+# of each delivery (see BandedSum). Events with deliveries (InsulinBolus, Food, LiverFattyGlucose,
+# BasalInsulin, the square and dual waves) go this way. LiverBasalGlucose uses its cumulative
+# integral, ExerciseEffect the integrals of its affectedEvents over the clipped windows, and any
+# other event gets one getIntegral per window. The windows must have time_start <= time_end.
+#
+
+#------------------------------------------------------------------
+def BandedMatrix(owners,n_owners,band_starts,band_ends,tails,values,t_grid,max_chunk=2000000) :
+    # Like BandedSum, but summed separately for each owner (owners[i] in [0,n_owners) is the
+    # row of event i). Returns an (n_owners x grid) matrix.
+    n_grid = len(t_grid)
+    result = np.zeros((n_owners,n_grid))
+    if not len(band_starts) :
+        return result
+
+    k0 = np.searchsorted(t_grid,band_starts,side='left')
+    k1 = np.searchsorted(t_grid,band_ends,side='right')
+
+    steps = np.bincount(owners*(n_grid+1) + k1,weights=tails,minlength=n_owners*(n_grid+1))
+    result += np.cumsum(steps.reshape(n_owners,n_grid+1)[:,:n_grid],axis=1)
+
+    for idx,ev in BandChunks(k0,k1,max_chunk) :
+        flat = owners[ev]*n_grid + idx
+        result += np.bincount(flat,weights=values(idx,ev),minlength=n_owners*n_grid).reshape(n_owners,n_grid)
+
+    return result
+
+#------------------------------------------------------------------
+def BandedOwnerSums(owners,n_owners,band_starts,band_ends,tails,values,t_grid,weights,max_chunk=2000000) :
+    # sum_k weights[k] * (the BandedMatrix row of each owner)[k], without making the matrix
+    result = np.zeros(n_owners)
+    if not len(band_starts) :
+        return result
+
+    k0 = np.searchsorted(t_grid,band_starts,side='left')
+    k1 = np.searchsorted(t_grid,band_ends,side='right')
+
+    # The tail of event i is on every grid point from k1[i] on
+    after = np.concatenate([np.cumsum(weights[::-1])[::-1],[0.]])
+    result += np.bincount(owners,weights=tails*after[k1],minlength=n_owners)
+
+    for idx,ev in BandChunks(k0,k1,max_chunk) :
+        result += np.bincount(owners[ev],weights=weights[idx]*values(idx,ev),minlength=n_owners)
+
+    return result
+
+#------------------------------------------------------------------
+def IntegralMatrix(events,settings,time_starts,time_ends,axis=None) :
+    events = list(events)
+    time_starts = np.atleast_1d(np.asarray(time_starts,dtype=np.float64))
+    time_ends = np.atleast_1d(np.asarray(time_ends,dtype=np.float64))
+    time_starts,time_ends = np.broadcast_arrays(time_starts,time_ends)
+    n_events,n_windows = len(events),len(time_starts)
+
+    if axis is None :
+        result = np.zeros((n_events,n_windows))
+    elif axis == 0 :
+        result = np.zeros(n_windows)
+    elif axis == 1 :
+        result = np.zeros(n_events)
+    else :
+        raise ValueError('IntegralMatrix: axis must be None, 0 or 1')
+
+    if not (n_events and n_windows) :
+        return result
+
+    # The distinct window times (the grid), and where each window starts and ends on it
+    t_grid,inverse = np.unique(np.concatenate([time_starts,time_ends]),return_inverse=True)
+    i_start,i_end = inverse[:n_windows],inverse[n_windows:]
+
+    def AddRow(i,row) :
+        # The integrals of event i over all windows
+        if axis is None :
+            result[i] += row
+        elif axis == 0 :
+            result[:] += row
+        else :
+            result[i] += np.sum(row)
+        return
+
+    def AddTerms(owners,terms) :
+        # The deliveries (or infusions) of the events in owners
+        if not len(owners) :
+            return
+        if axis is None :
+            phi = BandedMatrix(owners,n_events,*terms,t_grid=t_grid)
+            result[:] += phi[:,i_end] - phi[:,i_start]
+        elif axis == 0 :
+            phi = BandedSum(*terms,t_grid=t_grid)
+            result[:] += phi[i_end] - phi[i_start]
+        else :
+            weights = (np.bincount(i_end,minlength=len(t_grid)) - np.bincount(i_start,minlength=len(t_grid))).astype(np.float64)
+            result[:] += BandedOwnerSums(owners,n_events,*terms,t_grid=t_grid,weights=weights)
+        return
+
+    deliveries = []
+    infusions = []
+    for i,e in enumerate(events) :
+        if hasattr(e,'getDeliveries') :
+            times,magnitudes,Ta = e.getDeliveries(settings)
+            deliveries.append((np.full(len(times),i,dtype=np.int64),times,magnitudes,Ta))
+            if hasattr(e,'getInfusions') :
+                starts,ends,magnitudes,Ta = e.getInfusions(settings)
+                infusions.append((np.full(len(starts),i,dtype=np.int64),starts,ends,magnitudes,Ta))
+
+        elif e.IsBasalGlucose() :
+            e.getSmearedList(settings)
+            midnight = timeOfDay.Midnight(time_starts)
+            row = e.getCumulativeIntegralArray(time_ends - midnight) - e.getCumulativeIntegralArray(time_starts - midnight)
+            AddRow(i,np.where(time_ends <= time_starts,0.,row))
+
+        elif e.IsExercise() :
+            # factor * (the affected events over the windows clipped to the exercise)
+            overlap = (time_ends >= e.iov_0_utc) & (time_starts <= e.iov_1_utc)
+            row = np.zeros(n_windows)
+            if np.any(overlap) and e.affectedEvents :
+                clipped_starts = np.maximum(time_starts[overlap],e.iov_0_utc)
+                clipped_ends = np.minimum(time_ends[overlap],e.iov_1_utc)
+                row[overlap] = e.factor*IntegralMatrix(e.affectedEvents,settings,clipped_starts,clipped_ends,axis=0)
+            AddRow(i,row)
+
+        elif hasattr(e,'getIntegral') :
+            AddRow(i,np.array(list(e.getIntegral(t0,t1,settings) for t0,t1 in zip(time_starts.tolist(),time_ends.tolist()))))
+
+    if deliveries :
+        owners,times,magnitudes,Ta = (np.concatenate(x) for x in zip(*deliveries))
+        AddTerms(owners,DeliveryTerms(times,magnitudes,Ta,t_grid))
+
+    if infusions :
+        owners,starts,ends,magnitudes,Ta = (np.concatenate(x) for x in zip(*infusions))
+        AddTerms(owners,InfusionTerms(starts,ends,magnitudes,Ta,t_grid))
+
+    return result
@@ -0,0 +1,113 @@
+import numpy as np
+
+#------------------------------------------------------------------
+class IntervalIndex :
+    #
+    # A sorted index over the intervals of validity (iov_0_utc,iov_1_utc) of a list
+    # of events, for "which events overlap [t0,t1]" queries.
+    #
+    # The events are split into tiers by duration (powers of two in seconds). Within
+    # a tier the start times are sorted, and no event is longer than the tier's
+    # maximum duration, so the candidates for a window are one contiguous slice
+    # found by bisection. A query costs O(n_tiers * log(n)) plus the size of the answer.
+    #
+    # It behaves like the (read-mostly) list it was built from: len(), iteration
+    # and append() work as usual, and queries return events in their original order.
+    #
+    def __init__(self,events=[]) :
+        self.events = list(events)
+        self.dirty = True
+        return
+
+    def __len__(self) :
+        return len(self.events)
+
+    def __iter__(self) :
+        return iter(self.events)
+
+    def __getitem__(self,i) :
+        return self.events[i]
+
+    def append(self,event) :
+        self.events.append(event)
+        self.dirty = True
+        return
+
+    def Build(self) :
+        n = len(self.events)
+        starts = np.fromiter((e.iov_0_utc for e in self.events),dtype=np.float64,count=n)
+        ends   = np.fromiter((e.iov_1_utc for e in self.events),dtype=np.float64,count=n)
+        names  = list(e.__class__.__name__ for e in self.events)
+
+        # type codes, for filtering by type
+        self.typeCodes = dict((name,i) for i,name in enumerate(sorted(set(names))))
+        self.byType = dict((name,[]) for name in self.typeCodes.keys())
+        for e,name in zip(self.events,names) :
+            self.byType[name].append(e)
+        codes = np.fromiter((self.typeCodes[name] for name in names),dtype=np.int32,count=n)
+
+        # Tier by duration. Open-ended events (e.g. LiverBasalGlucose) get their own tier.
+        durations = ends - starts
+        finite = np.isfinite(durations)
+        tiers = np.full(n,-1,dtype=np.int32)
+        tiers[finite] = np.log2(np.maximum(durations[finite],0) + 1).astype(np.int32)
+
+        self.tiers = []
+        for tier in np.unique(tiers) :
+            positions = np.nonzero(tiers == tier)[0]
+            order = np.argsort(starts[positions],kind='stable')
+            positions = positions[order]
+            max_duration = float('inf') if (tier < 0) else durations[positions].max()
+            self.tiers.append((starts[positions],ends[positions],codes[positions],positions,max_duration))
+
+        self.dirty = False
+        return
+
+    def OverlappingIndices(self,time_start,time_end,type_names=None) :
+        # Positions (in the original list, sorted) of events with
+        # iov_0_utc <= time_end and iov_1_utc >= time_start
+        if self.dirty :
+            self.Build()
+
+        codes_wanted = None
+        if type_names is not None :
+            if type(type_names) == type('') :
+                type_names = [type_names]
+            codes_wanted = list(self.typeCodes[name] for name in type_names if name in self.typeCodes.keys())
+            if not codes_wanted :
+                return np.zeros(0,dtype=np.intp)
+
+        result = []
+        for starts,ends,codes,positions,max_duration in self.tiers :
+            lo = np.searchsorted(starts,time_start - max_duration,side='left')
+            hi = np.searchsorted(starts,time_end,side='right')
+            if hi <= lo :
+                continue
+
+            mask = ends[lo:hi] >= time_start
+            if codes_wanted is not None :
+                mask &= np.isin(codes[lo:hi],codes_wanted)
+            result.append(positions[lo:hi][mask])
+
+        if not result :
+            return np.zeros(0,dtype=np.intp)
+
+        return np.sort(np.concatenate(result))
+
+    def Overlapping(self,time_start,time_end,type_names=None) :
+        return list(self.events[i] for i in self.OverlappingIndices(time_start,time_end,type_names))
+
+    def ActiveAt(self,time_ut,type_names=None) :
+        # Events with iov_0_utc <= time_ut <= iov_1_utc
+        return self.Overlapping(time_ut,time_ut,type_names)
+
+    def OfType(self,type_names) :
+        # Events of the given type(s), in their original order
+        if self.dirty :
+            self.Build()
+
+        if type(type_names) == type('') :
+            return list(self.byType.get(type_names,[]))
+
+        positions = self.OverlappingIndices(-float('inf'),float('inf'),type_names)
+        return list(self.events[i] for i in positions)
@@ -0,0 +1,211 @@
+import sys
+from time import perf_counter
+from .BGIntegrals import *
+
+#------------------------------------------------------------------
+#
+# Opt-in instrumentation of the model evaluation: where does the time go?
+#
+#     with Profiler() as profiler :
+#         fitter.Fit()
+#     print(profiler.Table())
+#     profiler.Report()   # OrderedDict: 'methods' {name:{'calls','time_s'}}, 'objects' {name:count}
+#
+# While enabled, the methods and functions listed below are replaced by wrappers that
+# count the calls and add up the wall time (inclusive of what they call; a recursive
+# call is only timed once). The construction of every event is counted too, by class,
+# and by the profiled method that made it (e.g. the mini-boluses of MakeMiniBoluses).
+# Disable() puts the originals back, so a disabled profiler costs nothing at all.
+# The functions are replaced in every module of the package, since the modules have
+# their own (star-imported) references to them.
+#
+
+# (class name, method name)
+profiledMethods = [('BGEventBase'       ,'GetUtcFromString'),
+                   ('LocalTimeBinning'  ,'LocalSeconds'),
+                   ('LocalTimeBinning'  ,'LocalToUtc'),
+                   ('BasalInsulin'      ,'__init__'),
+                   ('SquareWaveBolus'   ,'MakeMiniBoluses'),
+                   ('LiverBasalGlucose' ,'getSmearedList'),
+                   ('ExerciseEffect'    ,'getMagnitudeOfBGEffect'),
+                   ]
+
+# Every class that has its own getIntegral / getBGEffectDerivPerHour
+profiledEventMethods = ['getIntegral','getBGEffectDerivPerHour']
+
+profiledFunctions = ['InsulinActionCurve',
+                     'InsulinActionCurveDerivative',
+                     'InsulinActionCurveArray',
+                     'InsulinActionCurveDerivativeArray',
+                     'InsulinActionCurveIntegral',
+                     'InsulinActionCurveIntegralArray',
+                     'BandedSum',
+                     ]
+
+# The profiler that is enabled (only one at a time)
+activeProfiler = None
+
+#------------------------------------------------------------------
+def EventClasses() :
+    # BGEventBase and all of its subclasses
+    classes = [BGEventBase]
+    for cls in classes :
+        classes += list(c for c in cls.__subclasses__() if c not in classes)
+    return classes
+
+#------------------------------------------------------------------
+class Profiler :
+
+    def __init__(self) :
+        self.patches = []
+        self.Reset()
+        return
+
+    def Reset(self) :
+        self.calls = OrderedDict()
+        self.times = OrderedDict()
+        self.objects = OrderedDict()
+        self.depth = dict()
+        self.stack = []
+        return
+
+    def __enter__(self) :
+        self.Enable()
+        return self
+
+    def __exit__(self,*args) :
+        self.Disable()
+        return False
+
+    def Enabled(self) :
+        return activeProfiler is self
+
+    def Timed(self,name,function) :
+        # function, counting its calls and adding up its time under name
+        calls,times,depth,stack = self.calls,self.times,self.depth,self.stack
+        calls[name] = calls.get(name,0)
+        times[name] = times.get(name,0.)
+
+        def Wrapped(*args,**kwargs) :
+            calls[name] += 1
+            if depth.get(name,0) :
+                return function(*args,**kwargs)
+
+            depth[name] = 1
+            stack.append(name)
+            start = perf_counter()
+            try :
+                return function(*args,**kwargs)
+            finally :
+                times[name] += perf_counter() - start
+                stack.pop()
+                depth[name] = 0
+
+        Wrapped.__name__ = function.__name__
+        Wrapped.__doc__ = function.__doc__
+        Wrapped.__wrapped__ = function
+        return Wrapped
+
+    def Counted(self,cls,init) :
+        # cls.__init__, counting the objects of cls (not of its subclasses) that are made
+        objects,stack = self.objects,self.stack
+        name = cls.__name__
+
+        def Wrapped(obj,*args,**kwargs) :
+            if type(obj) is cls :
+                objects[name] = objects.get(name,0) + 1
+                if stack :
+                    key = '%s <- %s'%(name,stack[-1])
+                    objects[key] = objects.get(key,0) + 1
+            return init(obj,*args,**kwargs)
+
+        Wrapped.__name__ = init.__name__
+        Wrapped.__wrapped__ = init
+        return Wrapped
+
+    def Patch(self,owner,attribute,replacement) :
+        # Replace owner.attribute (remembering how to put it back)
+        self.patches.append((owner,attribute,vars(owner).get(attribute,missing)))
+        setattr(owner,attribute,replacement)
+        return
+
+    def PatchMethod(self,cls,attribute,name) :
+        original = cls.__dict__[attribute]
+        if isinstance(original,staticmethod) :
+            self.Patch(cls,attribute,staticmethod(self.Timed(name,original.__func__)))
+        elif isinstance(original,classmethod) :
+            self.Patch(cls,attribute,classmethod(self.Timed(name,original.__func__)))
+        else :
+            self.Patch(cls,attribute,self.Timed(name,original))
+        return
+
+    def Enable(self) :
+        global activeProfiler
+        if activeProfiler is self :
+            return
+        if activeProfiler is not None :
+            raise ValueError('Profiler: another profiler is enabled')
+
+        classes = OrderedDict((cls.__name__,cls) for cls in EventClasses())
+        classes['LocalTimeBinning'] = LocalTimeBinning
+
+        for class_name,attribute in profiledMethods :
+            self.PatchMethod(classes[class_name],attribute,'%s.%s'%(class_name,attribute))
+
+        for attribute in profiledEventMethods :
+            for class_name,cls in classes.items() :
+                if attribute in cls.__dict__ :
+                    self.PatchMethod(cls,attribute,'%s.%s'%(class_name,attribute))
+
+        # (after the methods, so that the timed BasalInsulin.__init__ is counted too)
+        for class_name,cls in classes.items() :
+            if issubclass(cls,BGEventBase) :
+                self.Patch(cls,'__init__',self.Counted(cls,cls.__init__))
+
+        package = __name__.rpartition('.')[0]
+        modules = list(m for name,m in sys.modules.items() if (m is not None) and (name == package or name.startswith(package+'.')))
+        for function_name in profiledFunctions :
+            original = globals()[function_name]
+            timed = self.Timed(function_name,original)
+            for module in modules :
+                if vars(module).get(function_name) is original :
+                    self.Patch(module,function_name,timed)
+
+        activeProfiler = self
+        return
+
+    def Disable(self) :
+        global activeProfiler
+        if activeProfiler is not self :
+            return
+
+        for owner,attribute,original in reversed(self.patches) :
+            if original is missing :
+                delattr(owner,attribute)
+            else :
+                setattr(owner,attribute,original)
+        self.patches = []
+        self.depth.clear()
+        del self.stack[:]
+
+        activeProfiler = None
+        return
+
+    def Report(self) :
+        # The calls and the time of each profiled method (that was called), and the objects made
+        methods = OrderedDict()
+        for name in sorted(self.calls.keys(),key=lambda x : -self.times[x]) :
+            if self.calls[name] :
+                methods[name] = OrderedDict([('calls',self.calls[name]),('time_s',self.times[name])])
+        return OrderedDict([('methods',methods),('objects',OrderedDict(sorted(self.objects.items())))])
+
+    def Table(self) :
+        report = self.Report()
+        lines = ['%-45s %10s %12s %12s'%('Method','Calls','Total (s)','Per call (us)')]
+        for name,entry in report['methods'].items() :
+            lines.append('%-45s %10d %12.4f %12.2f'%(name,entry['calls'],entry['time_s'],1e6*entry['time_s']/entry['calls']))
+        lines.append('')
+        lines.append('%-45s %10s'%('Objects made','Count'))
+        for name,count in report['objects'].items() :
+            lines.append('%-45s %10d'%(name,count))
+        return '\n'.join(lines)
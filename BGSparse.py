@@ -0,0 +1,136 @@
+import numpy as np
+
+#------------------------------------------------------------------
+#
+# Sparse matrices for the profile fit (see BGFitter), in pure numpy.
+#
+# Each BG measurement window (between consecutive measurements) only sees the deliveries
+# of the last saturationTime_Ta * Ta hours, and so only the profile bins of those deliveries
+# (plus a few liver bins): the design matrix is mostly zeros. CSRBuilder adds up (flat index,
+# value) terms, like the np.bincount of the dense fit, but keeps only the nonzero entries,
+# summing duplicates every so often so that the memory stays of the order of the nonzeros:
+#
+#     builder = CSRBuilder(nrows,ncols)
+#     builder.Add(rows*ncols + columns,values)
+#     X = builder.Build()      # CSRMatrix
+#     X.dot(theta)             # like numpy: X theta
+#     X.TransposeDot(r)        # X^T r
+#     X.ToScipy()              # a scipy.sparse.csr_matrix (if scipy is installed)
+#
+# CGLS solves least-squares problems with only these two products.
+#
+
+#------------------------------------------------------------------
+class CSRMatrix :
+    #
+    # A compressed sparse row matrix: the nonzeros of row i are data[indptr[i]:indptr[i+1]],
+    # in the columns indices[indptr[i]:indptr[i+1]] (sorted).
+    #
+    def __init__(self,data,indices,indptr,shape) :
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.shape = tuple(shape)
+
+        # The row of each nonzero (for the products)
+        self.rows = np.repeat(np.arange(self.shape[0],dtype=np.int32),np.diff(indptr))
+        return
+
+    @classmethod
+    def FromFlat(cls,flat,values,shape) :
+        # From (row*ncols + column) indices; the duplicates are added up
+        nrows,ncols = shape
+        flat,inverse = np.unique(flat,return_inverse=True)
+        data = np.bincount(inverse.ravel(),weights=values,minlength=len(flat))
+
+        rows = flat//ncols
+        indptr = np.concatenate([[0],np.cumsum(np.bincount(rows,minlength=nrows))])
+        return cls(data,(flat - rows*ncols).astype(np.int32),indptr,shape)
+
+    @property
+    def nnz(self) :
+        return len(self.data)
+
+    def dot(self,x) :
+        # X x
+        return np.bincount(self.rows,weights=self.data*x[self.indices],minlength=self.shape[0])
+
+    def TransposeDot(self,y) :
+        # X^T y
+        return np.bincount(self.indices,weights=self.data*y[self.rows],minlength=self.shape[1])
+
+    def ColumnNorms(self) :
+        return np.sqrt(np.bincount(self.indices,weights=self.data**2,minlength=self.shape[1]))
+
+    def ToDense(self) :
+        dense = np.zeros(self.shape)
+        dense[self.rows,self.indices] = self.data
+        return dense
+
+    def ToScipy(self) :
+        import scipy.sparse
+        return scipy.sparse.csr_matrix((self.data,self.indices,self.indptr),shape=self.shape)
+
+#------------------------------------------------------------------
+class CSRBuilder :
+    #
+    # Adds up terms into an (nrows x ncols) matrix, keeping only the nonzero entries.
+    #
+    def __init__(self,nrows,ncols,max_pending=1<<20) :
+        self.shape = (nrows,ncols)
+        self.max_pending = max_pending
+        self.flat = np.zeros(0,dtype=np.int64)
+        self.values = np.zeros(0)
+        self.pending = []
+        self.npending = 0
+        return
+
+    def Add(self,flat,values) :
+        keep = (values != 0)
+        self.pending.append((np.asarray(flat,dtype=np.int64)[keep],values[keep]))
+        self.npending += np.count_nonzero(keep)
+        if self.npending > self.max_pending :
+            self.Compact()
+        return
+
+    def Compact(self) :
+        # Sum the duplicates
+        if not self.pending :
+            return
+        flat = np.concatenate([self.flat] + list(p[0] for p in self.pending))
+        values = np.concatenate([self.values] + list(p[1] for p in self.pending))
+        self.flat,inverse = np.unique(flat,return_inverse=True)
+        self.values = np.bincount(inverse.ravel(),weights=values,minlength=len(self.flat))
+        self.pending = []
+        self.npending = 0
+        return
+
+    def Build(self) :
+        self.Compact()
+        return CSRMatrix.FromFlat(self.flat,self.values,self.shape)
+
+#------------------------------------------------------------------
+def CGLS(Multiply,MultiplyTranspose,b,x0,tol=1e-10,maxiter=1000) :
+    # Conjugate gradients on the normal equations: the x minimizing |A x - b|, using
+    # only Multiply(x) = A x and MultiplyTranspose(y) = A^T y. Starts from x0, and stops
+    # when |A^T (b - A x)| has dropped by tol (or after maxiter iterations).
+    x = np.array(x0,dtype=np.float64)
+    r = b - Multiply(x)
+    s = MultiplyTranspose(r)
+    p = s.copy()
+    gamma = np.dot(s,s)
+    stop = (tol**2)*gamma
+
+    for iteration in range(maxiter) :
+        if gamma <= stop or gamma == 0 :
+            break
+        q = Multiply(p)
+        alpha = gamma/np.dot(q,q)
+        x += alpha*p
+        r -= alpha*q
+        s = MultiplyTranspose(r)
+        gamma_new = np.dot(s,s)
+        p = s + (gamma_new/gamma)*p
+        gamma = gamma_new
+
+    return x
@@ -0,0 +1,228 @@
+from .BGActionClasses import *
+from collections import OrderedDict
+
+#------------------------------------------------------------------
+#
+# Whole-timeline BG prediction.
+#
+# Every event contributes a cumulative BG effect Phi(t), and the predicted BG is
+#     BG(t) = BG(t_ref) + sum_events [ Phi(t) - Phi(t_ref) ]
+# (which is the sum of event.getIntegral(t_ref,t) for t >= t_ref).
+#
+# Point deliveries (boluses, food, basal deliveries, ...) only change within a
+# band of saturationTime_Ta * Ta after delivery, after which their effect is constant.
+# So only the band is evaluated explicitly, and the constant "tail" is added with
+# one cumulative sum over the grid.
+#
+
+#------------------------------------------------------------------
+def BandChunks(k0,k1,max_chunk=2000000) :
+    # For events with bands of grid indices [k0,k1), yields flat arrays of (grid indices,
+    # event indices) covering all of the bands, a chunk of events at a time to limit the memory
+    lengths = k1 - k0
+    cumulative = np.concatenate([[0],np.cumsum(lengths)])
+    first = 0
+    while first < len(lengths) :
+        last = max(np.searchsorted(cumulative,cumulative[first] + max_chunk,side='right') - 1,first + 1)
+
+        ev = np.repeat(np.arange(first,last),lengths[first:last])
+        idx = k0[ev] + np.arange(len(ev)) - (cumulative[ev] - cumulative[first])
+        if len(idx) :
+            yield idx,ev
+
+        first = last
+
+    return
+
+#------------------------------------------------------------------
+def BandedSum(band_starts,band_ends,tails,values,t_grid,max_chunk=2000000) :
+    # For each event i, add values(grid indices, i) on the grid points in [band_starts, band_ends],
+    # and the constant tails[i] on every grid point after band_ends. t_grid must be sorted.
+    # values(idx,ev) gets flat arrays of grid indices and event indices, and returns the values.
+    n_grid = len(t_grid)
+    result = np.zeros(n_grid)
+    if not len(band_starts) :
+        return result
+
+    k0 = np.searchsorted(t_grid,band_starts,side='left')
+    k1 = np.searchsorted(t_grid,band_ends,side='right')
+
+    # The tails
+    result += np.cumsum(np.bincount(k1,weights=tails,minlength=n_grid+1)[:n_grid])
+
+    # The bands
+    for idx,ev in BandChunks(k0,k1,max_chunk) :
+        result += np.bincount(idx,weights=values(idx,ev),minlength=n_grid)
+
+    return result
+
+#------------------------------------------------------------------
+def DeliveryTerms(times,magnitudes,Ta,t_grid) :
+    # The (band_starts, band_ends, tails, values) of point deliveries, for BandedSum:
+    # magnitude_i * InsulinActionCurve(t - time_i, Ta_i)
+    times = np.asarray(times,dtype=np.float64)
+    magnitudes = np.asarray(magnitudes,dtype=np.float64)
+    Ta = np.asarray(Ta,dtype=np.float64)
+
+    def values(idx,ev) :
+        return magnitudes[ev] * InsulinActionCurveArray((t_grid[idx] - times[ev])/3600.,Ta[ev])
+
+    band_ends = times + saturationTime_Ta*Ta*3600.
+    return times,band_ends,magnitudes,values
+
+#------------------------------------------------------------------
+def InfusionTerms(starts,ends,magnitudes,Ta,t_grid) :
+    # Same, for constant infusions from start_i to end_i (magnitudes are per hour of infusion)
+    starts = np.asarray(starts,dtype=np.float64)
+    ends = np.asarray(ends,dtype=np.float64)
+    magnitudes = np.asarray(magnitudes,dtype=np.float64)
+    Ta = np.asarray(Ta,dtype=np.float64)
+
+    def values(idx,ev) :
+        G_start = InsulinActionCurveIntegralArray((t_grid[idx] - starts[ev])/3600.,Ta[ev])
+        G_end   = InsulinActionCurveIntegralArray((t_grid[idx] - ends[ev]  )/3600.,Ta[ev])
+        return magnitudes[ev] * (G_start - G_end)
+
+    band_ends = ends + saturationTime_Ta*Ta*3600.
+    tails = magnitudes * (ends - starts)/3600.
+    return starts,band_ends,tails,values
+
+#------------------------------------------------------------------
+def CumulativeEffectOfDeliveries(times,magnitudes,Ta,t_grid) :
+    # sum_i magnitude_i * InsulinActionCurve(t - time_i, Ta_i), at each (sorted) grid time
+    return BandedSum(*DeliveryTerms(times,magnitudes,Ta,t_grid),t_grid=t_grid)
+
+#------------------------------------------------------------------
+def CumulativeEffectOfInfusions(starts,ends,magnitudes,Ta,t_grid) :
+    # Same, for constant infusions from start_i to end_i (magnitudes are per hour of infusion)
+    return BandedSum(*InfusionTerms(starts,ends,magnitudes,Ta,t_grid),t_grid=t_grid)
+
+#------------------------------------------------------------------
+class BGTimeline :
+    #
+    # The predicted BG trace over a time grid, given the events, the TrueUserProfile
+    # and a starting BGMeasurement:
+    #
+    #     timeline = BGTimeline(events,the_userprofile,t_grid)
+    #     timeline.bg                              # predicted BG at each time in t_grid
+    #     timeline.contributions['InsulinBolus']   # the part coming from each event type
+    #
+    # If startBG is not given, the firstBG (or else the earliest) BGMeasurement is used.
+    # Without any measurement, the trace is relative to the first grid time (starting at 0).
+    #
+    def __init__(self,events,settings,t_grid,startBG=None) :
+        self.times = np.asarray(t_grid,dtype=np.float64)
+        if np.any(np.diff(self.times) < 0) :
+            raise ValueError('BGTimeline: the time grid must be sorted')
+
+        if startBG is None :
+            startBG = findFirstBG(events)
+        if startBG is None :
+            measurements = list(e for e in events if e.IsMeasurement())
+            if measurements :
+                startBG = min(measurements,key=lambda x: x.iov_0_utc)
+
+        self.startBG = startBG
+        if startBG is not None :
+            self.time_ref = startBG.iov_0_utc
+            self.BG_ref = startBG.const_BG
+        else :
+            self.time_ref = self.times[0] if len(self.times) else 0
+            self.BG_ref = 0
+
+        self.contributions = OrderedDict()
+        self.MakeContributions(events,settings)
+
+        self.bg = np.full(len(self.times),float(self.BG_ref))
+        for curve in self.contributions.values() :
+            self.bg += curve
+
+        return
+
+    def AddContribution(self,type_name,curve) :
+        if type_name not in self.contributions.keys() :
+            self.contributions[type_name] = np.zeros(len(self.times))
+        self.contributions[type_name] += curve
+        return
+
+    def MakeContributions(self,events,settings) :
+        # Collect the point deliveries and infusions of each event type, to do them all at once
+        deliveries = OrderedDict()
+        infusions = OrderedDict()
+
+        for e in events :
+            if not getattr(e,'affectsBG',False) :
+                continue
+
+            type_name = e.__class__.__name__
+
+            if hasattr(e,'getDeliveries') :
+                deliveries.setdefault(type_name,[]).append(e.getDeliveries(settings))
+                if hasattr(e,'getInfusions') :
+                    infusions.setdefault(type_name,[]).append(e.getInfusions(settings))
+
+            elif e.IsBasalGlucose() :
+                self.AddContribution(type_name,self.LiverBasalGlucoseCurve(e,settings))
+
+            elif e.IsExercise() :
+                self.AddContribution(type_name,self.ExerciseCurve(e,settings))
+
+            else :
+                self.AddContribution(type_name,self.GenericCurve(e,settings))
+
+        time_ref = np.array([self.time_ref],dtype=np.float64)
+
+        for type_name in deliveries.keys() :
+            times,magnitudes,Ta = (np.concatenate(x) for x in zip(*deliveries[type_name]))
+            curve = CumulativeEffectOfDeliveries(times,magnitudes,Ta,self.times)
+            curve -= CumulativeEffectOfDeliveries(times,magnitudes,Ta,time_ref)[0]
+            self.AddContribution(type_name,curve)
+
+        for type_name in infusions.keys() :
+            starts,ends,magnitudes,Ta = (np.concatenate(x) for x in zip(*infusions[type_name]))
+            curve = CumulativeEffectOfInfusions(starts,ends,magnitudes,Ta,self.times)
+            curve -= CumulativeEffectOfInfusions(starts,ends,magnitudes,Ta,time_ref)[0]
+            self.AddContribution(type_name,curve)
+
+        return
+
+    def LiverBasalGlucoseCurve(self,liver,settings) :
+        # The bins are aligned to the midnight of the reference day (like liver.getIntegral(time_ref,t))
+        liver.getSmearedList(settings)
+        midnight = timeOfDay.Midnight(self.time_ref)
+        return liver.getCumulativeIntegralArray(self.times - midnight) - liver.getCumulativeIntegral(self.time_ref - midnight)
+
+    def ExerciseCurve(self,exercise,settings) :
+        # The exercise integral is clamped to its own window, so it is constant outside of it:
+        # Phi(t) = getIntegral(iov_0, t) for t in the window.
+        def Phi(times) :
+            clamped = np.clip(times,exercise.iov_0_utc,exercise.iov_1_utc)
+            unique,inverse = np.unique(clamped,return_inverse=True)
+            values = np.array(list(exercise.getIntegral(exercise.iov_0_utc,t,settings) for t in unique))
+            return values[inverse].reshape(np.shape(times))
+
+        return Phi(self.times) - Phi(np.array([self.time_ref]))[0]
+
+    def GenericCurve(self,event,settings) :
+        # Slow path, for events without a vectorized form: one getIntegral per grid time
+        curve = np.zeros(len(self.times))
+        for i,t in enumerate(self.times) :
+            if t >= self.time_ref :
+                curve[i] = event.getIntegral(self.time_ref,t,settings)
+            else :
+                curve[i] = -event.getIntegral(t,self.time_ref,settings)
+        return curve
+
+    def GetBG(self,type_names=None) :
+        # The predicted BG, optionally from only some of the event types
+        if type_names is None :
+            return self.bg
+
+        if type(type_names) == type('') :
+            type_names = [type_names]
+
+        bg = np.full(len(self.times),float(self.BG_ref))
+        for type_name in type_names :
+            if type_name in self.contributions.keys() :
+                bg += self.contributions[type_name]
+        return bg
@@ -0,0 +1,254 @@
+#
+# Benchmarks of the model evaluation, on synthetic patient histories.
+#
+# Run from the directory containing the package, e.g.:
+#     python -m BGModel.Benchmarks --days 1 30 365 --output bgmodel_benchmarks.json
+#
+# Each run is appended to the output json file (with the git commit, if available),
+# so that regressions show up when comparing runs across versions.
+#
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import subprocess
+import contextlib
+import io
+from .BGTimeline import *
+from .BGProfiling import Profiler
+
+#------------------------------------------------------------------
+def MakeSyntheticProfile(start='2019-02-24 00:00:00') :
+    # A TrueUserProfile and the pump settings it was made from (as in the demonstration notebook)
+
+    user_settings = OrderedDict()
+    for name,values in [('Sensitivity',[(0,60),(12,50),(18,40)]),
+                        ('RIC'        ,[(0,15),(11,12)]),
+                        ('Duration'   ,[(0,3.0)]),
+                        ('Basal'      ,[(0,1.0),(5,0.8),(6,1.1),(12,2.0),(18,1.3),(21.5,0.9)])] :
+        user_settings[name] = UserSetting(name)
+        user_settings[name].getOrMakeSettingsSnapshot(start)
+        for hour,value in values :
+            user_settings[name].AddSettingToSnapshot(start,hour,value)
+
+    profile = TrueUserProfile()
+    profile.AddSensitivityFromArrays(user_settings['Sensitivity'].latestSettingsSnapshot(),
+                                     user_settings['RIC'].latestSettingsSnapshot())
+    profile.AddHourlyGlucoseFromArrays(user_settings['Basal'].latestSettingsSnapshot(),
+                                       user_settings['Duration'].latestSettingsSnapshot())
+
+    return profile,user_settings
+
+#------------------------------------------------------------------
+def MakeSyntheticHistory(ndays,seed=0,start='2019-02-24 00:00:00') :
+    # Pump events for ndays: meals with boluses (and some square and dual waves),
+    # corrections, temp basals, suspends, exercise and hourly BG measurements.
+    # Returns the start time and the list of events (without the basal).
+    rnd = random.Random(seed)
+    time_start = BGEventBase.GetUtcFromString(start)
+
+    events = []
+    for day in range(ndays) :
+        midnight = time_start + day*86400
+
+        for meal_hr in [7.5,12.5,19] :
+            t = midnight + int((meal_hr + rnd.uniform(-1,1))*3600)
+            food = Food(t,rnd.uniform(15,90))
+            if rnd.random() < 0.2 :
+                food.Ta = rnd.choice([1.5,3.])
+            events.append(food)
+
+            kind = rnd.random()
+            if kind < 0.1 :
+                events.append(SquareWaveBolus(t,rnd.choice([2,3,4]),rnd.uniform(1,4)))
+            elif kind < 0.2 :
+                events.append(DualWaveBolus(t,rnd.choice([2,3,4]),rnd.uniform(1,3),rnd.uniform(1,3)))
+            else :
+                events.append(InsulinBolus(t,rnd.uniform(1,8)))
+
+        if rnd.random() < 0.5 :
+            events.append(InsulinBolus(midnight + rnd.randint(0,86399),rnd.uniform(0.5,2)))
+
+        if rnd.random() < 0.3 :
+            t = midnight + rnd.randint(0,20*3600)
+            events.append(TempBasal(t,t + rnd.choice([1,2,4])*3600,rnd.choice([0.5,0.8,1.2,1.5])))
+
+        if rnd.random() < 0.1 :
+            t = midnight + rnd.randint(0,22*3600)
+            events.append(Suspend(t,t + 3600))
+
+        for hour in range(24) :
+            t = midnight + hour*3600
+            events.append(BGMeasurement(t,t + 3600,rnd.uniform(70,250)))
+
+    events.sort(key=lambda x: x.iov_0_utc)
+
+    # Exercise every third day, affecting the insulin
+    for day in range(0,ndays,3) :
+        t = time_start + day*86400 + 17*3600
+        events.append(ExerciseEffect(t,t + 3600,0.3))
+
+    return time_start,events
+
+#------------------------------------------------------------------
+def MakeBasal(time_start,ndays,events,user_settings) :
+    # (BasalInsulin prints the LiverFattyGlucose events it makes)
+    with contextlib.redirect_stdout(io.StringIO()) :
+        basal = BasalInsulin(time_start,time_start + ndays*86400,
+                             user_settings['Basal'].latestSettingsSnapshot(),
+                             user_settings['Sensitivity'].latestSettingsSnapshot(),
+                             containers=events)
+    return basal
+
+#------------------------------------------------------------------
+def TimeIt(function,repeat=3) :
+    # Best wall time (seconds) of repeat calls (each one without the cached results of the previous one)
+    best = float('inf')
+    for i in range(repeat) :
+        resultCache.Clear()
+        start = time.perf_counter()
+        function()
+        best = min(best,time.perf_counter() - start)
+    return best
+
+#------------------------------------------------------------------
+def RunBenchmarks(ndays,repeat=3,nqueries=50,seed=0) :
+    # Returns a list of {'name','days','calls','seconds'} results for one history length
+
+    profile,user_settings = MakeSyntheticProfile()
+    time_start,events = MakeSyntheticHistory(ndays,seed)
+
+    results = []
+    def Record(name,calls,function) :
+        seconds = TimeIt(function,repeat)
+        results.append({'name':name,'days':ndays,'calls':calls,'seconds':seconds})
+        print('%-55s %4d days %6d calls %10.4f s'%(name,ndays,calls,seconds))
+        return
+
+    Record('BasalInsulin.__init__',1,lambda : MakeBasal(time_start,ndays,list(events),user_settings))
+
+    basal = MakeBasal(time_start,ndays,events,user_settings)
+    events.append(basal)
+    for c in events :
+        if c.IsExercise() :
+            c.LoadContainers(events)
+
+    liver = LiverBasalGlucose()
+    events.append(liver)
+
+    rnd = random.Random(seed)
+    query_times = sorted(time_start + rnd.uniform(0,ndays*86400) for i in range(nqueries))
+
+    # Group the events by type
+    by_type = OrderedDict()
+    for c in events :
+        if c.affectsBG :
+            by_type.setdefault(c.__class__.__name__,[]).append(c)
+
+    for type_name,type_events in by_type.items() :
+        ncalls = len(type_events)*len(query_times)
+
+        def Integrals() :
+            for t in query_times :
+                for c in type_events :
+                    c.getIntegral(t,t + 3600.,profile)
+        Record('%s.getIntegral'%(type_name),ncalls,Integrals)
+
+        def Derivatives() :
+            for t in query_times :
+                for c in type_events :
+                    c.getBGEffectDerivPerHour(t,profile)
+        Record('%s.getBGEffectDerivPerHour'%(type_name),ncalls,Derivatives)
+
+        if not hasattr(type_events[0],'BGEffectRemaining') :
+            continue
+
+        def Remaining() :
+            for t in query_times :
+                for c in type_events :
+                    c.BGEffectRemaining(t,profile)
+        Record('%s.BGEffectRemaining'%(type_name),ncalls,Remaining)
+
+    exercises = by_type.get('ExerciseEffect',[])
+    def Magnitudes() :
+        for c in exercises :
+            c.getMagnitudeOfBGEffect(profile)
+    Record('ExerciseEffect.getMagnitudeOfBGEffect',len(exercises),Magnitudes)
+
+    windows = list((t,t + rnd.choice([0.1,1,6,24,24*7])*3600.) for t in query_times)
+    def LiverIntegrals() :
+        for t0,t1 in windows :
+            liver.getIntegral(t0,t1,profile)
+    Record('LiverBasalGlucose.getIntegral (mixed windows)',len(windows),LiverIntegrals)
+
+    grid = np.arange(time_start,time_start + ndays*86400,300.)
+    Record('BGTimeline (5-minute grid)',1,lambda : BGTimeline(events,profile,grid))
+
+    # The action curve, exact (math.pow, or numpy) and from the interpolation tables
+    curve_times = list(rnd.uniform(-1,20) for i in range(10000))
+    curve_array = np.array(curve_times*100)
+    Record('InsulinActionCurve (exact)',len(curve_times),lambda : list(InsulinActionCurve(t,3.) for t in curve_times))
+    Record('InsulinActionCurveArray (exact)',len(curve_array),lambda : InsulinActionCurveArray(curve_array,3.))
+    for mode in ActionCurveTable.modes :
+        Record('InsulinActionCurve (%s table)'%(mode),len(curve_times),lambda : list(InsulinActionCurve(t,3.,mode) for t in curve_times))
+        Record('InsulinActionCurveArray (%s table)'%(mode),len(curve_array),lambda : InsulinActionCurveArray(curve_array,3.,mode))
+
+        previous = SetActionCurveMode(mode)
+        Record('BGTimeline (5-minute grid, %s table)'%(mode),1,lambda : BGTimeline(events,profile,grid))
+        SetActionCurveMode(previous)
+
+    return results
+
+#------------------------------------------------------------------
+def GitCommit() :
+    try :
+        return subprocess.check_output(['git','rev-parse','--short','HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception :
+        return None
+
+#------------------------------------------------------------------
+def main(argv=None) :
+    parser = argparse.ArgumentParser(description='Benchmarks of the BG model evaluation.')
+    parser.add_argument('--days',type=int,nargs='+',default=[1,30,365],help='history lengths, in days')
+    parser.add_argument('--repeat',type=int,default=3,help='repetitions (the best time is kept)')
+    parser.add_argument('--queries',type=int,default=50,help='query times per benchmark')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--label',default=None,help='a label for this run (e.g. a version)')
+    parser.add_argument('--output',default='bgmodel_benchmarks.json',help='json file the run is appended to')
+    parser.add_argument('--profile',action='store_true',help='also print the calls and time per method (the timings then include its overhead)')
+    args = parser.parse_args(argv)
+
+    run = {'label':args.label,
+           'commit':GitCommit(),
+           'date':time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python':platform.python_version(),
+           'numpy':np.__version__,
+           'results':[]}
+
+    # (the profiler is disabled again even if a benchmark fails)
+    profiler = Profiler()
+    with (profiler if args.profile else contextlib.nullcontext()) :
+        for ndays in args.days :
+            run['results'] += RunBenchmarks(ndays,args.repeat,args.queries,args.seed)
+
+    if args.profile :
+        print(profiler.Table())
+        run['profile'] = profiler.Report()
+
+    runs = []
+    if os.path.exists(args.output) :
+        with open(args.output) as f :
+            runs = json.load(f)
+    runs.append(run)
+    with open(args.output,'w') as f :
+        json.dump(runs,f,indent=1)
+
+    print('Results appended to %s'%(args.output))
+    return
+
+if __name__ == '__main__' :
+    main()
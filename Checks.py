@@ -0,0 +1,208 @@
+#
+# Consistency checks of the model, on synthetic patient histories (see Benchmarks).
+#
+# Run from the directory containing the package, e.g.:
+#     python -m BGModel.Checks --days 40
+#
+# Each check raises an AssertionError (with the discrepancy) if it fails.
+#
+import shutil
+import argparse
+import tempfile
+from .Benchmarks import *
+from .BGBatch import *
+from .BGActiveEffect import *
+
+#------------------------------------------------------------------
+def MakeSyntheticPatient(ndays,seed=0) :
+    # The events (with the basal, liver and exercise set up), the profile and the settings
+    profile,user_settings = MakeSyntheticProfile()
+    time_start,events = MakeSyntheticHistory(ndays,seed)
+    events.append(MakeBasal(time_start,ndays,events,user_settings))
+    events.append(LiverBasalGlucose())
+    for c in events :
+        if c.IsExercise() :
+            c.LoadContainers(events)
+    return time_start,events,profile,user_settings
+
+#------------------------------------------------------------------
+def MakeSyntheticPatientTwoSnapshots(ndays,seed=0) :
+    # Like MakeSyntheticPatient, but the Basal and Sensitivity settings change halfway
+    # through the history, and the BasalInsulin is made in two parts (one per snapshot)
+    profile,user_settings = MakeSyntheticProfile()
+    time_start,events = MakeSyntheticHistory(ndays,seed)
+    time_half = time_start + (ndays//2)*86400
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(time_half))
+    for name,values in [('Sensitivity',[(0,45),(9,55),(20,35)]),
+                        ('Basal'      ,[(0,0.7),(7,1.4),(15,1.0),(22,0.6)])] :
+        user_settings[name].getOrMakeSettingsSnapshot(timestamp)
+        for hour,value in values :
+            user_settings[name].AddSettingToSnapshot(timestamp,hour,value)
+
+    with contextlib.redirect_stdout(io.StringIO()) :
+        for t0,t1 in [(time_start,time_half),(time_half,time_start + ndays*86400)] :
+            events.append(BasalInsulin(t0,t1,user_settings['Basal'].getValidSnapshotAtUtc(t0),
+                                       user_settings['Sensitivity'].getValidSnapshotAtUtc(t0),containers=events))
+    events.append(LiverBasalGlucose())
+    for c in events :
+        if c.IsExercise() :
+            c.LoadContainers(events)
+    return time_start,events,profile,user_settings
+
+#------------------------------------------------------------------
+def CheckBundleRoundTrip(ndays=40,seed=0,tolerance=1e-6) :
+    # PredictTask gives the same BG on the events as on UnpackBundle(PackBundle(...)) and on
+    # an archive bundle, also when the settings change during the history
+    count = lambda x : sum(1 for e in x if e.IsLiverFattyGlucose())
+    path = tempfile.mkdtemp()
+    try :
+        for make in [MakeSyntheticPatient,MakeSyntheticPatientTwoSnapshots] :
+            time_start,events,profile,user_settings = make(ndays,seed)
+            options = {'time_start':time_start,'time_end':time_start + ndays*86400}
+            serial = PredictTask(events,profile,user_settings,**options)
+
+            archive = os.path.join(path,'%s.bgarchive'%(make.__name__))
+            SaveArchive(archive,events,profile,user_settings)
+            bundles = [PackBundle(events,profile,user_settings,name='packed',**options),
+                       ArchiveBundle(archive,name='archive',**options)]
+
+            for bundle in bundles :
+                unpacked = UnpackBundle(bundle)
+                assert count(events) == count(unpacked[0]),'%s %s: %d LiverFattyGlucose events before, %d after'%(make.__name__,bundle['name'],count(events),count(unpacked[0]))
+
+                difference = np.max(np.abs(serial['bg'] - PredictTask(*unpacked,**options)['bg']))
+                assert difference < tolerance,'%s %s: PredictTask changed by %g mg/dL'%(make.__name__,bundle['name'],difference)
+
+        # Without the BasalInsulin in the archive, it cannot be rebuilt from the two snapshots
+        archive = os.path.join(path,'store.bgarchive')
+        SaveArchive(archive,EventStore.FromEvents(e for e in events if e.__class__.__name__ in eventColumns.keys()),profile,user_settings)
+        try :
+            UnpackBundle(ArchiveBundle(archive,**options))
+        except ValueError :
+            pass
+        else :
+            raise AssertionError('UnpackBundle rebuilt a BasalInsulin from a setting that changes')
+    finally :
+        shutil.rmtree(path)
+    return
+
+#------------------------------------------------------------------
+def StoredRows(events) :
+    # The stored columns of each event (with the numbers as floats), in a sorted list
+    def Value(x) :
+        return x if isinstance(x,str) else repr(float(x))
+    rows = list((e.__class__.__name__,) + tuple(sorted((k,Value(v)) for k,v in EventStore.EventToRow(e).items()))
+                for e in events if e.__class__.__name__ in eventColumns.keys())
+    return sorted(rows)
+
+#------------------------------------------------------------------
+def CheckStoreRoundTrip(ndays=40,seed=0) :
+    # The events come back the same from an EventStore and from a BGArchive (e.g. the
+    # analytic square waves stay analytic)
+    time_start,events = MakeSyntheticHistory(ndays,seed)
+    squares = list(e for e in events if type(e) is SquareWaveBolus)
+    for i,e in enumerate(squares) :
+        e.SetAnalytic(i%2 == 0)
+
+    before = StoredRows(events)
+    from_store = EventStore.FromEvents(events).GetEvents()
+    assert StoredRows(from_store) == before,'The events changed in an EventStore round trip'
+    analytic = list(e.analytic for e in from_store if type(e) is SquareWaveBolus)
+    assert sum(analytic) == (len(squares)+1)//2,'%d of %d square waves analytic after the round trip'%(sum(analytic),len(squares))
+
+    path = tempfile.mkdtemp()
+    try :
+        SaveArchive(os.path.join(path,'check.bgarchive'),events)
+        store,profile,user_settings = LoadArchive(os.path.join(path,'check.bgarchive'))
+        assert StoredRows(store.GetEvents()) == before,'The events changed in a BGArchive round trip'
+    finally :
+        shutil.rmtree(path)
+    return
+
+#------------------------------------------------------------------
+def CheckBinCaching(ndays=40,seed=0,tolerance=1e-9) :
+    # Changing one bin of the profile only recomputes the cached integrals that read it
+    time_start,events,profile,user_settings = MakeSyntheticPatient(ndays,seed)
+    cached = list(e for e in events if type(e) in [BasalInsulin,SquareWaveBolus])
+    windows = list((t,t + 3*3600.) for t in np.arange(time_start,time_start + ndays*86400,3*3600.).tolist())
+    resultCache.Clear()
+    for e in cached :
+        for t0,t1 in windows :
+            e.getIntegral(t0,t1,profile)
+
+    # The bins read by each integral, by the same rules as the events
+    maxTa = float(np.max(profile.InsulinTa))
+    def Reads(e,t0,t1) :
+        if type(e) is BasalInsulin :
+            return e.getSettingsBins(profile,*e.getIntegralRange(t0,t1,maxTa))
+        return e.getSettingsBins(profile)
+
+    changed = profile.getBinFromHourOfDay(3.)
+    profile.SetInsulinSensitivity(3.,1.1*profile.InsulinSensitivity[changed])
+    expected = sum(1 for e in cached for t0,t1 in windows if changed in list(Reads(e,t0,t1)))
+    assert 0 < expected < len(cached)*len(windows),'Expected %d of %d integrals to read bin %d'%(expected,len(cached)*len(windows),changed)
+
+    hits,misses = resultCache.hits,resultCache.misses
+    for e in cached :
+        for t0,t1 in windows :
+            value = e.getIntegral(t0,t1,profile)
+            difference = abs(value - e.getIntegralUncached(t0,t1,profile))
+            assert difference < tolerance,'Cached integral of %s off by %g'%(type(e).__name__,difference)
+
+    recomputed = resultCache.misses - misses
+    kept = resultCache.hits - hits
+    assert recomputed == expected,'%d integrals recomputed after changing bin %d, expected %d'%(recomputed,changed,expected)
+    assert kept == len(cached)*len(windows) - expected,'%d integrals kept'%(kept)
+    return
+
+#------------------------------------------------------------------
+def CheckExerciseCaching(ndays=40,seed=0,tolerance=1e-9) :
+    # The cached ExerciseEffect results follow in-place changes of the affected events
+    time_start,events,profile,user_settings = MakeSyntheticPatient(ndays,seed)
+    exercises = list(e for e in events if e.IsExercise() and e.affectedEvents)
+    def Uncached(e) :
+        return e.factor*sum(c.getIntegral(e.iov_0_utc,e.iov_1_utc,profile) for c in e.affectedEvents)
+
+    # (the exercise with a bolus, and the basal)
+    exercise = next(e for e in exercises if any(c.IsBolus() for c in e.affectedEvents))
+    bolus = next(c for c in exercise.affectedEvents if c.IsBolus())
+    basal = next(c for c in events if c.IsBasalInsulin())
+
+    for change in [lambda : setattr(bolus,'insulin',2*bolus.insulin),
+                   lambda : setattr(bolus,'Ta',1.5),
+                   lambda : setattr(basal,'deliveryAmounts',0.5*basal.deliveryAmounts)] :
+        before = exercise.getMagnitudeOfBGEffect(profile)
+        change()
+        after = exercise.getMagnitudeOfBGEffect(profile)
+        assert after != before,'ExerciseEffect: cached magnitude after a change of its affected events'
+        assert abs(after - Uncached(exercise)) < tolerance,'ExerciseEffect: magnitude off by %g'%(after - Uncached(exercise))
+    return
+
+#------------------------------------------------------------------
+def CheckActiveEffect(ndays=40,seed=0,tolerance=1e-9) :
+    # ActiveEffectIndex gives the sum of BGEffectRemaining over the started events
+    time_start,events,profile,user_settings = MakeSyntheticPatient(ndays,seed)
+    index = ActiveEffectIndex(events,profile)
+    indexed = list(e for e in events if e.__class__.__name__ in activeEffectKindOf.keys())
+    for time_ut in np.arange(time_start + 3600.,time_start + ndays*86400,4321.).tolist() :
+        expected = sum(e.BGEffectRemaining(time_ut,profile) for e in indexed if e.iov_0_utc <= time_ut)
+        difference = abs(index.Total(time_ut) - expected)
+        assert difference < tolerance,'ActiveEffectIndex off by %g mg/dL at %s'%(difference,time.ctime(time_ut))
+    return
+
+checks = [CheckBundleRoundTrip,CheckStoreRoundTrip,CheckBinCaching,CheckExerciseCaching,CheckActiveEffect]
+
+#------------------------------------------------------------------
+def main(argv=None) :
+    parser = argparse.ArgumentParser(description='Consistency checks of the BG model.')
+    parser.add_argument('--days',type=int,default=40,help='history length, in days')
+    parser.add_argument('--seed',type=int,default=0)
+    args = parser.parse_args(argv)
+
+    for check in checks :
+        check(args.days,args.seed)
+        print('%-40s ok'%(check.__name__))
+    return
+
+if __name__ == '__main__' :
+    main()
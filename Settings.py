@@ -3,6 +3,9 @@ from collections import OrderedDict
 import datetime as dt
 import time
 import json
+import bisect
+from .TimeOfDay import *
+from .BGCache import *
 
 #
 # This is meant to store a list of settings snapshots, with the day starting from 12am.
@@ -15,6 +18,11 @@ class UserSetting :
         self.dtype = [('time_seconds',np.int32),('value',np.float64)]
         self.settings_24h = []
         self.type_of_setting = _type_of_setting
+
+        # Index of the snapshots: the parsed (utc) start time of each snapshot in settings_24h,
+        # and a cache of the snapshots as (read-only) numpy arrays, by timestamp string.
+        self.snapshotTimes = []
+        self.snapshotArrays = dict()
         return
 
     def toJson(self) :
@@ -32,57 +40,122 @@ class UserSetting :
                 hour_by_hour.append((setting_at_time_of_day[0],setting_at_time_of_day[1]))
             the_class.settings_24h.append([setting[0],hour_by_hour])
 
+        the_class.RebuildIndex()
         return the_class
 
+    @staticmethod
+    def ParseTimestamp(timestamp) :
+        return time.mktime(time.strptime(timestamp.replace('T',' '), "%Y-%m-%d %H:%M:%S"))
+
+    def RebuildIndex(self) :
+        # (Re-)parse the snapshot timestamps. Only needed if settings_24h is modified by hand.
+        self.settings_24h.sort(key=lambda x: UserSetting.ParseTimestamp(x[0]))
+        self.snapshotTimes = list(UserSetting.ParseTimestamp(x[0]) for x in self.settings_24h)
+        self.snapshotArrays = dict()
+        return
+
+    def CheckIndex(self) :
+        if len(self.snapshotTimes) != len(self.settings_24h) :
+            self.RebuildIndex()
+        return
+
     def ToNumpyArray(self,settings_list) :
         return np.array(settings_list, dtype=self.dtype)
 
+    def getSnapshotArray(self,i) :
+        # The i'th snapshot as a numpy array (cached; do not modify it)
+        timestamp,settings_list = self.settings_24h[i]
+
+        cached = self.snapshotArrays.get(timestamp)
+        if (cached is None) or (len(cached) != len(settings_list)) :
+            cached = self.ToNumpyArray(settings_list)
+            cached.flags.writeable = False
+            self.snapshotArrays[timestamp] = cached
+
+        return cached
+
     def latestSettingsSnapshot(self) :
         if not self.settings_24h :
             print('warning! No insulin-carb ratio on record!')
         else :
-            latest_snapshot = list(self.settings_24h[-1][1])
-            return self.ToNumpyArray(latest_snapshot)
+            return self.getSnapshotArray(-1)
 
         return None
 
     def getOrMakeSettingsSnapshot_list(self,timestamp) :
 
-        # Get the latest settings snapshot, if it exists
-        for setting in self.settings_24h :
-            if setting[0] == timestamp :
-                return setting[1]
+        self.CheckIndex()
+        the_time = UserSetting.ParseTimestamp(timestamp)
 
-        # If it does not exist, make a new one:
-        self.settings_24h.append((timestamp,[]))
+        # Get the latest settings snapshot, if it exists
+        i = bisect.bisect_left(self.snapshotTimes,the_time)
+        while i < len(self.snapshotTimes) and self.snapshotTimes[i] == the_time :
+            if self.settings_24h[i][0] == timestamp :
+                return self.settings_24h[i][1]
+            i += 1
 
-        # sort by utc time
-        self.settings_24h.sort(key=lambda x: time.mktime(time.strptime(x[0].replace('T',' '), "%Y-%m-%d %H:%M:%S")))
+        # If it does not exist, make a new one (keeping them sorted by utc time)
+        i = bisect.bisect_right(self.snapshotTimes,the_time)
+        self.settings_24h.insert(i,(timestamp,[]))
+        self.snapshotTimes.insert(i,the_time)
 
-        return self.getOrMakeSettingsSnapshot_list(timestamp)
+        return self.settings_24h[i][1]
 
     def getOrMakeSettingsSnapshot(self,timestamp) :
 
-        return self.ToNumpyArray(self.getOrMakeSettingsSnapshot_list(timestamp))
+        self.getOrMakeSettingsSnapshot_list(timestamp)
+        return self.getSnapshotArray(self.GetSnapshotIndex(timestamp))
+
+    def GetSnapshotIndex(self,timestamp) :
+        # Index (in settings_24h) of the snapshot started at exactly this timestamp
+        for i in range(bisect.bisect_left(self.snapshotTimes,UserSetting.ParseTimestamp(timestamp)),len(self.settings_24h)) :
+            if self.settings_24h[i][0] == timestamp :
+                return i
+        return None
+
+    def getValidSnapshotIndexAtUtc(self,time_utc) :
+        # The snapshot valid at time_utc (before the first snapshot, the first one is used)
+        self.CheckIndex()
+        return max(bisect.bisect_right(self.snapshotTimes,time_utc) - 1,0)
+
+    def getValidSnapshotAtUtc(self,time_utc) :
+        return self.getSnapshotArray(self.getValidSnapshotIndexAtUtc(time_utc))
 
     def getValidSnapshotAtTime(self,timestamp) :
 
-        the_time = time.mktime(time.strptime(timestamp.replace('T',' '), "%Y-%m-%d %H:%M:%S"))
+        the_time = UserSetting.ParseTimestamp(timestamp)
+        return self.getValidSnapshotAtUtc(the_time)
+
+    def GetSettingAtUtc(self,times_utc) :
+        # The setting value at each utc time (scalar or array), using the snapshot
+        # valid at that time and the local time of day.
+        self.CheckIndex()
+        times = np.atleast_1d(np.asarray(times_utc,dtype=np.float64))
 
-        for i in range(len(self.settings_24h)-1) :
+        snapshot = np.searchsorted(np.array(self.snapshotTimes),times,side='right') - 1
+        snapshot = np.maximum(snapshot,0)
+        seconds = timeOfDay.LocalSeconds(times)
 
-            iov_0 = time.mktime(time.strptime(self.settings_24h[i][0].replace('T',' '), "%Y-%m-%d %H:%M:%S"))
-            iov_1 = time.mktime(time.strptime(self.settings_24h[i+1][0].replace('T',' '), "%Y-%m-%d %H:%M:%S"))
+        values = np.zeros(len(times))
+        for i in np.unique(snapshot) :
+            settings = self.getSnapshotArray(i)
+            if not settings.size :
+                print('Missing settings.')
+                raise AttributeError
 
-            if (i == 0 and the_time < iov_0) or (the_time >= iov_0 and the_time < iov_1) :
-                return self.ToNumpyArray(self.settings_24h[i][1])
+            mask = (snapshot == i)
+            index = np.searchsorted(settings['time_seconds'],seconds[mask],side='right')
+            values[mask] = settings['value'][index-1]
 
-        return self.ToNumpyArray(self.settings_24h[-1][1])
+        if not np.ndim(times_utc) :
+            return values[0]
+        return values
 
     def AddSettingToSnapshot(self,timestamp,timeOfDay_hr,value) :
         # The input, timeOfDay, is in hours (float), starting from MIDNIGHT
 
         settings_list = self.getOrMakeSettingsSnapshot_list(timestamp)
+        self.snapshotArrays.pop(timestamp,None)
 
         timeOfDay_seconds = int(dt.timedelta(hours=timeOfDay_hr).total_seconds())
 
@@ -117,10 +190,144 @@ class UserSetting :
 
 #------------------------------------------------------------------
 
+#------------------------------------------------------------------
+class TrackedArray(np.ndarray) :
+    #
+    # A profile parameter (e.g. TrueUserProfile.InsulinSensitivity): a read-only view of
+    # its field in the profile record array. Assigning to it writes through the profile
+    # and tells it which bins changed, so that it can update their versions. Anything made
+    # from it (slices, arithmetic) is not tracked, and slices stay read-only.
+    #
+    owner = None
+    name = None
+
+    def __array_finalize__(self,obj) :
+        self.owner = None
+        self.name = None
+        return
+
+    def __setitem__(self,i,value) :
+        if self.owner is None :
+            np.ndarray.__setitem__(self,i,value)
+            return
+
+        self.owner.binsData[self.name][i] = value
+        if isinstance(i,slice) :
+            self.owner.Touch(self.name,range(len(self))[i])
+        elif isinstance(i,(int,np.integer)) :
+            self.owner.Touch(self.name,[i % len(self)])
+        else :
+            self.owner.Touch(self.name,np.arange(len(self))[i].ravel().tolist())
+        return
+
+    # In-place arithmetic: through __setitem__
+    def InPlace(operator) :
+        def Wrapped(self,other) :
+            self[:] = operator(np.asarray(self),other)
+            return self
+        return Wrapped
+
+    __iadd__      = InPlace(np.add)
+    __isub__      = InPlace(np.subtract)
+    __imul__      = InPlace(np.multiply)
+    __itruediv__  = InPlace(np.true_divide)
+    del InPlace
+
 #------------------------------------------------------------------
 class TrueUserProfile :
 
+    # The parameters, one float per bin each, are the fields of one record array (bins),
+    # and the attributes (e.g. self.InsulinSensitivity) are TrackedArray views of them.
+    # Every change gets a new version (see BGCache):
+    #   version                  : the latest change to anything
+    #   arrayVersions[name]      : the latest change to the array
+    #   binVersions[name][bin]   : the latest change to one bin (BGEventBase.CachedResult
+    #                              keeps a result while the bins it read are unchanged)
+    parameterNames = ['InsulinSensitivity','FoodSensitivity','FoodTa','InsulinTa','LiverHourlyGlucose']
+    parameterDefaults = [0.,0.,2.,4.,0.]
+    dtype = list((name,np.float64) for name in parameterNames)
+
+    def __setattr__(self,name,value) :
+        if name in TrueUserProfile.parameterNames :
+            values = np.asarray(value,dtype=np.float64)
+            if values.shape != (self.nBins,) :
+                raise ValueError('TrueUserProfile: %s needs %d values (nBins), not %s'%(name,self.nBins,values.shape))
+            self.binsData[name] = values
+            self.Touch(name,None)
+            return
+
+        object.__setattr__(self,name,value)
+
+        # A new number of bins: a new record array (with the default values)
+        if name == 'nBins' and (len(self.__dict__.get('binsData',())) != value) :
+            self.MakeBins()
+            return
+
+        # The binning changes the meaning of every bin
+        if name in ['binWidth_hr','nBins'] :
+            for parameter in TrueUserProfile.parameterNames :
+                if parameter in self.__dict__ :
+                    self.Touch(parameter,None)
+        return
+
+    def MakeBins(self) :
+        binsData = np.zeros(self.nBins,dtype=TrueUserProfile.dtype)
+        for parameter,default in zip(TrueUserProfile.parameterNames,TrueUserProfile.parameterDefaults) :
+            binsData[parameter] = default
+
+        self.__dict__['binsData'] = binsData
+        self.__dict__['bins'] = binsData.view()
+        self.bins.flags.writeable = False
+
+        for parameter in TrueUserProfile.parameterNames :
+            view = binsData[parameter].view(TrackedArray)
+            view.flags.writeable = False
+            view.owner = self
+            view.name = parameter
+            self.__dict__[parameter] = view
+            self.Touch(parameter,None)
+        return
+
+    def __getstate__(self) :
+        # (the parameters as lists, after nBins)
+        state = OrderedDict()
+        for key,value in self.__dict__.items() :
+            if key in ['binsData','bins'] :
+                continue
+            state[key] = value.tolist() if (key in TrueUserProfile.parameterNames) else value
+        return state
+
+    def __setstate__(self,state) :
+        # (unpickled or copied: new versions, since they are only unique within one process)
+        self.arrayVersions = dict()
+        self.binVersions = dict()
+        self.version = NewVersion()
+        for key,value in state.items() :
+            if key not in ['arrayVersions','binVersions','version'] :
+                setattr(self,key,value)
+        return
+
+    def Touch(self,name,bins) :
+        # Mark bins (or the whole array, if bins is None) of one parameter as changed
+        version = NewVersion()
+        self.__dict__['version'] = version
+        self.arrayVersions[name] = version
+
+        n = len(getattr(self,name))
+        if (bins is None) or (len(self.binVersions.get(name,[])) != n) :
+            self.binVersions[name] = [version]*n
+            return
+
+        versions = self.binVersions[name]
+        for i in bins :
+            versions[i] = version
+        return
+
     def __init__(self) :
+        self.arrayVersions = dict()
+        self.binVersions = dict()
+        self.version = NewVersion()
+
         #
         # Independent parameters:
         #
@@ -137,39 +344,67 @@ class TrueUserProfile :
     def toJson(self) :
         return json.dumps({'binWidth_hr':self.binWidth_hr,
                            'nBins':self.nBins,
-                           'InsulinSensitivity':self.InsulinSensitivity,
-                           'FoodSensitivity':self.FoodSensitivity,
-                           'FoodTa':self.FoodTa,
-                           'InsulinTa':self.InsulinTa,
-                           'LiverHourlyGlucose':self.LiverHourlyGlucose})
+                           'InsulinSensitivity':self.InsulinSensitivity.tolist(),
+                           'FoodSensitivity':self.FoodSensitivity.tolist(),
+                           'FoodTa':self.FoodTa.tolist(),
+                           'InsulinTa':self.InsulinTa.tolist(),
+                           'LiverHourlyGlucose':self.LiverHourlyGlucose.tolist()})
 
     @classmethod
     def fromJson(cls,json_string) :
         the_dict = json.loads(json_string)
         the_class = cls()
-        for key in the_dict.keys() :
+        # (nBins first: the parameters need to have that many values)
+        for key in sorted(the_dict.keys(),key=lambda x : x in TrueUserProfile.parameterNames) :
             setattr(the_class,key,the_dict[key])
         return the_class
 
+    def Fingerprint(self) :
+        # A hashable summary of all of the parameters (for caching results that depend on them)
+        return (self.binWidth_hr,
+                tuple(self.InsulinSensitivity.tolist()),
+                tuple(self.FoodSensitivity.tolist()),
+                tuple(self.FoodTa.tolist()),
+                tuple(self.InsulinTa.tolist()),
+                tuple(self.LiverHourlyGlucose.tolist()))
+
     @staticmethod
-    def SettingsArrayToList(the_settings_array,outlist) :
-        # Something to convert the array into a list
-        # input (outlist) is a list with 48 entries
+    def SettingsArrayToBins(the_settings_array,nBins) :
+        # The setting (a UserSetting snapshot) at the start of each of nBins bins of the day
+        if not the_settings_array.size :
+            print('Missing settings.')
+            raise AttributeError
 
-        for i in range(len(outlist)) :
-            time_hr = i * 24. / float(len(outlist))
-            outlist[i] = UserSetting.GetSettingAtTime(the_settings_array,time_hr)
+        seconds = np.arange(nBins,dtype=np.int64)*86400//nBins
+        index = np.searchsorted(the_settings_array['time_seconds'],seconds,side='right')
+        return the_settings_array['value'][index-1].astype(np.float64)
 
+    @staticmethod
+    def SettingsArrayToList(the_settings_array,outlist) :
+        # Something to convert the array into a list
+        # input (outlist) is a list (or array) with 48 entries
+        outlist[:] = TrueUserProfile.SettingsArrayToBins(the_settings_array,len(outlist)).tolist()
         return
 
     def getBin(self,time_ut) :
-        # From midnight ... and assuming 48 bins
-        return int(time.localtime(time_ut).tm_hour/self.binWidth_hr)
+        # From midnight ... and assuming 48 bins (time_ut can also be an array)
+        hours = timeOfDay.Hour(time_ut)
+        if np.ndim(hours) :
+            return (hours/self.binWidth_hr).astype(np.int64)
+        return int(hours/self.binWidth_hr)
 
     def getBinFromHourOfDay(self,time_hr) :
-        # From midnight ... and assuming 48 bins
+        # From midnight ... and assuming 48 bins (time_hr can also be an array)
+        if np.ndim(time_hr) :
+            return ((np.asarray(time_hr,dtype=np.float64)%24)/self.binWidth_hr).astype(np.int64)
         return int( (time_hr%24) /self.binWidth_hr)
 
+    # The getters below take a time (or an array of times, for an array of values)
+
+    def getParameters(self,time_ut) :
+        # All of the parameters at once: the record(s) of the bins
+        return self.bins[self.getBin(time_ut)]
+
     def getInsulinSensitivity(self,time_ut) :
         return self.InsulinSensitivity[self.getBin(time_ut)]
 
@@ -189,8 +424,7 @@ class TrueUserProfile :
         return self.InsulinTa[self.getBin(time_ut)]
 
     def setInsulinTa(self,val) :
-        for i in range(self.nBins) :
-            self.InsulinTa[i] = val
+        self.InsulinTa[:] = val
 
     def getInsulinTaHrMidnight(self,time_hr) :
         return self.InsulinTa[self.getBinFromHourOfDay(time_hr)]
@@ -199,8 +433,7 @@ class TrueUserProfile :
         return self.FoodTa[self.getBin(time_ut)]
 
     def setFoodTa(self,val) :
-        for i in range(self.nBins) :
-            self.FoodTa[i] = val
+        self.FoodTa[:] = val
 
     def getFoodTaHrMidnight(self,time_hr) :
         return self.FoodTa[self.getBinFromHourOfDay(time_hr)]
@@ -217,47 +450,45 @@ class TrueUserProfile :
 
     def AddSensitivityFromArrays(self,h_insulin,h_ric) :
 
-        self.SettingsArrayToList(h_insulin,self.InsulinSensitivity)
+        insulin = self.SettingsArrayToBins(h_insulin,self.nBins)
 
         # We want to save the food sensitivity, not the RIC. Food sensitivity is the independent var.
-        tmp_ric = [0]*self.nBins
-        self.SettingsArrayToList(h_ric,tmp_ric)
-        for i in range(len(tmp_ric)) :
-            self.FoodSensitivity[i] = self.InsulinSensitivity[i] / float(tmp_ric[i])
+        ric = self.SettingsArrayToBins(h_ric,self.nBins)
+        self.FoodSensitivity = insulin / ric
 
         # Invert the sign of the sensitivity:
-        for i in range(len(self.InsulinSensitivity)) :
-            self.InsulinSensitivity[i] = -self.InsulinSensitivity[i]
+        self.InsulinSensitivity = -insulin
 
         return
 
     def AddHourlyGlucoseFromArrays(self,h_basal,h_duration) :
 
-        sensitivity_set = (True in list(a != 0 for a in self.InsulinSensitivity))
+        sensitivity_set = np.any(self.InsulinSensitivity != 0)
         if not sensitivity_set :
             print('Error - tried to make basal glucose, but sensitivity is not set!')
             return
 
-        tmp_basal = [0]*self.nBins
-        self.SettingsArrayToList(h_basal,tmp_basal)
-        tmp_duration = [0]*self.nBins
-        self.SettingsArrayToList(h_duration,tmp_duration)
+        basal = self.SettingsArrayToBins(h_basal,self.nBins)
+        duration = self.SettingsArrayToBins(h_duration,self.nBins)
 
         # assume that the user was trying to match the glucose from 2 hours in the future.
-        for i in range(len(tmp_basal)) :
-            # E.g. 4*30 minutes earlier, which sometimes goes to the other end of the array.
-
-            peak_point = tmp_duration[i]/2. # Assume the peak of the basal is Ta/2.
-            offset = int( peak_point / float(self.binWidth_hr))
+        # E.g. 4*30 minutes earlier, which sometimes goes to the other end of the array.
+        peak_point = duration/2. # Assume the peak of the basal is Ta/2.
+        offset = (peak_point / float(self.binWidth_hr)).astype(np.int64)
+        target = (np.arange(self.nBins) + offset)%self.nBins
 
-            self.LiverHourlyGlucose[(i+offset)%self.nBins] = - tmp_basal[i] * self.InsulinSensitivity[i]
+        # (if two bins land on the same one, the later bin wins; bins that nothing lands on are kept)
+        target,last = np.unique(target[::-1],return_index=True)
+        liver = np.array(self.LiverHourlyGlucose)
+        liver[target] = (- basal * self.InsulinSensitivity)[::-1][last]
+        self.LiverHourlyGlucose = liver
 
         return
 
 
     def AddDurationFromArray(self,h_duration) :
 
-        self.SettingsArrayToList(h_duration,self.InsulinTa)
+        self.InsulinTa = self.SettingsArrayToBins(h_duration,self.nBins)
         return
 
 
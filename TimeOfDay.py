@@ -0,0 +1,157 @@
+import math
+import time
+import bisect
+import numpy as np
+
+#------------------------------------------------------------------
+class LocalTimeBinning :
+    #
+    # Local time-of-day lookups (the same answers as time.localtime, including
+    # daylight saving time), without calling time.localtime every time.
+    #
+    # The local utc offset is tabulated once over the range of interest: it is
+    # probed once per day, and each change (DST transition) is located to the second
+    # by bisection. After that, the local time of day of any utc timestamp is just
+    #     (t + offset(t)) % 86400
+    # in integer arithmetic, and arrays of timestamps are done in one go.
+    #
+    day_s = 86400
+    block_s = 366*86400 # the table is extended by (roughly) one year at a time
+
+    def __init__(self) :
+        self.lo = None
+        self.hi = None
+        self.starts = []  # utc times at which each offset starts to be valid (sorted)
+        self.offsets = [] # seconds east of utc
+        self.startsArray = np.zeros(0,dtype=np.int64)
+        self.offsetsArray = np.zeros(0,dtype=np.int64)
+        return
+
+    @staticmethod
+    def GetOffset(time_ut) :
+        return time.localtime(time_ut).tm_gmtoff
+
+    def Cover(self,time_lo,time_hi) :
+        # Make sure that the table covers [time_lo,time_hi]
+        if (self.lo is not None) and (self.lo <= time_lo) and (time_hi < self.hi) :
+            return
+
+        lo = int(time_lo//self.block_s)*self.block_s
+        hi = (int(time_hi//self.block_s)+1)*self.block_s
+        if self.lo is not None :
+            lo = min(lo,self.lo)
+            hi = max(hi,self.hi)
+
+        starts = [lo]
+        offsets = [LocalTimeBinning.GetOffset(lo)]
+
+        probe = lo
+        while probe < hi :
+            next_probe = probe + self.day_s
+            offset = LocalTimeBinning.GetOffset(next_probe)
+            if offset != offsets[-1] :
+                # Find the first second with the new offset
+                a,b = probe,next_probe
+                while b - a > 1 :
+                    mid = (a+b)//2
+                    if LocalTimeBinning.GetOffset(mid) == offset :
+                        b = mid
+                    else :
+                        a = mid
+                starts.append(b)
+                offsets.append(offset)
+            probe = next_probe
+
+        self.lo,self.hi = lo,hi
+        self.starts,self.offsets = starts,offsets
+        self.startsArray = np.array(starts,dtype=np.int64)
+        self.offsetsArray = np.array(offsets,dtype=np.int64)
+        return
+
+    def LocalSeconds(self,time_ut) :
+        # Seconds since local midnight (tm_hour*3600 + tm_min*60 + tm_sec)
+        if np.ndim(time_ut) :
+            t = np.floor(np.asarray(time_ut,dtype=np.float64)).astype(np.int64)
+            if not t.size :
+                return t
+            self.Cover(int(t.min()),int(t.max()))
+            i = np.searchsorted(self.startsArray,t,side='right') - 1
+            return (t + self.offsetsArray[i]) % self.day_s
+
+        t = int(math.floor(time_ut))
+        if (self.lo is None) or not (self.lo <= t < self.hi) :
+            self.Cover(t,t)
+        i = bisect.bisect_right(self.starts,t) - 1
+        return (t + self.offsets[i]) % self.day_s
+
+    def Hour(self,time_ut) :
+        # Like time.localtime(time_ut).tm_hour
+        return self.LocalSeconds(time_ut)//3600
+
+    def HourOfDay(self,time_ut) :
+        # Fractional hour of the day, to the minute (tm_hour + tm_min/60.)
+        seconds = self.LocalSeconds(time_ut)
+        return seconds//3600 + ((seconds%3600)//60)/60.
+
+    def GetBin(self,time_ut,binWidth_hr) :
+        # Time-of-day bin (from midnight), for bins of binWidth_hr hours
+        hours = self.HourOfDay(time_ut)
+        if np.ndim(hours) :
+            return (hours/float(binWidth_hr)).astype(np.int64)
+        return int(hours/float(binWidth_hr))
+
+    def SecondsIntoHour(self,time_ut) :
+        # 60*tm_min + tm_sec
+        return self.LocalSeconds(time_ut)%3600
+
+    def Midnight(self,time_ut) :
+        # Local midnight of the day (time_ut - 3600*tm_hour - 60*tm_min - tm_sec)
+        return time_ut - self.LocalSeconds(time_ut)
+
+    def LocalToUtc(self,local_s) :
+        # The inverse of t + offset(t): utc times from local calendar seconds (the local date
+        # and time counted as if they were utc, i.e. calendar.timegm of the local struct_time).
+        # Around an offset change, a repeated local time gets the earlier of its two utc times,
+        # and a skipped local time is read with the offset from before the change (like mktime).
+        if not np.ndim(local_s) :
+            return self.LocalToUtcScalar(int(local_s))
+
+        local_s = np.asarray(local_s,dtype=np.int64)
+        if not local_s.size :
+            return local_s
+
+        self.Cover(int(local_s.min()) - 2*self.day_s,int(local_s.max()) + 2*self.day_s)
+
+        def Offset(t) :
+            return self.offsetsArray[np.searchsorted(self.startsArray,t,side='right') - 1]
+
+        # (offset changes are much more than a day apart)
+        before = Offset(local_s - self.day_s)
+        after = Offset(local_s + self.day_s)
+        utc = local_s - before
+        utc_after = local_s - after
+        use_after = (before != after) & (utc_after + Offset(utc_after) == local_s)
+        use_after &= ~(utc + Offset(utc) == local_s) | (utc_after < utc)
+        return np.where(use_after,utc_after,utc)
+
+    def LocalToUtcScalar(self,local_s) :
+        # Same as LocalToUtc, for one time
+        if (self.lo is None) or not (self.lo <= local_s - 2*self.day_s and local_s + 2*self.day_s < self.hi) :
+            self.Cover(local_s - 2*self.day_s,local_s + 2*self.day_s)
+
+        def Offset(t) :
+            return self.offsets[bisect.bisect_right(self.starts,t) - 1]
+
+        before = Offset(local_s - self.day_s)
+        after = Offset(local_s + self.day_s)
+        utc = local_s - before
+        if before == after :
+            return utc
+
+        utc_after = local_s - after
+        if (utc_after + Offset(utc_after) == local_s) and ((utc + Offset(utc) != local_s) or (utc_after < utc)) :
+            return utc_after
+        return utc
+
+# The shared instance
+timeOfDay = LocalTimeBinning()
@@ -0,0 +1,102 @@
+import time
+import calendar
+import numpy as np
+from .TimeOfDay import *
+from .BGBaseClasses import timestampFormats
+
+#------------------------------------------------------------------
+class TimestampParser :
+    #
+    # Local timestamp strings to utc, like BGEventBase.GetUtcFromString, but for whole
+    # columns of a file:
+    # - The format is detected once (from the first string), not tried per string.
+    # - The date and time-of-day parts are parsed once each and memoized (an export has
+    #   only a few hundred distinct dates).
+    # - Local time is converted to utc with the offset table of timeOfDay, in one go for
+    #   the column (see LocalToUtc for the repeated and skipped hours of DST changes).
+    # - Rows that cannot be parsed are reported (row,string) instead of raising.
+    #
+    #     parser = TimestampParser()
+    #     times_utc,errors = parser.Parse(list_of_strings)
+    #
+    def __init__(self,formats=timestampFormats) :
+        self.formats = list(formats)
+        self.format = None
+        self.dates = dict() # date string -> days since the epoch (local calendar)
+        self.times = dict() # time string -> seconds since midnight
+        return
+
+    def Detect(self,time_str) :
+        # The first format that can parse time_str
+        for fmt in self.formats :
+            try :
+                time.strptime(time_str,fmt)
+            except ValueError :
+                continue
+            self.SetFormat(fmt)
+            return fmt
+
+        raise ValueError('TimestampParser: unknown timestamp format: %s'%(time_str))
+
+    def SetFormat(self,fmt) :
+        # Split the format into its date and time-of-day parts (at the character before %H)
+        i = fmt.index('%H')
+        self.format = fmt
+        self.separator = fmt[i-1]
+        self.dateFormat = fmt[:i-1]
+        self.timeFormat = fmt[i:]
+        self.dates = dict()
+        self.times = dict()
+        return
+
+    def LocalSeconds(self,time_str) :
+        # The local calendar time of time_str, in seconds (as if it were utc)
+        if self.format is None :
+            self.Detect(time_str)
+
+        date_str,separator,time_of_day_str = time_str.partition(self.separator)
+
+        days = self.dates.get(date_str)
+        if days is None :
+            days = calendar.timegm(time.strptime(date_str,self.dateFormat))//86400
+            self.dates[date_str] = days
+
+        seconds = self.times.get(time_of_day_str)
+        if seconds is None :
+            seconds = self.TimeOfDaySeconds(time_of_day_str)
+            self.times[time_of_day_str] = seconds
+
+        return days*86400 + seconds
+
+    def TimeOfDaySeconds(self,time_of_day_str) :
+        # (the usual H:M:S without strptime)
+        if self.timeFormat == '%H:%M:%S' :
+            fields = time_of_day_str.split(':')
+            if len(fields) == 3 and all(x.isdigit() and len(x) <= 2 for x in fields) :
+                hour,minute,second = (int(x) for x in fields)
+                if hour < 24 and minute < 60 and second < 62 :
+                    return hour*3600 + minute*60 + second
+
+        tm = time.strptime(time_of_day_str,self.timeFormat)
+        return tm.tm_hour*3600 + tm.tm_min*60 + tm.tm_sec
+
+    def Parse(self,strings) :
+        # Returns an int64 array of utc times (0 where parsing failed) and a list of (row,string) errors
+        n = len(strings)
+        local = np.zeros(n,dtype=np.int64)
+        ok = np.ones(n,dtype=bool)
+        errors = []
+        for i,time_str in enumerate(strings) :
+            try :
+                local[i] = self.LocalSeconds(time_str)
+            except (ValueError,AttributeError) :
+                ok[i] = False
+                errors.append((i,time_str))
+
+        utc = np.zeros(n,dtype=np.int64)
+        utc[ok] = timeOfDay.LocalToUtc(local[ok])
+        return utc,errors
+
+    def ParseOne(self,time_str) :
+        # One string (raises ValueError if it cannot be parsed)
+        return int(timeOfDay.LocalToUtc(self.LocalSeconds(time_str)))